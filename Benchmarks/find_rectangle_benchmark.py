@@ -0,0 +1,46 @@
+"""
+Compares find_biggest_rectangle searching the whole mask with the pyramid mode on 4K reference images
+Usage: find_rectangle_benchmark.py [repeats]
+"""
+
+import sys
+import os
+import cv2
+import numpy
+from timeit import timeit
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from constants import default_hue_range, default_saturation_range, default_value_range
+from functions.image_functions import find_biggest_rectangle
+
+image_size = (2160, 3840)
+marker_color = (255, 0, 0)
+
+# (name, number of single pixels in the marker color scattered over the image)
+scenarios = [('clean', 0), ('light noise', 2000), ('heavy noise', 200000)]
+
+def make_reference(generator: numpy.random.Generator, noise_pixels: int) -> numpy.ndarray:
+    image = cv2.GaussianBlur(generator.integers(0, 256, (*image_size, 3), dtype=numpy.uint8), (0, 0), 5)
+    cv2.rectangle(image, (1200, 600), (2600, 1500), marker_color, -1)
+    if noise_pixels > 0:
+        points = generator.integers(0, (image_size[1], image_size[0]), (noise_pixels, 2))
+        image[points[:, 1], points[:, 0]] = marker_color
+    return image
+
+def main(args: list[str]):
+    repeats = int(args[0]) if len(args) > 0 and args[0].isdigit() else 3
+    generator = numpy.random.default_rng(0)
+    print('{:>12} {:>12} {:>14} {:>10}'.format('reference', 'full [ms]', 'pyramid [ms]', 'speedup'))
+    for name, noise_pixels in scenarios:
+        image = make_reference(generator, noise_pixels)
+        find = lambda pyramid: find_biggest_rectangle(image, marker_color, default_hue_range, default_saturation_range, default_value_range, pyramid)
+        full_result = find(False)
+        pyramid_result = find(True)
+        if full_result.returnCode != pyramid_result.returnCode or full_result.returnValue != pyramid_result.returnValue:
+            print('Results differ for {} reference: {} and {}'.format(name, full_result.returnValue, pyramid_result.returnValue))
+            return
+        full_time = timeit(lambda: find(False), number=repeats) / repeats * 1000
+        pyramid_time = timeit(lambda: find(True), number=repeats) / repeats * 1000
+        print('{:>12} {:>12.1f} {:>14.1f} {:>9.1f}x'.format(name, full_time, pyramid_time, full_time / pyramid_time))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
\ No newline at end of file
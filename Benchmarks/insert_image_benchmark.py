@@ -0,0 +1,48 @@
+"""
+Compares the old per-pixel insert_image_into_image loop with the current slice based one
+Usage: insert_image_benchmark.py [repeats]
+"""
+
+import sys
+import os
+import cv2
+import numpy
+from timeit import timeit
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions.image_functions import insert_image_into_image
+
+background_size = (1080, 1920)
+# (height, width) of the image field
+field_sizes = [(50, 50), (100, 200), (400, 600), (720, 1280)]
+
+# Copy of the implementation before the compositing engine, kept only for comparison
+def legacy_insert_image_into_image(Image_background: numpy.array, Image_element: numpy.array, size_rect: tuple[int, int, int, int]) -> numpy.array:
+    y_initial, x_initial, y_final, x_final = size_rect
+    inserting_image = cv2.resize(Image_element, (x_final - x_initial + 1, y_final - y_initial + 1), interpolation=cv2.INTER_LINEAR)
+    returnImage = numpy.copy(Image_background)
+    for y in range(y_initial, y_final + 1):
+        for x in range(x_initial, x_final + 1):
+            returnImage[y][x] = inserting_image[y - y_initial][x - x_initial]
+    return returnImage
+
+def main(args: list[str]):
+    repeats = int(args[0]) if len(args) > 0 and args[0].isdigit() else 3
+    generator = numpy.random.default_rng(0)
+    background = generator.integers(0, 256, (*background_size, 3), dtype=numpy.uint8)
+    element = generator.integers(0, 256, (300, 300, 3), dtype=numpy.uint8)
+    output = numpy.empty_like(background)
+    print('{:>12} {:>12} {:>12} {:>12} {:>10}'.format('field', 'legacy [ms]', 'copy [ms]', 'buffer [ms]', 'speedup'))
+    for height, width in field_sizes:
+        rect = (10, 10, 10 + height - 1, 10 + width - 1)
+        expected = legacy_insert_image_into_image(background, element, rect)
+        result = insert_image_into_image(background, element, rect)
+        if not result or not numpy.array_equal(expected, result.returnValue):
+            print('Results differ for field {}x{}'.format(width, height))
+            return
+        legacy_time = timeit(lambda: legacy_insert_image_into_image(background, element, rect), number=repeats) / repeats * 1000
+        copy_time = timeit(lambda: insert_image_into_image(background, element, rect), number=repeats) / repeats * 1000
+        buffer_time = timeit(lambda: insert_image_into_image(background, element, rect, output), number=repeats) / repeats * 1000
+        print('{:>12} {:>12.2f} {:>12.2f} {:>12.2f} {:>9.0f}x'.format('{}x{}'.format(width, height), legacy_time, copy_time, buffer_time, legacy_time / copy_time))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
\ No newline at end of file
@@ -0,0 +1,47 @@
+"""
+Compares a formatted text query with the parameterized query going through the pool's prepared statement cache
+Needs a database set up with the credentials from settings.json and ideally some test data (Database/generate_testdata.py)
+Usage: prepared_statement_benchmark.py [repeats]
+"""
+
+import sys
+import os
+from timeit import timeit
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from constants import db_required_settings
+from functions.utils import load_settings, get_setting
+from functions.database_functions import setup_connection_pool, close_connection_pool, select
+
+formatted_query = 'SELECT id, filename FROM images WHERE user_id=\"{}\" AND enumeration={}'
+parameterized_query = 'SELECT id, filename FROM images WHERE user_id=%s AND enumeration=%s'
+
+def main(args: list[str]):
+    repeats = int(args[0]) if len(args) > 0 and args[0].isdigit() else 2000
+    result = load_settings(required_keys=db_required_settings)
+    if not result:
+        print(result)
+        return
+    result = setup_connection_pool(get_setting('db_username'), get_setting('db_password'), get_setting('database_name'), 1)
+    if not result:
+        print(result)
+        return
+    pool = result.returnValue
+    result = select(None, 'SELECT user_id, enumeration FROM images LIMIT 1')
+    user_id, enumeration = result.returnValue if result else ('0', 1)
+    # Both versions must see the same rows
+    formatted_result = select(None, formatted_query.format(user_id, enumeration))
+    parameterized_result = select(None, parameterized_query, params=(user_id, enumeration))
+    if formatted_result.returnValue != parameterized_result.returnValue:
+        print('Results differ: {} and {}'.format(formatted_result.returnValue, parameterized_result.returnValue))
+        close_connection_pool()
+        return
+    formatted_time = timeit(lambda: select(None, formatted_query.format(user_id, enumeration)), number=repeats) / repeats * 1000000
+    prepared_time = timeit(lambda: select(None, parameterized_query, params=(user_id, enumeration)), number=repeats) / repeats * 1000000
+    stats = pool.stats()
+    close_connection_pool()
+    print('{:>14} {:>14} {:>10}'.format('text [us]', 'prepared [us]', 'speedup'))
+    print('{:>14.1f} {:>14.1f} {:>9.2f}x'.format(formatted_time, prepared_time, formatted_time / prepared_time))
+    print('Statements prepared: {}, reused: {}'.format(stats['statements_prepared'], stats['statements_reused']))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
\ No newline at end of file
@@ -0,0 +1,124 @@
+"""
+Compares memory used by updating a template in use: drawing every field into a new copy of the image (flattened)
+against rasterizing changed fields into layers and compositing them into the session's image (layered)
+Peak is the most memory allocated at once during the update on top of what was allocated before it, as seen by tracemalloc
+Usage: render_memory_benchmark.py [fields] [repeats]
+"""
+
+import sys
+import os
+import cv2
+import numpy
+import tracemalloc
+from timeit import timeit
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions.image_functions import write_on_image, insert_image_into_image
+from functions.render_functions import LayeredImage, rasterize_field, fields_to_render, invalidate_field
+
+image_size = (2160, 3840)
+text_thickness = 2
+
+def make_fields(generator: numpy.random.Generator, count: int) -> dict:
+    fields = {}
+    columns = 6
+    cell_height = image_size[0] // ((count + columns - 1) // columns)
+    cell_width = image_size[1] // columns
+    for i in range(count):
+        top = (i // columns) * cell_height + 10
+        left = (i % columns) * cell_width + 10
+        bounds = (top, left, top + cell_height - 20, left + cell_width - 20)
+        if i % 4 == 0:
+            fields['field{}'.format(i)] = {'type': 'image', 'bounds': bounds, 'value': generator.integers(0, 256, (200, 300, 3), dtype=numpy.uint8), 'updated': False, 'layer': None}
+        else:
+            fields['field{}'.format(i)] = {'type': 'text', 'bounds': bounds, 'value': ('Field number {}'.format(i), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (0, 0, 0)), 'updated': False, 'layer': None}
+    return fields
+
+def draw_order(fields: dict) -> list[str]:
+    return sorted((name for name, field in fields.items() if not field['value'] is None), key=lambda name: fields[name]['type'] != 'image')
+
+# Every update starts from a copy of the template and each field is drawn into a new copy of the image
+def flattened_update(template: numpy.ndarray, fields: dict) -> tuple[numpy.ndarray, int]:
+    image = template.copy()
+    allocations = 1
+    for name in draw_order(fields):
+        field = fields[name]
+        if field['type'] == 'image':
+            image = insert_image_into_image(image, field['value'], field['bounds']).returnValue
+        else:
+            text, font, font_scale, color = field['value']
+            image = write_on_image(image, text, font, font_scale, color, text_thickness, cv2.LINE_8, field['bounds']).returnValue
+        allocations += 1
+    return image, allocations
+
+def layered_update(layers: LayeredImage, fields: dict) -> numpy.ndarray:
+    for field in fields.values():
+        if not field['value'] is None and field['layer'] is None:
+            field['layer'] = rasterize_field(field['type'], field['bounds'], field['value'], layers.shape, text_thickness, cv2.LINE_8).returnValue
+    names = fields_to_render(fields)
+    names.sort(key=lambda name: fields[name]['type'] != 'image')
+    layers.composite([fields[name]['layer'] for name in names])
+    for name in names:
+        fields[name]['updated'] = True
+    return layers.image
+
+def change_field(fields: dict, name: str, text: str):
+    _, font, font_scale, color = fields[name]['value']
+    fields[name]['value'] = (text, font, font_scale, color)
+
+def measure_peak(function) -> tuple[object, int]:
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    result = function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak - before
+
+def main(args: list[str]):
+    field_count = int(args[0]) if len(args) > 0 and args[0].isdigit() else 30
+    repeats = int(args[1]) if len(args) > 1 and args[1].isdigit() else 5
+    generator = numpy.random.default_rng(0)
+    template = cv2.GaussianBlur(generator.integers(0, 256, (*image_size, 3), dtype=numpy.uint8), (0, 0), 5)
+    flattened_fields = make_fields(numpy.random.default_rng(1), field_count)
+    layered_fields = make_fields(numpy.random.default_rng(1), field_count)
+    layers = LayeredImage(template)
+    # The copy of the template every session has is not counted in the updates
+    layers.prepare()
+    edited = 'field1'
+
+    (flattened_image, flattened_allocations), flattened_first_peak = measure_peak(lambda: flattened_update(template, flattened_fields))
+    layered_image, layered_first_peak = measure_peak(lambda: layered_update(layers, layered_fields))
+    if not numpy.array_equal(flattened_image, layered_image):
+        print('Images differ after the first update')
+        return
+    change_field(flattened_fields, edited, 'Changed text')
+    change_field(layered_fields, edited, 'Changed text')
+    invalidate_field(layers, layered_fields, edited)
+    (flattened_image, _), flattened_edit_peak = measure_peak(lambda: flattened_update(template, flattened_fields))
+    layered_image, layered_edit_peak = measure_peak(lambda: layered_update(layers, layered_fields))
+    if not numpy.array_equal(flattened_image, layered_image):
+        print('Images differ after editing a field')
+        return
+
+    def flattened_edit():
+        change_field(flattened_fields, edited, 'Changed text')
+        flattened_update(template, flattened_fields)
+    def layered_edit():
+        change_field(layered_fields, edited, 'Changed text')
+        invalidate_field(layers, layered_fields, edited)
+        layered_update(layers, layered_fields)
+    flattened_time = timeit(flattened_edit, number=repeats) / repeats * 1000
+    layered_time = timeit(layered_edit, number=repeats) / repeats * 1000
+    layer_mb = sum(field['layer'].nbytes() for field in layered_fields.values()) / 1024 / 1024
+
+    print('{} fields on a {}x{} template, one frame is {:.1f} MB'.format(field_count, image_size[1], image_size[0], template.nbytes / 1024 / 1024))
+    print('Flattened model allocated {} frames in the first update'.format(flattened_allocations))
+    print('{:>10} {:>24} {:>24} {:>10}'.format('model', 'first update peak [MB]', 'edit peak [MB]', 'edit [ms]'))
+    for name, first_peak, edit_peak, edit_time in (('flattened', flattened_first_peak, flattened_edit_peak, flattened_time), ('layered', layered_first_peak, layered_edit_peak, layered_time)):
+        first_text = '{:.1f} ({:.2f} frames)'.format(first_peak / 1024 / 1024, first_peak / template.nbytes)
+        edit_text = '{:.1f} ({:.2f} frames)'.format(edit_peak / 1024 / 1024, edit_peak / template.nbytes)
+        print('{:>10} {:>24} {:>24} {:>10.1f}'.format(name, first_text, edit_text, edit_time))
+    print('Layered session keeps 1 frame plus {:.1f} MB of layers'.format(layer_mb))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
\ No newline at end of file
@@ -14,14 +14,17 @@ INSERT INTO descriptions (field_name, description_text) VALUES
     ("right_bound_option", "The rightmost pixel of the image for the field area (top left corner is (0,0))"),
     ("reference_image_option", "The image with marked rectangle field. Make sure to fill the rectangle in"),
     ("reference_color_option", "The color you used to reference the field for the image. Use hexadecimal RGB color code"),
+    ("add_fields_command", "Adds a field for every region marked on a reference image"),
+    ("names_option", "Field names separated with commas, in order of colors, then top to bottom and left to right"),
+    ("reference_colors_option", "Colors you used to mark the fields, separated with commas. Use hexadecimal RGB color codes"),
     ("remove_field_command", "Removes a field with a given name from a template"),
     ("field_name_option", "A name for the field. Use /view with option show_fields=True to list your fields"),
     ("use_template_command", "Initialize using template by filling its fields"),
     ("fill_text_field_command", "Fill out a text field that you have registered for your command"),
     ("text_option", "What text you want to write on your field"),
     ("font_option", "What font style would you like to use?"),
-    ("font_size_option", "What font size would you like to use? This scales lineary and default is 3"),
+    ("font_size_option", "Font size, scales linearly. Leave empty or use 0 to fit the text to the field"),
     ("color_option", "What color do you want your text to be in? Use hexadecimal RGB color code"),
     ("fill_image_field_command", "Fill out an image field that you have registered for your command"),
     ("image_option", "Upload an image that you would like to put in your image field")
-;
\ No newline at end of file
+ON DUPLICATE KEY UPDATE description_text = VALUES(description_text);
\ No newline at end of file
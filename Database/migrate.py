@@ -0,0 +1,172 @@
+"""
+Upgrades a live database by applying versioned migrations from Database/migrations
+Migration files are named <version>_<name>.sql and are applied in order of their version, each at most once
+Usage: migrate.py [--status] [--no-explain]
+"""
+
+import sys
+import os
+import re
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from constants import db_required_settings, migrations_dir
+from functions.utils import load_settings, get_setting
+from functions.database_functions import connect_database, execute_query, select
+from functions.ReturnInfo import ReturnInfo
+from mysql.connector import MySQLConnection
+from mysql.connector.cursor import MySQLCursor
+
+migrations_table_query = 'CREATE TABLE IF NOT EXISTS schema_migrations (version INT NOT NULL PRIMARY KEY, name VARCHAR(255) NOT NULL, applied_at DATETIME NOT NULL)'
+
+# Lookups done by the bot on every interaction. Their plans are shown before and after migrating
+hot_queries = [
+    'SELECT id, filename FROM images WHERE user_id=\"0\" AND enumeration=1',
+    'SELECT image_extension, created_at, enumeration FROM images WHERE user_id=\"0\"',
+    'SELECT field_name, type, up_bound, left_bound, down_bound, right_bound FROM editable_fields WHERE image_id=1',
+    'SELECT 1 FROM editable_fields WHERE field_name=\"name\" AND image_id=1',
+    'SELECT i.id, i.filename, f.field_name, f.type FROM images AS i LEFT JOIN editable_fields AS f ON f.image_id=i.id WHERE i.user_id=\"0\" AND i.enumeration=1 ORDER BY f.id'
+]
+explain_columns = ['table', 'type', 'possible_keys', 'key', 'rows', 'Extra']
+
+# Rows that would make a migration fail or lose data, by version. A migration is applied only if none of its queries return anything,
+# otherwise the rows are listed and have to be fixed by hand
+migration_checks = {
+    1: [
+        ('Templates with the same user_id and enumeration (ids)', 'SELECT user_id, enumeration, GROUP_CONCAT(id ORDER BY id) FROM images GROUP BY user_id, enumeration HAVING COUNT(*) > 1'),
+        ('Fields with the same name in one template (image_id, field_name, ids)', 'SELECT image_id, field_name, GROUP_CONCAT(id ORDER BY id) FROM editable_fields GROUP BY image_id, field_name HAVING COUNT(*) > 1')
+    ]
+}
+
+def load_migrations(directory: str = migrations_dir) -> ReturnInfo:
+    ret = ReturnInfo(Messages={
+        1: 'Directory \"{}\" does not exist'.format(directory),
+        2: 'Version {} is used by more than one migration'
+    })
+    if not os.path.isdir(directory):
+        ret.returnCode = 1
+        return ret
+    migrations = {}
+    for filename in os.listdir(directory):
+        match = re.fullmatch(r'(\d+)_(\w+)\.sql', filename)
+        if match is None:
+            continue
+        version = int(match.group(1))
+        if version in migrations.keys():
+            ret.returnCode = 2
+            ret.format_message(2, version)
+            return ret
+        migrations[version] = (match.group(2), os.path.join(directory, filename))
+    ret.returnValue = dict(sorted(migrations.items()))
+    return ret
+
+def split_statements(script: str) -> list[str]:
+    lines = [line for line in script.splitlines() if not line.strip().startswith('--')]
+    return [statement.strip() for statement in '\n'.join(lines).split(';') if statement.strip()]
+
+# returnValue is a report of the rows found by the migration's checks, empty if there are none
+def check_migration(db_cursor: MySQLCursor, version: int) -> ReturnInfo:
+    report = ''
+    for description, query in migration_checks.get(version, []):
+        result = select(db_cursor, query, True, True)
+        if not result:
+            return result
+        if len(result.returnValue) == 0:
+            continue
+        report += '  {}:\n'.format(description)
+        for row in result.returnValue:
+            report += '    ' + ', '.join(str(value) for value in row) + '\n'
+    return ReturnInfo(returnValue=report)
+
+def get_applied_versions(db_handle: MySQLConnection, db_cursor: MySQLCursor) -> ReturnInfo:
+    result = execute_query(db_handle, db_cursor, migrations_table_query)
+    if not result:
+        return result
+    result = select(db_cursor, 'SELECT version FROM schema_migrations', True, True)
+    if not result:
+        return result
+    result.returnValue = set(row[0] for row in result.returnValue)
+    return result
+
+def print_explain_plans(db_cursor: MySQLCursor, title: str):
+    print(title)
+    for query in hot_queries:
+        print('  {}'.format(query))
+        db_cursor.execute('EXPLAIN ' + query)
+        rows = db_cursor.fetchall()
+        indexes = [db_cursor.column_names.index(column) for column in explain_columns]
+        for row in rows:
+            print('    ' + ', '.join('{}={}'.format(column, row[index]) for column, index in zip(explain_columns, indexes)))
+
+def apply_migrations(db_handle: MySQLConnection, db_cursor: MySQLCursor, explain: bool = True) -> ReturnInfo:
+    ret = ReturnInfo(Messages={
+        1: 'Migration {} failed on statement:\n{}\n{}',
+        2: 'Migration {} not applied. These rows have to be fixed by hand first:\n{}'
+    })
+    result = load_migrations()
+    if not result:
+        return result
+    migrations = result.returnValue
+    result = get_applied_versions(db_handle, db_cursor)
+    if not result:
+        return result
+    pending = [(version, name, filepath) for version, (name, filepath) in migrations.items() if not version in result.returnValue]
+    if len(pending) == 0:
+        print('Database is up to date')
+        return ret
+    if explain:
+        print_explain_plans(db_cursor, 'Query plans before migrating:')
+    for version, name, filepath in pending:
+        result = check_migration(db_cursor, version)
+        if not result:
+            return result
+        if result.returnValue:
+            ret.returnCode = 2
+            ret.format_message(2, version, result.returnValue.rstrip('\n'))
+            return ret
+        with open(filepath, 'r') as migration_file:
+            statements = split_statements(migration_file.read())
+        # MySQL commits DDL statements implicitly, so a migration is recorded only once all its statements went through
+        for statement in statements:
+            result = execute_query(db_handle, db_cursor, statement)
+            if not result:
+                ret.returnCode = 1
+                ret.format_message(1, version, statement, result)
+                return ret
+        result = execute_query(db_handle, db_cursor, 'INSERT INTO schema_migrations (version, name, applied_at) VALUES ({}, \"{}\", NOW())'.format(version, name))
+        if not result:
+            return result
+        print('Applied migration {}: {}'.format(version, name))
+    if explain:
+        print_explain_plans(db_cursor, 'Query plans after migrating:')
+    return ret
+
+def main(args: list[str]):
+    result = load_settings(required_keys=db_required_settings)
+    if not result:
+        print(result)
+        return
+    result = connect_database(get_setting('db_username'), get_setting('db_password'), get_setting('database_name'))
+    if not result:
+        print(result)
+        return
+    db_handle, db_cursor = result.returnValue
+    if '--status' in args:
+        result = load_migrations()
+        if not result:
+            print(result)
+            return
+        migrations = result.returnValue
+        result = get_applied_versions(db_handle, db_cursor)
+        if not result:
+            print(result)
+            return
+        for version, (name, _) in migrations.items():
+            print('{} {}: {}'.format(version, name, 'applied' if version in result.returnValue else 'pending'))
+        return
+    result = apply_migrations(db_handle, db_cursor, not '--no-explain' in args)
+    if not result:
+        print(result)
+        return
+    print('Done')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
\ No newline at end of file
@@ -0,0 +1,11 @@
+-- Indexes for the lookups every command does: images by (user_id, enumeration) and editable_fields by image_id or (image_id, field_name)
+-- Duplicates would make the unique indexes fail. The bot never creates them, but rows inserted by hand might
+-- migrate.py lists them and doesn't apply this migration until they are removed by hand, nothing is deleted here
+
+ALTER TABLE images ADD UNIQUE INDEX images_user_enumeration (user_id, enumeration);
+-- Covers listing templates and resolving (user_id, enumeration) to id and filename without reading the rows
+ALTER TABLE images ADD INDEX images_user_covering (user_id, enumeration, filename, image_extension, created_at);
+
+ALTER TABLE editable_fields ADD UNIQUE INDEX editable_fields_image_name (image_id, field_name);
+-- Covers reading all fields of a template
+ALTER TABLE editable_fields ADD INDEX editable_fields_image_covering (image_id, field_name, type, up_bound, left_bound, down_bound, right_bound);
\ No newline at end of file
@@ -0,0 +1,2 @@
+-- Font size of /fill_text_field now defaults to fitting the text to the field
+UPDATE descriptions SET description_text = "Font size, scales linearly. Leave empty or use 0 to fit the text to the field" WHERE field_name = "font_size_option";
\ No newline at end of file
@@ -0,0 +1,6 @@
+-- Descriptions of the /add_fields command
+INSERT INTO descriptions (field_name, description_text) VALUES
+    ("add_fields_command", "Adds a field for every region marked on a reference image"),
+    ("names_option", "Field names separated with commas, in order of colors, then top to bottom and left to right"),
+    ("reference_colors_option", "Colors you used to mark the fields, separated with commas. Use hexadecimal RGB color codes")
+ON DUPLICATE KEY UPDATE description_text = VALUES(description_text);
\ No newline at end of file
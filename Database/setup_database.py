@@ -5,6 +5,7 @@ from functions.database_functions import connect_database
 from functions.utils import load_settings, get_setting
 from constants import db_required_settings, setup_database_script
 from mysql.connector import Error as mysql_error, errorcode
+from migrate import apply_migrations
 
 def main():
     result = load_settings(required_keys=db_required_settings)
@@ -15,7 +16,7 @@ def main():
     if not connection:
         print(connection)
         return
-    _, db_cursor = connection.returnValue
+    db_handle, db_cursor = connection.returnValue
     ok = False
     try:
         with open(setup_database_script, 'r') as query_file:
@@ -39,8 +40,14 @@ def main():
     except PermissionError:
         print('Program could not access file \"{}\" due to missing permissions'.format(setup_database_script))
         return
-    if ok:
-        print('Done')
+    if not ok:
+        return
+    # Base schema is only the starting point, indexes and later changes come from migrations
+    result = apply_migrations(db_handle, db_cursor, explain=False)
+    if not result:
+        print(result)
+        return
+    print('Done')
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,3 +1,4 @@
+DROP TABLE IF EXISTS schema_migrations;
 DROP TABLE IF EXISTS editable_fields;
 DROP TABLE IF EXISTS images;
 DROP TABLE IF EXISTS descriptions;
@@ -5,25 +5,59 @@
 import discord
 import logging
 import asyncio
-from mysql.connector import MySQLConnection
-from mysql.connector.cursor import MySQLCursor
 from os import path, remove as remove_file
 from io import BytesIO
-from cv2 import imread, imencode, imdecode, IMREAD_COLOR, LINE_8, FONT_HERSHEY_SIMPLEX
-from numpy import asarray, uint8, copy as np_copy
+from typing import Any, Awaitable, Callable
+from itertools import count
+from time import perf_counter, monotonic, time
+from cv2 import LINE_8, FONT_HERSHEY_SIMPLEX
+from numpy import ndarray
 
-from constants import absolute_path_to_project, embed_default_color, default_color_hex, default_hue_range, default_saturation_range, default_value_range
-from functions.database_functions import select as mysql_select, execute_query
-from functions.image_functions import hex_to_bgr, show_fields as show_fields_image, find_biggest_rectangle, insert_image_into_image, write_on_image
+from constants import absolute_path_to_project, embed_default_color, default_color_hex, default_hue_range, default_saturation_range, default_value_range, default_min_field_area, default_diff_threshold, default_template_cache_mb, default_preview_cache_mb, default_metadata_cache_ttl, default_metadata_cache_entries, default_preview_max_side, default_preview_format, default_preview_quality, default_output_format, default_lossy_format, default_output_quality, default_output_min_quality, default_output_max_kb, default_max_upload_pixels, default_session_idle_seconds, default_session_memory_mb, default_session_store, default_session_store_file, default_render_executor, default_render_workers, default_render_queue_size, default_render_timeout
+from functions.database_functions import close_connection_pool
+from functions.async_database_functions import execute as async_execute, execute_many as async_execute_many, close_database_backend
+from functions.image_functions import hex_to_bgr, show_fields as show_fields_image, find_changed_rectangle, find_all_rectangles, read_image, decode_upload, EncodedImage, encode_image, encode_for_upload, downscale_image, scale_bounds
+from functions.executor_functions import setup_render_executor, shutdown_render_executor, run_render_job
+from functions.cache_functions import LRUCache, format_cache_stats
+from functions.session_functions import SessionManager, TimerWheel, format_session_manager_stats
+from functions.session_store import MemorySessionStore, open_session_store, serialize_session, deserialize_session
+from functions.render_functions import LayeredImage, rasterize_field, fields_to_render, invalidate_field, session_nbytes, release_layers, render_layered_image
+from functions.text_functions import fit_font_scale
+from functions.template_repository import TemplateRepository, template_query, user_templates_query, find_field, fields_signature
+from functions.utils import get_setting
 from functions.ReturnInfo import ReturnInfo
 
-needed_data = ['client', 'db_cursor', 'db_handle', 'logging_ref']
+needed_data = ['client', 'logging_ref']
 
-using_template = {}
+# Templates in use by user id. Images of sessions used least recently are released when they take more than session_memory_mb together
+using_template = SessionManager(
+    max_bytes=default_session_memory_mb * 1024 * 1024,
+    size_function=lambda data: sum(session_nbytes(data['layers'], data['fields'])),
+    release_function=lambda data: release_session(data)
+)
+# Expiry and idle timers of templates in use, keyed by ('expire' or 'idle', user id, generation of the session)
+# Every session gets a new generation, so a timer of a session that ended can never act on a later session of the same user
+# Generations start from the time the bot started, so they stay unique for sessions stored by earlier runs
+session_timers = TimerWheel()
+session_generations = count(int(time() * 1000))
+# Templates in use are saved there whenever they change and resumed from there when their users come back after a restart
+session_store = MemorySessionStore()
+
+# Templates and their fields by (user id, template number). Has to be invalidated by every command changing them
+templates = TemplateRepository(ttl=default_metadata_cache_ttl, max_entries=default_metadata_cache_entries)
 
 possible_fonts = {
     'Simple': FONT_HERSHEY_SIMPLEX
 }
+text_thickness = 2
+
+# Decoded template images keyed by (filename, modification time). Cached arrays are read-only and shared between all interactions
+template_cache = LRUCache(max_bytes=default_template_cache_mb * 1024 * 1024, size_function=lambda image: image.nbytes)
+
+# Encoded /view show_fields previews and their filenames keyed by (template id, signature of the fields, color)
+preview_cache = LRUCache(max_bytes=default_preview_cache_mb * 1024 * 1024, size_function=lambda entry: len(entry[0]))
+# Totals of decoded uploads, logged when the bot is turned off
+ingest_stats = {'uploads': 0, 'bytes': 0, 'seconds': 0., 'reduced': 0, 'rejected': 0}
 
 async def error_with_mysql_query(context: discord.Interaction, query: str, error_message: str, use_followup: bool = False):
     log_output('Error while processing a mysql query: \n\t{}\n{}'.format(query, error_message), logging.ERROR)
@@ -31,19 +65,219 @@ async def error_with_mysql_query(context: discord.Interaction, query: str, error
     await method('Sorry, something went wrong. Try again later', ephemeral=True)
 
 def setup_commands(data: dict[str, any]) -> bool:
-    global client, db_cursor, db_handle, log_output
+    global client, log_output, session_store
     for key in needed_data:
         if key not in data.keys():
             return False
     client = data['client']
-    db_cursor = data['db_cursor']
-    db_handle = data['db_handle']
     log_output = data['logging_ref']
+    template_cache.resize(max_bytes=get_setting('template_cache_mb', int, default_template_cache_mb) * 1024 * 1024)
+    preview_cache.resize(max_bytes=get_setting('preview_cache_mb', int, default_preview_cache_mb) * 1024 * 1024)
+    using_template.resize(get_setting('session_memory_mb', int, default_session_memory_mb) * 1024 * 1024)
+    templates.configure(
+        get_setting('metadata_cache', bool, True),
+        get_setting('metadata_cache_ttl', float, default_metadata_cache_ttl),
+        get_setting('metadata_cache_entries', int, default_metadata_cache_entries)
+    )
+    result = setup_render_executor(
+        get_setting('render_executor', str, default_render_executor),
+        get_setting('render_workers', int, default_render_workers),
+        get_setting('render_queue_size', int, default_render_queue_size),
+        get_setting('render_timeout', float, default_render_timeout),
+        log_output
+    )
+    if not result:
+        log_output(result, logging.ERROR)
+        return False
+    result = open_session_store(get_setting('session_store', str, default_session_store), path.join(absolute_path_to_project, get_setting('session_store_file', str, default_session_store_file)), time())
+    if not result:
+        log_output(result, logging.ERROR)
+        return False
+    session_store = result.returnValue
     return True
 
-def reconnect_database(database_connection: MySQLConnection, database_cursor: MySQLCursor):
-    global db_handle, db_cursor
-    db_handle, db_cursor = database_connection, database_cursor
+async def load_template_image(filename: str) -> ndarray | None:
+    filepath = path.join(absolute_path_to_project, 'Images', filename)
+    try:
+        key = (filename, path.getmtime(filepath))
+    except OSError:
+        return None
+    image = template_cache.get(key)
+    if image is None:
+        result = await run_render_job(read_image, filepath)
+        if not result:
+            log_output(result, logging.ERROR)
+            return None
+        image = result.returnValue
+        image.flags.writeable = False
+        # Drop entries for an older version of the same file
+        invalidate_template_image(filename)
+        template_cache.put(key, image)
+    return image
+
+def invalidate_template_image(filename: str):
+    template_cache.invalidate(lambda key: key[0] == filename)
+
+def get_template_cache_stats() -> dict[str, int | float]:
+    return template_cache.stats()
+
+# Downscaled template used for previews, cached next to the template. None if the template can't be read
+async def load_template_preview(filename: str) -> ndarray | None:
+    image = await load_template_image(filename)
+    if image is None:
+        return None
+    max_side = get_setting('preview_max_side', int, default_preview_max_side)
+    try:
+        key = (filename, path.getmtime(path.join(absolute_path_to_project, 'Images', filename)), max_side)
+    except OSError:
+        return None
+    preview = template_cache.get(key)
+    if preview is None:
+        result = await run_render_job(downscale_image, image, max_side)
+        if not result:
+            log_output(result, logging.ERROR)
+            return None
+        preview = result.returnValue
+        # Templates already small enough are their own previews and are cached once
+        if not preview is image:
+            preview.flags.writeable = False
+            template_cache.put(key, preview)
+    return preview
+
+# Previews are sent in the preview format whatever the format of the template is
+def preview_filename(filename: str) -> str:
+    return '{}.{}'.format(filename.rsplit('.', 1)[0], get_setting('preview_format', str, default_preview_format))
+
+async def encode_preview(image: ndarray) -> ReturnInfo:
+    return await run_render_job(encode_image, image, get_setting('preview_format', str, default_preview_format), get_setting('preview_quality', int, default_preview_quality))
+
+# Reads an attachment and decodes it from the received bytes on the render executor, see decode_upload
+# Code 2 means the upload is over max_upload_pixels and couldn't be reduced, code 3 that its size can't be read to check it
+# returnValue is (decoded image, the upload as EncodedImage decoding again to the same image)
+async def ingest_attachment(attachment: discord.Attachment, allow_reduced: bool, min_size: tuple[int, int] | None = None) -> ReturnInfo:
+    start = perf_counter()
+    buffer = await attachment.read()
+    result = await run_render_job(decode_upload, buffer, get_setting('max_upload_pixels', int, default_max_upload_pixels), allow_reduced, min_size)
+    seconds = perf_counter() - start
+    ingest_stats['uploads'] += 1
+    ingest_stats['bytes'] += len(buffer)
+    ingest_stats['seconds'] += seconds
+    if result.returnCode in [2, 3]:
+        ingest_stats['rejected'] += 1
+    if not result:
+        log_output('Upload \"{}\" ({:.1f} KB) not decoded in {:.1f} ms: {}'.format(attachment.filename, len(buffer) / 1024, seconds * 1000, result))
+        return result
+    image, factor = result.returnValue
+    if factor > 1:
+        ingest_stats['reduced'] += 1
+    log_output('Upload \"{}\" ({:.1f} KB) decoded to {}x{} (1/{} size) in {:.1f} ms'.format(attachment.filename, len(buffer) / 1024, image.shape[1], image.shape[0], factor, seconds * 1000))
+    result.returnValue = (image, EncodedImage(buffer, factor))
+    return result
+
+def format_ingest_stats() -> str:
+    return 'Uploads: {} decoded, {:.1f} MB in {:.1f} s, {} reduced, {} rejected'.format(ingest_stats['uploads'], ingest_stats['bytes'] / 1024 / 1024, ingest_stats['seconds'], ingest_stats['reduced'], ingest_stats['rejected'])
+
+# Encodes an image to be sent in full, in the format and within the size set in settings. Logs what came out and how long it took
+# returnValue is the dict from encode_for_upload, with 'filename' added: filename with the extension of the chosen format
+async def encode_output(image: ndarray, filename: str) -> ReturnInfo:
+    name, extension = filename.rsplit('.', 1)
+    result = await run_render_job(
+        encode_for_upload,
+        image,
+        extension,
+        get_setting('output_format', str, default_output_format),
+        get_setting('output_quality', int, default_output_quality),
+        get_setting('output_max_kb', int, default_output_max_kb) * 1024,
+        get_setting('output_min_quality', int, default_output_min_quality),
+        get_setting('lossy_format', str, default_lossy_format)
+    )
+    if not result:
+        return result
+    encoded = result.returnValue
+    encoded['filename'] = '{}.{}'.format(name, encoded['extension'])
+    log_output('Encoded {}x{} image from \"{}\" as {} (quality {}, 1/{} size): {:.1f} KB in {:.1f} ms'.format(image.shape[1], image.shape[0], filename, encoded['extension'], encoded['quality'], encoded['factor'], len(encoded['data']) / 1024, encoded['seconds'] * 1000))
+    return result
+
+# Resizes a field's value into its layer in the background as soon as the field is filled, so updates only composite it
+# decoded is the already decoded image of an EncodedImage value, so it isn't decoded twice
+# The job belongs to the value it was started for (the object itself). Its result is dropped if the value was replaced since
+# or the session was released meanwhile, its layers are all made again when it's restored
+def start_layer_job(layers: LayeredImage, field: dict[str, Any], decoded: ndarray | None = None):
+    value = field['value']
+    async def layer_job() -> ReturnInfo:
+        result = await run_render_job(rasterize_field, field['type'], field['bounds'], value if decoded is None else decoded, layers.shape, text_thickness, LINE_8)
+        if result and field['value'] is value and field['layer'] is None and not layers.is_released():
+            field['layer'] = result.returnValue
+        return result
+    field['layer_job'] = (value, asyncio.create_task(layer_job()))
+
+# Marks the template in use as used now. Once it's been idle for session_idle_seconds its image and field layers are released
+# and only field values (uploads still compressed) are kept until it's used again
+def touch_session(user_id: int):
+    data = using_template.get(user_id)
+    if data is None:
+        return
+    data['last_used'] = monotonic()
+    using_template.touch(user_id)
+    idle_seconds = get_setting('session_idle_seconds', float, default_session_idle_seconds)
+    if idle_seconds > 0:
+        session_timers.schedule(('idle', user_id, data['generation']), idle_seconds, release_idle_session, user_id, data['generation'])
+
+def release_idle_session(user_id: int, generation: int):
+    data = using_template.get(user_id)
+    if data is None or data['generation'] != generation or data['layers'].is_released():
+        return
+    released_bytes = release_session(data)
+    if released_bytes == 0:
+        return
+    log_output('Released template in use by user {} after {:.0f} s idle: {:.1f} MB freed, {}'.format(user_id, monotonic() - data['last_used'], released_bytes / 1024 / 1024, format_session_memory(data)))
+
+# Drops a session's image and field layers, which are rebuilt from the template file and field values when it's used again
+# A session being rendered is left as it is. Returns the number of bytes released
+def release_session(data: dict[str, Any]) -> int:
+    if data['render_lock'].locked():
+        return 0
+    return release_layers(data['layers'], data['fields'])
+
+# Bytes a new session of the template takes before any field is filled: its copy of the template and of the preview
+def template_session_nbytes(original_template: ndarray, preview_template: ndarray) -> int:
+    return original_template.nbytes + (0 if preview_template is original_template else preview_template.nbytes)
+
+# Attaches the template again to a session released while idle or under memory pressure, releasing other sessions to make room for it
+# A session already in use is never refused, so it's attached even if that goes over the budget
+# False if the template can't be read or isn't the same size anymore
+async def restore_session(user_id: int) -> bool:
+    data = using_template[user_id]
+    layers = data['layers']
+    if not layers.is_released():
+        return True
+    original_template = await load_template_image(data['filename'])
+    preview_template = await load_template_preview(data['filename'])
+    if original_template is None or preview_template is None or original_template.shape != layers.shape:
+        return False
+    if not using_template.make_room(template_session_nbytes(original_template, preview_template), user_id):
+        log_output('Restoring template in use by user {} goes over the session memory budget. {}'.format(user_id, format_session_manager_stats(using_template.stats())), logging.WARNING)
+    # The session could have been restored by another update while the template was loaded
+    if layers.is_released():
+        layers.attach(original_template, None if preview_template is original_template else preview_template)
+    return True
+
+def format_session_memory(data: dict[str, Any]) -> str:
+    working_bytes, value_bytes = session_nbytes(data['layers'], data['fields'])
+    return '{:.1f} MB of image and layers, {:.1f} KB of field values'.format(working_bytes / 1024 / 1024, value_bytes / 1024)
+
+def format_session_stats() -> str:
+    working_bytes = value_bytes = released = 0
+    for data in using_template.values():
+        session_working, session_values = session_nbytes(data['layers'], data['fields'])
+        working_bytes += session_working
+        value_bytes += session_values
+        released += data['layers'].is_released()
+    return 'Templates in use: {} ({} released), {:.1f} MB of images and layers, {:.1f} MB of field values'.format(len(using_template), released, working_bytes / 1024 / 1024, value_bytes / 1024 / 1024)
+
+# Has to be called whenever fields of a template change or the template itself is replaced
+def invalidate_template_preview(template_id: int):
+    preview_cache.invalidate(lambda key: key[0] == template_id)
 
 async def followup_and_delete(context: discord.Interaction, message: str, delay: int = 10):
     await context.followup.send(message)
@@ -58,8 +292,10 @@ async def register_template(user_id: int | str, template_number: int, file: disc
     filename = str(user_id) + '_' + str(template_number) + '.' + extension
     try:
         await file.save(path.join(absolute_path_to_project, 'Images', filename))
-        query = 'INSERT INTO images (image_extension, user_id, enumeration, created_at) VALUES (\"{}\", \"{}\", {}, NOW())'.format(extension, user_id, template_number)
-        result = execute_query(db_handle, db_cursor, query)
+        invalidate_template_image(filename)
+        query = 'INSERT INTO images (image_extension, user_id, enumeration, created_at) VALUES (%s, %s, %s, NOW())'
+        result = await async_execute(query, (extension, str(user_id), template_number))
+        templates.invalidate(user_id, template_number)
         if not result:
             return result
     except discord.HTTPException:
@@ -67,22 +303,23 @@ async def register_template(user_id: int | str, template_number: int, file: disc
         return ret
     return ret
 
-def delete_template(user_id: int | str, template_number: int, filename: str | None = None) -> ReturnInfo:
+async def delete_template(user_id: int | str, template_number: int, filename: str | None = None) -> ReturnInfo:
     if filename is None:
-        query = 'SELECT CONCAT(im.user_id, "_", im.enumeration, ".", im.image_extension) FROM images AS im WHERE im.user_id=\"{}\" AND im.enumeration={}'.format(user_id, template_number)
-        result = mysql_select(db_cursor, query)
+        result = await templates.get_template(user_id, template_number)
         if not result:
             return result
-        filename = result.returnValue[0]
+        filename = result.returnValue['filename']
     else:
         filename = path.basename(filename)
     ret = ReturnInfo(Messages={
         1: 'File \"{}\" not found'.format(filename)
     })
-    query = 'DELETE FROM images AS im WHERE im.user_id=\"{}\" AND im.enumeration={}'.format(user_id, template_number)
-    result = execute_query(db_handle, db_cursor, query)
+    query = 'DELETE FROM images AS im WHERE im.user_id=%s AND im.enumeration=%s'
+    result = await async_execute(query, (str(user_id), template_number))
+    templates.invalidate(user_id, template_number)
     if not result:
         return result
+    invalidate_template_image(filename)
     try:
         remove_file(path.join(absolute_path_to_project, 'Images', filename))
     except FileNotFoundError:
@@ -91,30 +328,44 @@ def delete_template(user_id: int | str, template_number: int, filename: str | No
 
 async def turn_off_command_prototype(context: discord.Interaction):
     await context.response.send_message('Turning off bot...')
+    # Shutting down waits for running renders, on a thread of its own so the event loop (and the gateway heartbeat) keeps running meanwhile
+    await asyncio.to_thread(shutdown_render_executor)
+    session_timers.stop()
+    await asyncio.to_thread(session_store.close)
+    await asyncio.to_thread(close_database_backend)
+    close_connection_pool()
+    log_output(format_cache_stats('Template', get_template_cache_stats()))
+    log_output(format_cache_stats('Preview', preview_cache.stats()))
+    log_output(format_cache_stats('Metadata', templates.stats()))
+    log_output(format_ingest_stats())
+    log_output(format_session_stats())
+    log_output(format_session_manager_stats(using_template.stats()))
     await client.close()
 
 async def create_template_command_prototype(context: discord.Interaction, template: discord.Attachment, template_number: int):
+    await context.response.defer(thinking=True)
     if template_number < 1 or template_number > 3:
-        await context.response.send_message('Incorrect template number. Should be between 1 and 3')
+        await followup_and_delete(context, 'Incorrect template number. Should be between 1 and 3')
+        return
     if type(template.content_type) != str or not template.content_type.startswith('image/'):
-        await context.response.send_message('Unable to read attachment as image', ephemeral=True)
+        await followup_and_delete(context, 'Unable to read attachment as image')
         return
-    query = 'SELECT filename FROM images AS im WHERE im.user_id=\"{}\" AND im.enumeration={}'.format(context.user.id, template_number)
-    result = mysql_select(db_cursor, query)
-    result.okCodes.append(1)
+    result = await templates.get_template(context.user.id, template_number)
+    # Code 1 means there's no template with this number yet
     empty_query = result.returnCode == 1
-    if not result:
-        await error_with_mysql_query(context, query, str(result))
+    if not result and not empty_query:
+        await error_with_mysql_query(context, template_query, str(result), True)
         return
     if empty_query:
         result = await register_template(context.user.id, template_number, template)
         if result:
-            await context.response.send_message('Template successfully registered', ephemeral=True)
+            await followup_and_delete(context, 'Template successfully registered')
         else:
             log_output('Error: Failed to register a template. user_id={} template_number={}\n{}'.format(context.user.id, template_number, result))
-            await context.response.send_message('Sorry, something went wrong. Template not registered', ephemeral=True)
+            await followup_and_delete(context, 'Sorry, something went wrong. Template not registered')
     else:
-        filename = result.returnValue[0]
+        filename = result.returnValue['filename']
+        old_template_id = result.returnValue['id']
         embed = discord.Embed(
             title = 'Template already exists',
             description = 'Template with existing number already exists for user {}\nWould you like to replace that template with a new one? (This will delete all fields attached to it)'.format(context.user.display_name),
@@ -128,7 +379,8 @@ async def create_template_command_prototype(context: discord.Interaction, templa
             if interaction.user != context.user:
                 await interaction.response.send_message('This command was not run by you and you cannot respond to it', ephemeral=True)
                 return
-            result = delete_template(context.user.id, template_number, filename)
+            result = await delete_template(context.user.id, template_number, filename)
+            invalidate_template_preview(old_template_id)
             if not result:
                 log_output('Error trying to delete from table images. user_id={}, template_number={}\n{}'.format(context.user.id, template_number, result))
                 asyncio.gather(
@@ -158,7 +410,7 @@ async def create_template_command_prototype(context: discord.Interaction, templa
         buttons = discord.ui.View()
         buttons.add_item(replace_button)
         buttons.add_item(cancel_button)
-        await context.response.send_message(embed=embed, view=buttons, file=attachment)
+        await context.followup.send(embed=embed, view=buttons, file=attachment)
 
 async def view_command_prototype(context: discord.Interaction, template_number: int = 0, show_fields: bool = False):
     await context.response.defer(ephemeral=True, thinking=True)
@@ -171,18 +423,17 @@ async def view_all_templates(context: discord.Interaction):
         title = '{}\'s templates'.format(context.user.display_name),
         color = embed_default_color
     )
-    query = 'SELECT image_extension, created_at, enumeration FROM images WHERE user_id=\"{}\"'.format(context.user.id)
-    result = mysql_select(db_cursor, query, True, True)
+    result = await templates.get_user_templates(context.user.id)
     if not result:
-        await error_with_mysql_query(context, query, str(result), True)
+        await error_with_mysql_query(context, user_templates_query, str(result), True)
         return
     entries = result.returnValue
-    templates = ['No registered template'] * 3
+    template_descriptions = ['No registered template'] * 3
     for entry in entries:
-        templates[entry[2] - 1] = '{} image. Created at: {}'.format(entry[0], entry[1])
+        template_descriptions[entry['enumeration'] - 1] = '{} image. Created at: {}'.format(entry['extension'], entry['created_at'])
     desc = ''
-    for i in range(len(templates)):
-        desc += str(i + 1) + ': ' + templates[i] + '\n'
+    for i in range(len(template_descriptions)):
+        desc += str(i + 1) + ': ' + template_descriptions[i] + '\n'
     desc += 'To view a chosen template use /view number_of_template'
     embed.description = desc
     await context.followup.send(embed=embed, ephemeral=True)
@@ -192,54 +443,62 @@ async def view_one_template(context: discord.Interaction, template_number: int,
         title='{}\'s template no. {}'.format(context.user.display_name, template_number),
         color = embed_default_color
     )
-    query = 'SELECT filename, image_extension, created_at, id FROM images WHERE user_id=\"{}\" AND enumeration={}'.format(context.user.id, template_number)
-    result = mysql_select(db_cursor, query)
+    result = await templates.get_template(context.user.id, template_number)
     if not result:
         if result.returnCode == 1:
             await context.followup.send('Sorry, looks like you don\'t have a template with a given number. Try using the command with no template_number to show you all the templates you have registered', ephemeral=True)
             return
         else:
-            await error_with_mysql_query(context, query, str(result), True)
+            await error_with_mysql_query(context, template_query, str(result), True)
             return
-    filename = result.returnValue[0]
+    template = result.returnValue
+    filename = template['filename']
     if show_fields:
-        query = 'SELECT field_name, type, up_bound, left_bound, down_bound, right_bound FROM editable_fields WHERE image_id={}'.format(result.returnValue[3])
-        result = mysql_select(db_cursor, query, True, True)
-        if not result:
-            await error_with_mysql_query(context, query, str(result), True)
-            return
+        template_id = template['id']
         desc = ''
         counter = 0
         field_coords = []
         field_names = []
-        for field in result.returnValue:
+        for field in template['fields']:
             counter += 1
-            desc += str(counter) + ': ' + field[0] + '(' + field[1] + ')\n'
-            field_coords.append((field[2], field[3], field[4], field[5]))
-            field_names.append(field[0])
+            desc += str(counter) + ': ' + field['name'] + '(' + field['type'] + ')\n'
+            field_coords.append(field['bounds'])
+            field_names.append(field['name'])
         if desc:
             # delete the last newline
             desc = desc[:-1]
         else:
             desc = 'No registered fields'
+        # The key comes from the fields just loaded, so fields changed outside the bot never get an old preview
+        # A repeated view of an unchanged template is then served without drawing or encoding
+        fields_hash = fields_signature(template)
+        encoded_preview = preview_cache.get((template_id, fields_hash, default_color_hex))
+        if encoded_preview is None:
+            result = hex_to_bgr(default_color_hex)
+            bgr_color = result.returnValue
+            original_image = await load_template_image(filename)
+            if original_image is None:
+                log_output('Error while reading template file: {}'.format(filename), logging.ERROR)
+                await context.followup.send('Sorry, something went wrong. Try again later')
+                return
+            result = await run_render_job(show_fields_image, original_image, field_coords, field_names, bgr_color)
+            if not result:
+                log_output('Error while generating a template with fields for file: {}\n{}'.format(filename, result), logging.ERROR)
+                await context.followup.send('Sorry, something went wrong. Try again later')
+                return
+            fields_image = result.returnValue
+            result = await encode_output(fields_image, filename)
+            if not result:
+                log_output('Error while converting file \"{}\" with fields to bytes\n{}'.format(filename, result), logging.ERROR)
+                await context.followup.send('Sorry, something went wrong. Try again later')
+                return
+            encoded_preview = (result.returnValue['data'], result.returnValue['filename'])
+            preview_cache.put((template_id, fields_hash, default_color_hex), encoded_preview)
         embed.description = desc
-        result = hex_to_bgr(default_color_hex)
-        bgr_color = result.returnValue
-        original_image = imread(path.join(absolute_path_to_project, 'Images', filename))
-        result = show_fields_image(original_image, field_coords, field_names, bgr_color)
-        if not result:
-            log_output('Error while generating a template with fields for file: {}'.format(filename), logging.ERROR)
-            await context.followup.send('Sorry, something went wrong. Try again later')
-            return
-        fields_image = result.returnValue
-        success, buff = imencode('.' + filename.split('.')[-1], fields_image)
-        if not success:
-            log_output('Error while converting file \"{}\" with fields to bytes'.format(filename), logging.ERROR)
-            await context.followup.send('Sorry, something went wrong. Try again later')
-            return
-        filepath = BytesIO(buff.tobytes())
+        filepath = BytesIO(encoded_preview[0])
+        filename = encoded_preview[1]
     else:
-        embed.description = '{} file\n Created at: {}\nTo show registered fields, use this command with show_fields=true'.format(result.returnValue[1], result.returnValue[2])
+        embed.description = '{} file\n Created at: {}\nTo show registered fields, use this command with show_fields=true'.format(template['extension'], template['created_at'])
         filepath = path.join(absolute_path_to_project, 'Images', filename)
     embed.set_image(url='attachment://{}'.format(filename))
     attachment = discord.File(filepath, filename=filename)
@@ -255,69 +514,78 @@ async def add_field_command_prototype(context: discord.Interaction, field_type:
         return
     if use_bounds:
         use_image = False
-    query = 'SELECT id, filename FROM images WHERE user_id=\"{}\" AND enumeration={}'.format(context.user.id, template_number)
-    result = mysql_select(db_cursor, query)
+    result = await templates.get_template(context.user.id, template_number)
     if not result:
         if result.returnCode == 1:
             await followup_and_delete(context, 'No template with a given number for user {} exists. Please create a template with /create_template command'.format(context.user.display_name))
             return
-        await error_with_mysql_query(context, query, str(result), True)
+        await error_with_mysql_query(context, template_query, str(result), True)
         return
-    template_id, filename = result.returnValue
+    template_id = result.returnValue['id']
+    filename = result.returnValue['filename']
     filepath = path.join(absolute_path_to_project, 'Images', filename)
-    query = f'SELECT 1 FROM editable_fields WHERE field_name=\"{name}\" AND image_id={template_id}'
-    result = mysql_select(db_cursor, query)
-    result.okCodes.append(1)
-    if result.returnCode == 0:
+    if not find_field(result.returnValue, name) is None:
         await followup_and_delete(context, 'A field with that name already exists for this template')
         return
-    if not result:
-        await error_with_mysql_query(context, query, str(result), True)
-        return
     result = hex_to_bgr(color)
     if not result:
         await followup_and_delete(context, result)
         return
     bgr_color = result.returnValue
+    original_image = await load_template_image(filename)
+    if original_image is None:
+        log_output('Error while reading template file: {}'.format(filename), logging.ERROR)
+        await followup_and_delete(context, 'Sorry, something went wrong. Try again later')
+        return
     if use_image:
-        reference_bytes = asarray(bytearray(await reference_image.read()), dtype=uint8)
-        template_image = imdecode(reference_bytes, IMREAD_COLOR)
-        result = find_biggest_rectangle(template_image, bgr_color, default_hue_range, default_saturation_range, default_value_range)
+        # Found bounds have to be in the template's pixels, so a reference is never decoded reduced
+        result = await ingest_attachment(reference_image, False)
+        if not result:
+            await followup_and_delete(context, str(result) if result.returnCode in [2, 3] else 'Unable to read the reference image')
+            return
+        template_image = result.returnValue[0]
+        result = await run_render_job(find_changed_rectangle, original_image, template_image, bgr_color, default_hue_range, default_saturation_range, default_value_range, get_setting('diff_threshold', int, default_diff_threshold))
         if not result:
             await followup_and_delete(context, 'Unable to find a specified color ({}) in a chosen template'.format(color))
             return
         bounds = result.returnValue
-    original_image = imread(path.join(absolute_path_to_project, 'Images', filename))
-    result = show_fields_image(original_image, [bounds], [name], bgr_color)
+    preview_image = await load_template_preview(filename)
+    if preview_image is None:
+        log_output('Error while reading template file: {}'.format(filename), logging.ERROR)
+        await followup_and_delete(context, 'Sorry, something went wrong. Try again later')
+        return
+    result = await run_render_job(show_fields_image, preview_image, [scale_bounds(bounds, original_image.shape, preview_image.shape)], [name], bgr_color)
     if not result:
         log_output('Error while trying to create a template with fields: {}'.format(result), logging.ERROR)
         await followup_and_delete(context, 'Sorry, something went wrong. Try again later')
         return
     fields_image = result.returnValue
-    success, buffer = imencode('.' + filename.split('.')[-1], fields_image)
-    if not success:
-        log_output('Error while converting file \"{}\" with fields to bytes'.format(filename), logging.ERROR)
+    result = await encode_preview(fields_image)
+    if not result:
+        log_output('Error while converting file \"{}\" with fields to bytes\n{}'.format(filename, result), logging.ERROR)
         await context.followup.send('Sorry, something went wrong. Try again later')
         return
-    filepath = BytesIO(buffer.tobytes())
-    attachment = discord.File(filepath, filename=filename)
+    filepath = BytesIO(result.returnValue)
+    attachment = discord.File(filepath, filename=preview_filename(filename))
     embed = discord.Embed(
         title = 'Adding field',
         color = embed_default_color,
         description = 'Here\'s a preview of a new field. To confirm click on a corresponding button'
     )
-    embed.set_image(url='attachment://{}'.format(filename))
+    embed.set_image(url='attachment://{}'.format(preview_filename(filename)))
     confirm_button = discord.ui.Button(label='Confirm', style=discord.ButtonStyle.primary, emoji='✅')
     cancel_button = discord.ui.Button(label='Cancel', style=discord.ButtonStyle.primary, emoji='❌')
     async def confirm_action(interaction: discord.Interaction):
         if interaction.user != context.user:
             await interaction.response.send_message('This command was not run by you and you cannot respond to it', ephemeral=True)
             return
-        query = 'INSERT INTO editable_fields (field_name, type, up_bound, left_bound, down_bound, right_bound, image_id) VALUES (\"{}\", \"{}\", {}, {}, {}, {}, {})'.format(name, field_type.value, bounds[0], bounds[1], bounds[2], bounds[3], template_id)
-        result = execute_query(db_handle, db_cursor, query)
+        query = 'INSERT INTO editable_fields (field_name, type, up_bound, left_bound, down_bound, right_bound, image_id) VALUES (%s, %s, %s, %s, %s, %s, %s)'
+        result = await async_execute(query, (name, field_type.value, bounds[0], bounds[1], bounds[2], bounds[3], template_id))
+        templates.invalidate(context.user.id, template_number)
         if not result:
             await error_with_mysql_query(context, query, str(result), True)
             return
+        invalidate_template_preview(template_id)
         asyncio.gather(
             interaction.message.delete(),
             interaction.response.send_message('Field successfully added', ephemeral=True)
@@ -334,26 +602,228 @@ async def add_field_command_prototype(context: discord.Interaction, field_type:
     buttons.add_item(cancel_button)
     await context.followup.send(embed=embed, view=buttons, file=attachment)
 
-async def remove_field_command_prototype(context: discord.Interaction, template_number: int, field_name: str):
-    query = 'SELECT f.id FROM editable_fields AS f JOIN images AS i WHERE i.enumeration={} AND i.user_id=\"{}\" AND LOWER(f.field_name)=\"{}\"'.format(template_number, context.user.id, field_name.lower())
-    result = mysql_select(db_cursor, query)
-    if result.returnCode == 1:
-        await context.response.send_message('No field with name \"{}\" found for template number {}\nUse /view to check your templates and fields'.format(field_name, template_number), ephemeral=True)
+# Adds a field for every region marked on the reference image. names and colors are comma separated lists
+# Regions are matched with names in order of colors, then from top to bottom and from left to right
+async def add_fields_command_prototype(context: discord.Interaction, field_type: discord.app_commands.Choice[str], names: str, template_number: int, reference_image: discord.Attachment, colors: str = default_color_hex):
+    await context.response.defer(thinking=True)
+    field_names = [name.strip() for name in names.split(',') if name.strip()]
+    if len(field_names) == 0:
+        await followup_and_delete(context, 'Please give names for the fields separated with commas')
         return
+    if len(set(name.lower() for name in field_names)) != len(field_names):
+        await followup_and_delete(context, 'Every field needs a different name')
+        return
+    bgr_colors = []
+    for color in colors.split(','):
+        result = hex_to_bgr(color.strip())
+        if not result:
+            await followup_and_delete(context, result)
+            return
+        bgr_colors.append(result.returnValue)
+    result = await templates.get_template(context.user.id, template_number)
     if not result:
-        await error_with_mysql_query(context, query, str(result))
+        if result.returnCode == 1:
+            await followup_and_delete(context, 'No template with a given number for user {} exists. Please create a template with /create_template command'.format(context.user.display_name))
+            return
+        await error_with_mysql_query(context, template_query, str(result), True)
+        return
+    template_id = result.returnValue['id']
+    filename = result.returnValue['filename']
+    existing_names = [name for name in field_names if not find_field(result.returnValue, name) is None]
+    if len(existing_names) > 0:
+        await followup_and_delete(context, 'Fields with these names already exist for this template: {}'.format(', '.join(existing_names)))
+        return
+    original_image = await load_template_image(filename)
+    if original_image is None:
+        log_output('Error while reading template file: {}'.format(filename), logging.ERROR)
+        await followup_and_delete(context, 'Sorry, something went wrong. Try again later')
+        return
+    result = await ingest_attachment(reference_image, False)
+    if not result:
+        await followup_and_delete(context, str(result) if result.returnCode in [2, 3] else 'Unable to read the reference image')
         return
-    query = 'DELETE FROM editable_fields WHERE id={}'.format(result.returnValue[0])
-    result = execute_query(db_handle, db_cursor, query)
+    result = await run_render_job(find_all_rectangles, result.returnValue[0], bgr_colors, default_hue_range, default_saturation_range, default_value_range, default_min_field_area, original_image, get_setting('diff_threshold', int, default_diff_threshold))
+    if not result:
+        await followup_and_delete(context, 'Unable to find any of the specified colors ({}) in a chosen template'.format(colors))
+        return
+    field_bounds = [bounds for _, bounds in result.returnValue]
+    if len(field_bounds) != len(field_names):
+        await followup_and_delete(context, 'Found {} marked regions but {} names were given'.format(len(field_bounds), len(field_names)))
+        return
+    preview_image = await load_template_preview(filename)
+    if preview_image is None:
+        log_output('Error while reading template file: {}'.format(filename), logging.ERROR)
+        await followup_and_delete(context, 'Sorry, something went wrong. Try again later')
+        return
+    preview_bounds = [scale_bounds(bounds, original_image.shape, preview_image.shape) for bounds in field_bounds]
+    result = await run_render_job(show_fields_image, preview_image, preview_bounds, field_names, bgr_colors[0])
+    if not result:
+        log_output('Error while trying to create a template with fields: {}'.format(result), logging.ERROR)
+        await followup_and_delete(context, 'Sorry, something went wrong. Try again later')
+        return
+    result = await encode_preview(result.returnValue)
+    if not result:
+        log_output('Error while converting file \"{}\" with fields to bytes\n{}'.format(filename, result), logging.ERROR)
+        await context.followup.send('Sorry, something went wrong. Try again later')
+        return
+    attachment = discord.File(BytesIO(result.returnValue), filename=preview_filename(filename))
+    embed = discord.Embed(
+        title = 'Adding fields',
+        color = embed_default_color,
+        description = 'Here\'s a preview of {} new {} fields:\n{}\nTo confirm click on a corresponding button'.format(len(field_names), field_type.value, '\n'.join('{}: {}'.format(name, bounds) for name, bounds in zip(field_names, field_bounds)))
+    )
+    embed.set_image(url='attachment://{}'.format(preview_filename(filename)))
+    confirm_button = discord.ui.Button(label='Confirm', style=discord.ButtonStyle.primary, emoji='✅')
+    cancel_button = discord.ui.Button(label='Cancel', style=discord.ButtonStyle.primary, emoji='❌')
+    async def confirm_action(interaction: discord.Interaction):
+        if interaction.user != context.user:
+            await interaction.response.send_message('This command was not run by you and you cannot respond to it', ephemeral=True)
+            return
+        query = 'INSERT INTO editable_fields (field_name, type, up_bound, left_bound, down_bound, right_bound, image_id) VALUES (%s, %s, %s, %s, %s, %s, %s)'
+        result = await async_execute_many(query, [(name, field_type.value, *bounds, template_id) for name, bounds in zip(field_names, field_bounds)])
+        templates.invalidate(context.user.id, template_number)
+        if not result:
+            await error_with_mysql_query(context, query, str(result), True)
+            return
+        invalidate_template_preview(template_id)
+        asyncio.gather(
+            interaction.message.delete(),
+            interaction.response.send_message('{} fields successfully added'.format(len(field_names)), ephemeral=True)
+        )
+    async def cancel_action(interaction: discord.Interaction):
+        if interaction.user != context.user:
+            await interaction.response.send_message('This command was not run by you and you cannot respond to it', ephemeral=True)
+            return
+        await interaction.message.delete()
+    confirm_button.callback = confirm_action
+    cancel_button.callback = cancel_action
+    buttons = discord.ui.View()
+    buttons.add_item(confirm_button)
+    buttons.add_item(cancel_button)
+    await context.followup.send(embed=embed, view=buttons, file=attachment)
+
+async def remove_field_command_prototype(context: discord.Interaction, template_number: int, field_name: str):
+    result = await templates.get_template(context.user.id, template_number)
+    if not result and result.returnCode != 1:
+        await error_with_mysql_query(context, template_query, str(result))
+        return
+    field = None if result.returnCode == 1 else find_field(result.returnValue, field_name)
+    if field is None:
+        await context.response.send_message('No field with name \"{}\" found for template number {}\nUse /view to check your templates and fields'.format(field_name, template_number), ephemeral=True)
+        return
+    field_id = field['id']
+    template_id = result.returnValue['id']
+    query = 'DELETE FROM editable_fields WHERE id=%s'
+    result = await async_execute(query, (field_id,))
+    templates.invalidate(context.user.id, template_number)
     if not result:
         await error_with_mysql_query(context, query, str(result))
         return
+    invalidate_template_preview(template_id)
     await context.response.send_message('Field \"{}\" successfully removed'.format(field_name), ephemeral=True)
 
-async def delete_from_template_dict(user_id: int):
-    global using_template
+# Removes the template in use by the user, cancels its timers and deletes it from the session store. Returns the session, None if there was none
+# The stored session is gone once this returns, so a template started right after can't resume it
+async def end_session(user_id: int) -> dict[str, Any] | None:
     data = using_template.pop(user_id, None)
     if data is None:
+        return None
+    session_timers.cancel(('expire', user_id, data['generation']))
+    session_timers.cancel(('idle', user_id, data['generation']))
+    result = await session_store.delete(user_id, data['generation'])
+    if not result:
+        log_output('Unable to delete stored template in use by user {}: {}'.format(user_id, result), logging.ERROR)
+    return data
+
+# Saves the template in use by the user to the session store, with images as compressed uploads. Layers aren't saved, they're made again
+# Stores that don't persist sessions keep nothing, so nothing is serialized for them
+async def save_session(user_id: int):
+    data = using_template.get(user_id)
+    if data is None or not session_store.persistent:
+        return
+    # Images kept decoded are encoded as PNG, so it's a render job. Only what gets stored is sent to it, not the session's arrays
+    snapshot = {key: data.get(key) for key in ('template_id', 'filename', 'channel_id', 'message_id', 'expires_at')}
+    snapshot['fields'] = {field_name: {'type': field['type'], 'bounds': field['bounds'], 'value': field['value']} for field_name, field in data['fields'].items()}
+    generation = data['generation']
+    result = await run_render_job(serialize_session, snapshot)
+    if not result:
+        log_output('Unable to save template in use by user {}: {}'.format(user_id, result), logging.ERROR)
+        return
+    # Saves finish in order, so one started for a session that has ended since must not store it again
+    data = using_template.get(user_id)
+    if data is None or data['generation'] != generation:
+        return
+    result = await session_store.save(user_id, generation, data['expires_at'], result.returnValue)
+    if not result:
+        log_output('Unable to save template in use by user {}: {}'.format(user_id, result), logging.ERROR)
+
+# Brings back a template in use stored by an earlier run of the bot when its user uses a command needing it
+# Its old message can't be interacted with anymore, so it's replaced by a new one. False if there was nothing to resume
+async def resume_session(user_id: int) -> bool:
+    if user_id in using_template.keys():
+        return True
+    result = await session_store.load(user_id, time())
+    if not result:
+        log_output('Unable to read stored template in use by user {}: {}'.format(user_id, result), logging.ERROR)
+        return False
+    if result.returnCode == 1:
+        return False
+    payload, generation, expires_at = result.returnValue
+    result = deserialize_session(payload)
+    if not result:
+        log_output('Unable to resume template in use by user {}: {}'.format(user_id, result), logging.ERROR)
+        await session_store.delete(user_id, generation)
+        return False
+    stored = result.returnValue
+    original_template = await load_template_image(stored['filename'])
+    preview_template = await load_template_preview(stored['filename'])
+    if original_template is None or preview_template is None:
+        log_output('Unable to resume template in use by user {}: template file \"{}\" can\'t be read'.format(user_id, stored['filename']), logging.ERROR)
+        return False
+    # The user could have started another template while this one was read
+    if user_id in using_template.keys():
+        return True
+    if not using_template.admit(template_session_nbytes(original_template, preview_template)):
+        log_output('Refused to resume template {} for user {}. {}'.format(stored['template_id'], user_id, format_session_manager_stats(using_template.stats())), logging.WARNING)
+        return False
+    preview_base = None if preview_template is original_template else preview_template
+    fields = {}
+    for field_name, field in stored['fields'].items():
+        fields[field_name] = {'type': field['type'], 'bounds': field['bounds'], 'value': field['value'], 'updated': False, 'layer': None, 'layer_job': None}
+    data = {'template_id': stored['template_id'], 'filename': stored['filename'], 'layers': LayeredImage(original_template, preview_base), 'channel_id': stored['channel_id'], 'message_id': stored['message_id'], 'last_used': monotonic(), 'generation': generation, 'expires_at': expires_at, 'fields': fields, 'render_lock': asyncio.Lock()}
+    using_template[user_id] = data
+    touch_session(user_id)
+    session_timers.schedule(('expire', user_id, generation), expires_at - time(), expire_session, user_id, generation)
+    log_output('Resumed template in use by user {} with {} of {} fields filled'.format(user_id, sum(not field['value'] is None for field in fields.values()), len(fields)))
+    try:
+        channel = await client.fetch_channel(data['channel_id'])
+        if not data['message_id'] is None:
+            try:
+                await channel.get_partial_message(data['message_id']).delete()
+            except discord.HTTPException:
+                pass
+        async def send(**kwargs) -> int:
+            return (await channel.send(**kwargs)).id
+        result = await send_session_message(user_id, 'The bot was restarted while this template was being used. Fields filled before are kept, use Update to see them', send)
+    except discord.HTTPException as error:
+        log_output('Unable to send the message of resumed template in use by user {}: {}'.format(user_id, error), logging.ERROR)
+        return True
+    if result:
+        await save_session(user_id)
+    return True
+
+def expire_session(user_id: int, generation: int):
+    data = using_template.get(user_id)
+    if data is None or data['generation'] != generation:
+        return
+    asyncio.create_task(delete_from_template_dict(user_id, generation))
+
+async def delete_from_template_dict(user_id: int, generation: int):
+    data = using_template.get(user_id)
+    if data is None or data['generation'] != generation:
+        return
+    await end_session(user_id)
+    if data['message_id'] is None:
         return
     # interaction = data['interaction']
     message = (await client.fetch_channel(data['channel_id'])).get_partial_message(data['message_id'])
@@ -373,254 +843,372 @@ async def delete_from_template_dict(user_id: int):
     view.add_item(button)
     await message.edit(embed=embed, view=view, attachments=[])
 
-def using_template_check(context: discord.Interaction) -> bool:
-    return context.user.id in using_template.keys()
-
-async def use_template_command_prototype(context: discord.Interaction, template_number: int):
-    global using_template
+# Only tells whether the user has a template in use or stored. Resuming it can take a while, so commands do it once they deferred
+async def using_template_check(context: discord.Interaction) -> bool:
     if context.user.id in using_template.keys():
-        embed = discord.Embed(
-            title='Template is already being used',
-            description='A template is already being used. Would you like to abandon the old template and use this one?',
-            color=embed_default_color
-        )
-        new_button = discord.ui.Button(label='Use a new one', style=discord.ButtonStyle.primary, emoji='✅')
-        cancel_button = discord.ui.Button(label='Cancel', style=discord.ButtonStyle.secondary, emoji='❌')
-        async def new_button_action(button_interaction: discord.Interaction):
-            if button_interaction.user != context.user:
-                await button_interaction.response.send_message('This command was not run by you so you cannot interact with it', ephemeral=True)
-                return
-            if context.user.id not in using_template.keys():
-                return
-            message = (await client.fetch_channel(using_template[context.user.id]['channel_id'])).get_partial_message(using_template[context.user.id]['message_id'])
-            asyncio.gather(
-                use_template_command_prototype(button_interaction, template_number),
-                button_interaction.message.delete(),
-                message.delete()
-            )
-            del using_template[context.user.id]
-        async def cancel_button_action(button_interaction: discord.Interaction):
-            if button_interaction.user != context.user:
-                await button_interaction.response.send_message('This command was not run by you so you cannot interact with it', ephemeral=True)
-                return
-            await context.delete_original_response()
-        new_button.callback = new_button_action
-        cancel_button.callback = cancel_button_action
-        buttons = discord.ui.View()
-        buttons.add_item(new_button)
-        buttons.add_item(cancel_button)
-        await context.response.send_message(embed=embed, view=buttons)
-        return
-    query = 'SELECT id, filename FROM images WHERE user_id=\"{}\" AND enumeration={}'.format(context.user.id, template_number)
-    result = mysql_select(db_cursor, query)
-    if result.returnCode == 1:
-        await context.response.send_message('No template found with a given number. Use /add_template to add your template and use /view to see what templates you have', ephemeral=True)
-        return
-    if not result:
-        await error_with_mysql_query(context, query, str(result))
-        return
-    template_id, filename = result.returnValue
-    filepath = path.join(absolute_path_to_project, 'Images', filename)
-    image = imread(filepath)
-    data = {'template_id': template_id, 'filename': filename, 'image': image, 'channel_id': context.channel_id, 'original_template': image.copy()}
-    fields = {}
-    query = 'SELECT LOWER(field_name), type, up_bound, left_bound, down_bound, right_bound FROM editable_fields WHERE image_id={}'.format(template_id)
-    result = mysql_select(db_cursor, query, True, True)
+        return True
+    result = await session_store.exists(context.user.id, time())
     if not result:
-        await error_with_mysql_query(context, query, str(result))
-        return
-    for field_data in result.returnValue:
-        fields[field_data[0]] = {'type': field_data[1], 'bounds': tuple(field_data[2:]), 'value': None, 'updated': False}
-    data['fields'] = fields
-    using_template[context.user.id] = data
-    asyncio.get_running_loop().call_later(60 * 60, asyncio.create_task, delete_from_template_dict(context.user.id))
+        log_output('Unable to read stored template in use by user {}: {}'.format(context.user.id, result), logging.ERROR)
+        return False
+    return result.returnValue
+
+# Sends the message showing the template in use by the user, with its Finish, Update and Cancel buttons
+# send is called with the message's embed, view and file and returns the id of the sent message
+async def send_session_message(user_id: int, description: str, send: Callable[..., Awaitable[int]]) -> ReturnInfo:
+    data = using_template[user_id]
+    template_id = data['template_id']
+    filename = data['filename']
+    fields = data['fields']
     embed = discord.Embed(
         title='Using template',
-        description='Template is being used. Use /fill_text_field or /fill_image_field to fill a field of a chosen type for the chosen template\nA template will no long be available to fill in an hour from now on. Make sure to finish using it by then',
+        description=description,
         color=embed_default_color
     )
-    embed.set_image(url='attachment://{}'.format(filename))
+    embed.set_image(url='attachment://{}'.format(preview_filename(filename)))
     finish_button = discord.ui.Button(label='Finish', style=discord.ButtonStyle.primary, emoji='✅')
     update_view_button = discord.ui.Button(label='Update', style=discord.ButtonStyle.secondary, emoji='🔄')
     cancel_button = discord.ui.Button(label='Cancel', style=discord.ButtonStyle.red, emoji='🗑️')
+    # The session can't be released and its fields aren't changed while its image is rendered. Returns what update_layers returns
     async def update_image() -> ReturnInfo:
+        data = using_template[user_id]
+        async with data['render_lock']:
+            result = await update_layers(True)
+        # Layers rasterized for the update can take the sessions over the budget, other sessions are released then
+        using_template.make_room(0, user_id)
+        return result
+    # Has to be called holding the session's render lock. With show_empty_fields set a preview with outlines of empty fields is made as well
+    # returnValue is (message listing fields that don't fit, the preview or None)
+    async def update_layers(show_empty_fields: bool = False) -> ReturnInfo:
         global using_template
-        ret = ReturnInfo(okCodes=[0, 1], returnValue='Done', Messages={
+        ret = ReturnInfo(okCodes=[0, 1], Messages={
             1: 'Template shown is up-to-date',
             2: 'Error while trying to insert image',
-            3: 'Error while trying to write on image'
+            3: 'Error while trying to write on image',
+            4: 'Error while trying to restore the template',
+            5: 'Error while trying to draw the template'
         })
-        image_fields = [field_name for field_name, field in using_template[context.user.id]['fields'].items() if not field['value'] is None and not field['updated'] and field['type'] == 'image']
-        text_fields = [field_name for field_name, field in using_template[context.user.id]['fields'].items() if not field['value'] is None and not field['updated'] and field['type'] == 'text']
-        if len(image_fields) + len(text_fields) == 0:
-            ret.returnCode = 1
+        message = 'Done'
+        touch_session(user_id)
+        fields = using_template[user_id]['fields']
+        layers = using_template[user_id]['layers']
+        if not await restore_session(user_id):
+            ret.returnCode = 4
+            ret.returnValue = 'Unable to read template file \"{}\"'.format(using_template[user_id]['filename'])
             return ret
-        for field_name in image_fields:
-            field = using_template[context.user.id]['fields'][field_name]
-            result = insert_image_into_image(using_template[context.user.id]['image'], field['value'], field['bounds'])
-            if not result:
-                ret.returnCode = 2
-                ret.returnValue = result
-                return ret
-            new_image = result.returnValue
-            using_template[context.user.id]['image'] = new_image
-            using_template[context.user.id]['fields'][field_name]['updated'] = True
-        for field_name in text_fields:
-            field = using_template[context.user.id]['fields'][field_name]
-            text, font, font_scale, color = field['value']
-            result = write_on_image(using_template[context.user.id]['image'], text, font, font_scale, color, 2, LINE_8, field['bounds'])
+        # Filled fields are rasterized once into layers covering only the part of the template they change
+        for field_name, field in fields.items():
+            if field['value'] is None or not field['layer'] is None:
+                continue
+            # Image fields are resized in the background when filled, the job is waited for unless the value changed since
+            layer_job = field['layer_job']
+            field['layer_job'] = None
+            if not layer_job is None and layer_job[0] is field['value']:
+                result = await layer_job[1]
+            else:
+                result = await run_render_job(rasterize_field, field['type'], field['bounds'], field['value'], layers.shape, text_thickness, LINE_8)
             if not result:
-                ret.returnCode = 3
+                ret.returnCode = 2 if field['type'] == 'image' else 3
                 ret.returnValue = result
                 return ret
             if result.returnCode == 1:
-                ret.returnValue += '\n' + field_name + ': ' + str(result)
-            new_image = result.returnValue
-            using_template[context.user.id]['image'] = new_image
-            using_template[context.user.id]['fields'][field_name]['updated'] = True
+                message += '\n' + field_name + ': ' + str(result)
+            field['layer'] = result.returnValue
+        # Only changed fields and fields overlapping them are drawn, image fields first
+        fields_to_draw = fields_to_render(fields)
+        if len(fields_to_draw) == 0:
+            ret.returnCode = 1
+            return ret
+        fields_to_draw.sort(key=lambda field_name: fields[field_name]['type'] != 'image')
+        # The preview is downscaled and outlined in the same job the fields are composited in
+        empty_fields = [(field_name, field['bounds']) for field_name, field in fields.items() if field['value'] is None]
+        empty_field_bounds = [item[1] for item in empty_fields] if show_empty_fields else None
+        result = await run_render_job(render_layered_image, layers, [fields[field_name]['layer'] for field_name in fields_to_draw], empty_field_bounds, [item[0] for item in empty_fields])
+        if not result:
+            ret.returnCode = 5
+            ret.returnValue = result
+            return ret
+        layers.update_from(result.returnValue[0])
+        preview = result.returnValue[1]
+        for field_name in fields_to_draw:
+            fields[field_name]['updated'] = True
+        log_output('Template in use by user {}: {}'.format(user_id, format_session_memory(using_template[user_id])))
+        ret.returnValue = (message, preview)
         return ret
     async def finish_action(button_interaction: discord.Interaction):
         global using_template
-        if context.user != button_interaction.user:
+        if button_interaction.user.id != user_id:
             await button_interaction.response.send_message('This command was not run by you so you cannot interact with it', ephemeral=True)
             return
-        if context.user.id not in using_template.keys():
+        if user_id not in using_template.keys():
             asyncio.gather(
                 button_interaction.message.delete(),
                 button_interaction.response.send_message('The time has run out and the message has been deleted', ephemeral=True)
             )
             return
-        if not context.user.id in using_template.keys():
+        if not user_id in using_template.keys():
             await button_interaction.response.send_message('Something went wrong. Try using a template again', ephemeral=True)
             return
-        result = await update_image()
-        if not result:
-            await button_interaction.response.send_message('Sorry, something went wrong. Try again later', ephemeral=True)
-            log_output('{}\ttemplate_number={}\t{}user_id={}\n{}'.format(result, template_id, context.user.id, result.returnValue))
+        # Render jobs can wait in the queue for longer than an interaction can go without a response
+        await button_interaction.response.defer()
+        data = using_template[user_id]
+        filename = data['filename']
+        # Fields aren't changed while the finished image is encoded either
+        async with data['render_lock']:
+            update_result = await update_layers()
+            result = await encode_output(data['layers'].current_image(), filename) if update_result else update_result
+        if not update_result:
+            await button_interaction.followup.send('Sorry, something went wrong. Try again later', ephemeral=True)
+            log_output('{}\ttemplate_number={}\t{}user_id={}\n{}'.format(update_result, template_id, user_id, update_result.returnValue))
             return
-        filename = using_template[context.user.id]['filename']
-        success, buffor = imencode('.' + filename.split('.')[-1], using_template[context.user.id]['image'])
-        if not success:
-            log_output('Error while converting file \"{}\" to bytes'.format(filename), logging.ERROR)
-            await button_interaction.response.send_message('Sorry, something went wrong. Try again later', ephemeral=True)
+        if not result:
+            log_output('Error while converting file \"{}\" to bytes\n{}'.format(filename, result), logging.ERROR)
+            await button_interaction.followup.send('Sorry, something went wrong. Try again later', ephemeral=True)
             return
-        file = discord.File(BytesIO(buffor.tobytes()), filename=filename)
+        file = discord.File(BytesIO(result.returnValue['data']), filename=result.returnValue['filename'])
         message = 'Image created from a template'
-        del using_template[context.user.id]
+        await end_session(user_id)
         asyncio.gather(
-            button_interaction.response.send_message(message, file=file),
+            button_interaction.followup.send(message, file=file),
             button_interaction.message.delete()
         )
     async def cancel_action(button_interaction: discord.Interaction):
         global using_template
-        if context.user != button_interaction.user:
+        if button_interaction.user.id != user_id:
             await button_interaction.response.send_message('This command was not run by you so you cannot interact with it', ephemeral=True)
             return
-        using_template.pop(context.user.id, None)
+        await end_session(user_id)
         await button_interaction.message.delete()
     async def update_view(button_interaction: discord.Interaction):
-        if context.user != button_interaction.user:
+        if button_interaction.user.id != user_id:
             await button_interaction.response.send_message('This command was not run by you so you cannot interact with it', ephemeral=True)
             return
-        if context.user.id not in using_template.keys():
+        if user_id not in using_template.keys():
             asyncio.gather(
                 button_interaction.message.delete(),
                 button_interaction.response.send_message('The time has run out and the message has been deleted', ephemeral=True)
             )
             return
+        await button_interaction.response.defer()
         result = await update_image()
         if not result:
-            await button_interaction.response.send_message('Sorry, something went wrong. Try again later', ephemeral=True)
-            log_output('{}\ttemplate_number={}\t{}user_id={}\n{}'.format(result, template_id, context.user.id, result.returnValue))
+            await button_interaction.followup.send('Sorry, something went wrong. Try again later', ephemeral=True)
+            log_output('{}\ttemplate_number={}\t{}user_id={}\n{}'.format(result, template_id, user_id, result.returnValue))
             return
         if result.returnCode == 1:
-            await button_interaction.response.send_message(str(result), ephemeral=True)
+            await button_interaction.followup.send(str(result), ephemeral=True)
             return
-        message = result.returnValue
-        empty_fields_temp = [(field_name, field['bounds']) for field_name, field in using_template[context.user.id]['fields'].items() if field['value'] is None]
-        empty_field_names = [item[0] for item in empty_fields_temp]
-        empty_field_bounds = [item[1] for item in empty_fields_temp]
-        image = np_copy(using_template[context.user.id]['image'])
-        result = show_fields_image(image, empty_field_bounds, empty_field_names)
-        if not result:
-            await button_interaction.response.send_message('Sorry, something went wrong. Try again later', ephemeral=True)
-            log_output('Error while generating fields for image\n{}'.format(result), logging.ERROR)
-            return
-        image = result.returnValue
-        filename = using_template[context.user.id]['filename']
+        message, image = result.returnValue
+        filename = using_template[user_id]['filename']
         new_embed = embed.copy()
-        new_embed.set_image(url='attachment://{}'.format(filename))
-        success, buffer = imencode('.' + filename.split('.')[-1], image)
-        if not success:
-            log_output('Error while converting file \"{}\" to bytes'.format(filename), logging.ERROR)
-            await button_interaction.response.send_message('Sorry, something went wrong. Try again later', ephemeral=True)
+        new_embed.set_image(url='attachment://{}'.format(preview_filename(filename)))
+        result = await encode_preview(image)
+        if not result:
+            log_output('Error while converting file \"{}\" to bytes\n{}'.format(filename, result), logging.ERROR)
+            await button_interaction.followup.send('Sorry, something went wrong. Try again later', ephemeral=True)
             return
-        new_file = discord.File(BytesIO(buffer.tobytes()), filename=filename)
-        await button_interaction.response.edit_message(embed=embed, attachments=[new_file])
+        new_file = discord.File(BytesIO(result.returnValue), filename=preview_filename(filename))
+        await button_interaction.edit_original_response(embed=embed, attachments=[new_file])
         await button_interaction.followup.send(message, ephemeral=True)
     finish_button.callback = finish_action
     update_view_button.callback = update_view
     cancel_button.callback = cancel_action
-    buttons = discord.ui.View(timeout=60 * 60)
+    buttons = discord.ui.View(timeout=max(1., data['expires_at'] - time()))
     buttons.add_item(finish_button)
     buttons.add_item(update_view_button)
     buttons.add_item(cancel_button)
-    image = np_copy(using_template[context.user.id]['image'])
+    layers = data['layers']
     field_temp = [(field_name, field['bounds']) for field_name, field in fields.items()]
     field_names = [item[0] for item in field_temp]
     field_bounds = [item[1] for item in field_temp]
-    result = show_fields_image(image, field_bounds, field_names)
+    async with data['render_lock']:
+        if not await restore_session(user_id):
+            result = ReturnInfo(returnCode=1, Messages={1: 'Unable to read template file \"{}\"'.format(filename)})
+        else:
+            result = await run_render_job(render_layered_image, layers, [], field_bounds, field_names)
+            if result:
+                layers.update_from(result.returnValue[0])
     if not result:
-        await context.response.send_message('Sorry, something went wrong. Try again later', ephemeral=True)
         log_output('Error while generating fields for image\n{}'.format(result), logging.ERROR)
+        return result
+    image = result.returnValue[1]
+    result = await encode_preview(image)
+    if not result:
+        log_output('Error while converting image \"{}\"to bytes\n{}'.format(filename, result), logging.ERROR)
+        return result
+    attachment = discord.File(BytesIO(result.returnValue), filename=preview_filename(filename))
+    data['message_id'] = await send(embed=embed, view=buttons, file=attachment)
+    return ReturnInfo()
+
+async def use_template_command_prototype(context: discord.Interaction, template_number: int):
+    global using_template
+    # Loading, resuming and rendering the template can take longer than an interaction can go without a response
+    await context.response.defer(thinking=True)
+    await resume_session(context.user.id)
+    if context.user.id in using_template.keys():
+        embed = discord.Embed(
+            title='Template is already being used',
+            description='A template is already being used. Would you like to abandon the old template and use this one?',
+            color=embed_default_color
+        )
+        new_button = discord.ui.Button(label='Use a new one', style=discord.ButtonStyle.primary, emoji='✅')
+        cancel_button = discord.ui.Button(label='Cancel', style=discord.ButtonStyle.secondary, emoji='❌')
+        async def new_button_action(button_interaction: discord.Interaction):
+            if button_interaction.user != context.user:
+                await button_interaction.response.send_message('This command was not run by you so you cannot interact with it', ephemeral=True)
+                return
+            if context.user.id not in using_template.keys():
+                return
+            # The old template has no message yet while it's still being sent
+            old_data = using_template[context.user.id]
+            deletions = [button_interaction.message.delete()]
+            if not old_data['message_id'] is None:
+                deletions.append((await client.fetch_channel(old_data['channel_id'])).get_partial_message(old_data['message_id']).delete())
+            # The old template has to be out of the session store before the new one starts, or it would be resumed instead
+            await end_session(context.user.id)
+            asyncio.gather(
+                use_template_command_prototype(button_interaction, template_number),
+                *deletions
+            )
+        async def cancel_button_action(button_interaction: discord.Interaction):
+            if button_interaction.user != context.user:
+                await button_interaction.response.send_message('This command was not run by you so you cannot interact with it', ephemeral=True)
+                return
+            await context.delete_original_response()
+        new_button.callback = new_button_action
+        cancel_button.callback = cancel_button_action
+        buttons = discord.ui.View()
+        buttons.add_item(new_button)
+        buttons.add_item(cancel_button)
+        await context.followup.send(embed=embed, view=buttons)
+        return
+    result = await templates.get_template(context.user.id, template_number)
+    if result.returnCode == 1:
+        await followup_and_delete(context, 'No template found with a given number. Use /add_template to add your template and use /view to see what templates you have')
+        return
+    if not result:
+        await error_with_mysql_query(context, template_query, str(result), True)
+        return
+    template = result.returnValue
+    template_id = template['id']
+    filename = template['filename']
+    original_template = await load_template_image(filename)
+    if original_template is None:
+        await followup_and_delete(context, 'Sorry, something went wrong. Try again later')
+        log_output('Error while reading template file: {}'.format(filename), logging.ERROR)
+        return
+    preview_template = await load_template_preview(filename)
+    if preview_template is None:
+        await followup_and_delete(context, 'Sorry, something went wrong. Try again later')
+        log_output('Error while reading template file: {}'.format(filename), logging.ERROR)
         return
-    image = result.returnValue
-    success, buffer = imencode('.' + filename.split('.')[-1], image)
-    if not success:
-        await context.response.send_message('Sorry, something went wrong. Try again later', ephemeral=True)
-        log_output('Error while converting image \"{}\"to bytes'.format(filename), logging.ERROR)
+    # A new session is refused only if releasing every other session's images doesn't make room for it
+    if not using_template.admit(template_session_nbytes(original_template, preview_template)):
+        await followup_and_delete(context, 'Too many templates are being used right now. Try again in a few minutes')
+        log_output('Refused to use template {} for user {}. {}'.format(template_id, context.user.id, format_session_manager_stats(using_template.stats())), logging.WARNING)
         return
-    attachment = discord.File(BytesIO(buffer.tobytes()), filename=filename)
-    await context.response.send_message(embed=embed, view=buttons, file=attachment)
-    using_template[context.user.id]['message_id'] = (await context.original_response()).id
+    # original_template is the shared read-only cached array, the session composites its fields into its own copy of it
+    # Previews are made from a downscaled copy kept up to date where fields change
+    preview_base = None if preview_template is original_template else preview_template
+    data = {'template_id': template_id, 'filename': filename, 'layers': LayeredImage(original_template, preview_base), 'channel_id': context.channel_id, 'message_id': None, 'last_used': monotonic(), 'generation': next(session_generations), 'expires_at': time() + 60 * 60, 'render_lock': asyncio.Lock()}
+    fields = {}
+    for field_data in template['fields']:
+        fields[field_data['name'].lower()] = {'type': field_data['type'], 'bounds': field_data['bounds'], 'value': None, 'updated': False, 'layer': None, 'layer_job': None}
+    data['fields'] = fields
+    using_template[context.user.id] = data
+    touch_session(context.user.id)
+    session_timers.schedule(('expire', context.user.id, data['generation']), 60 * 60, expire_session, context.user.id, data['generation'])
+    async def send(**kwargs) -> int:
+        return (await context.followup.send(**kwargs)).id
+    result = await send_session_message(context.user.id, 'Template is being used. Use /fill_text_field or /fill_image_field to fill a field of a chosen type for the chosen template\nA template will no long be available to fill in an hour from now on. Make sure to finish using it by then', send)
+    # A session without its message can't be finished, so it isn't kept
+    if not result:
+        await end_session(context.user.id)
+        await followup_and_delete(context, 'Sorry, something went wrong. Try again later')
+        return
+    await save_session(context.user.id)
 
 async def fill_image_field_command_prototype(context: discord.Interaction, field_name: str, image: discord.Attachment):
     global using_template
+    # The upload is decoded by a render job, which can take longer than an interaction can go without a response
+    await context.response.defer(ephemeral=True, thinking=True)
+    await resume_session(context.user.id)
     if not context.user.id in using_template.keys():
-        await context.response.send_message('An error occurred, try again later', ephemeral=True)
+        await context.followup.send('An error occurred, try again later', ephemeral=True)
         log_output('Error: command use_image_field used without permission', logging.ERROR)
         return
     if not field_name.lower() in using_template[context.user.id]['fields'].keys():
-        await context.response.send_message('Field \"{}\" not found for the template in use'.format(field_name), ephemeral=True)
+        await context.followup.send('Field \"{}\" not found for the template in use'.format(field_name), ephemeral=True)
         return
     if using_template[context.user.id]['fields'][field_name.lower()]['type'] != 'image':
-        await context.response.send_message('This field is a text field. Please use command /fill_text_field', ephemeral=True)
+        await context.followup.send('This field is a text field. Please use command /fill_text_field', ephemeral=True)
+        return
+    data = using_template[context.user.id]
+    # The upload is resized to the field anyway, so it doesn't have to be decoded any bigger than the field
+    top, left, down, right = data['fields'][field_name.lower()]['bounds']
+    result = await ingest_attachment(image, True, (right - left + 1, down - top + 1))
+    if not result:
+        await context.followup.send(str(result) if result.returnCode in [2, 3] else 'Unable to read attachment as image', ephemeral=True)
+        return
+    # The field keeps the upload compressed, the decoded image is only used to make its layer
+    # unless the image was decoded reduced so much that it takes less memory than the upload
+    image_array, encoded_image = result.returnValue
+    # The session could have ended while the upload was decoded. The field isn't changed while the session's image is rendered
+    async with data['render_lock']:
+        ended = not using_template.get(context.user.id) is data
+        if not ended:
+            touch_session(context.user.id)
+            data['fields'][field_name.lower()]['value'] = encoded_image if encoded_image.nbytes() <= image_array.nbytes else image_array
+            invalidate_field(data['layers'], data['fields'], field_name.lower())
+            start_layer_job(data['layers'], data['fields'][field_name.lower()], image_array)
+    if ended:
+        await context.followup.send('The template is not being used anymore. Use /use_template to use a template again', ephemeral=True)
         return
-    image_array = imdecode(asarray(bytearray(await image.read()), dtype=uint8), IMREAD_COLOR)
-    using_template[context.user.id]['fields'][field_name.lower()]['value'] = image_array
-    using_template[context.user.id]['fields'][field_name.lower()]['updated'] = False
-    await context.response.send_message('Field \"{}\" has been filled'.format(field_name), ephemeral=True)
+    await context.followup.send('Field \"{}\" has been filled'.format(field_name), ephemeral=True)
+    await save_session(context.user.id)
 
-async def fill_text_field_command_prototype(context: discord.Interaction, field_name: str, text: str, font: discord.app_commands.Choice[str], font_size: float = 3., color: str = default_color_hex):
+async def fill_text_field_command_prototype(context: discord.Interaction, field_name: str, text: str, font: discord.app_commands.Choice[str], font_size: float = 0., color: str = default_color_hex):
     global using_template
+    # Fitting the font size is a render job, which can take longer than an interaction can go without a response
+    await context.response.defer(ephemeral=True, thinking=True)
+    await resume_session(context.user.id)
     if not context.user.id in using_template.keys():
-        await context.response.send_message('An error occurred, try again later', ephemeral=True)
+        await context.followup.send('An error occurred, try again later', ephemeral=True)
         log_output('Error: command use_image_field used without permission', logging.ERROR)
         return
     if not field_name.lower() in using_template[context.user.id]['fields'].keys():
-        await context.response.send_message('Field \"{}\" not found for the template in use'.format(field_name), ephemeral=True)
+        await context.followup.send('Field \"{}\" not found for the template in use'.format(field_name), ephemeral=True)
         return
     if using_template[context.user.id]['fields'][field_name.lower()]['type'] != 'text':
-        await context.response.send_message('This field is an image field. Please use command /fill_image_field', ephemeral=True)
+        await context.followup.send('This field is an image field. Please use command /fill_image_field', ephemeral=True)
         return
+    data = using_template[context.user.id]
     result = hex_to_bgr(color)
     if not result:
-        await context.response.send_message('Could not convert \"{}\" to a color. To describe a color use a hex code'.format(color), ephemeral=True)
-        return
-    values = text, possible_fonts[font.value], font_size, result.returnValue
-    using_template[context.user.id]['fields'][field_name.lower()]['value'] = values
-    if using_template[context.user.id]['fields'][field_name.lower()]['updated']:
-        using_template[context.user.id]['image'] = using_template[context.user.id]['original_template'].copy()
-        for field_name in using_template[context.user.id]['fields'].copy().keys():
-            using_template[context.user.id]['fields'][field_name]['updated'] = False
-    await context.response.send_message('Field \"{}\" has been filled'.format(field_name), ephemeral=True)
\ No newline at end of file
+        await context.followup.send('Could not convert \"{}\" to a color. To describe a color use a hex code'.format(color), ephemeral=True)
+        return
+    bgr_color = result.returnValue
+    message = 'Field \"{}\" has been filled'.format(field_name)
+    # Font size of 0 or less means the biggest size at which the text fits the field
+    if font_size <= 0:
+        result = await run_render_job(fit_font_scale, text, data['fields'][field_name.lower()]['bounds'], possible_fonts[font.value], text_thickness)
+        if not result:
+            log_output('Error while fitting font size for field \"{}\"\n{}'.format(field_name, result), logging.ERROR)
+            await context.followup.send('Sorry, something went wrong. Try again later', ephemeral=True)
+            return
+        font_size = result.returnValue
+        message += ' with font size {:.2f}'.format(font_size)
+    values = text, possible_fonts[font.value], font_size, bgr_color
+    # The session could have ended while the font size was fitted. The field isn't changed while the session's image is rendered
+    async with data['render_lock']:
+        ended = not using_template.get(context.user.id) is data
+        if not ended:
+            touch_session(context.user.id)
+            data['fields'][field_name.lower()]['value'] = values
+            # Brings back only this field's part of the template, so the old text isn't drawn over
+            invalidate_field(data['layers'], data['fields'], field_name.lower())
+    if ended:
+        await context.followup.send('The template is not being used anymore. Use /use_template to use a template again', ephemeral=True)
+        return
+    await context.followup.send(message, ephemeral=True)
+    await save_session(context.user.id)
\ No newline at end of file
@@ -22,6 +22,7 @@ date_format = '%Y-%m-%d %H:%M:%S'
 description_placeholder = 'Missing description'
 
 setup_database_script = os.path.join(absolute_path_to_project, 'Database', 'setup_database_script.sql')
+migrations_dir = os.path.join(absolute_path_to_project, 'Database', 'migrations')
 
 skip_tables_for_testdata = ['descriptions']
 priority_fields = ['images']
@@ -34,4 +35,54 @@ log_file_split_check_timer = 60
 default_hue_range = 20
 default_saturation_range = 30
 default_value_range = 20
-default_color_hex = '#0000FF'
\ No newline at end of file
+# A pixel of a reference image differing from the template by more than this in any channel counts as painted over
+default_diff_threshold = 40
+default_color_hex = '#0000FF'
+# Regions of a reference image smaller than this many pixels are not made into fields by /add_fields
+default_min_field_area = 100
+
+# Budget for decoded template images kept in memory, in megabytes
+default_template_cache_mb = 256
+# Budget for encoded /view show_fields previews, in megabytes
+default_preview_cache_mb = 64
+# Templates and their fields read from the database are cached for this many seconds. 0 means until they change
+default_metadata_cache_ttl = 300
+# Maximum number of cached templates and template lists. 0 means no limit
+default_metadata_cache_entries = 4096
+# Previews of templates being edited or used are scaled down to this many pixels on the longer side (0 means full size)
+# and encoded as preview_format with preview_quality. The finished image keeps the template's size and format
+default_preview_max_side = 1280
+default_preview_format = 'jpg'
+default_preview_quality = 85
+# Finished images and /view previews: "auto" (PNG for flat images, lossy_format for photos), "source" (the template's format), "png", "jpg" or "webp"
+# Lossy output starts at output_quality and goes down to output_min_quality to fit in output_max_kb kilobytes (0 means no limit)
+default_output_format = 'auto'
+default_lossy_format = 'jpg'
+default_output_quality = 92
+default_output_min_quality = 40
+default_output_max_kb = 8000
+# Uploaded reference images over this many pixels are rejected, image field uploads are decoded at a reduced size
+# Uploads whose size can't be read from their header (formats other than PNG, JPEG, GIF, BMP and WebP) are rejected. 0 means no limit
+default_max_upload_pixels = 50000000
+# A template in use idle for this many seconds keeps only its field values until used again, 0 keeps everything for the whole hour
+default_session_idle_seconds = 5 * 60
+# Templates in use taking more memory than this have images of the least recently used ones released, new ones are refused if that's not enough. 0 means no limit
+default_session_memory_mb = 1024
+# Where templates in use are kept to be resumed after a restart: 'memory' (not resumed) or 'sqlite', in session_store_file in the project's directory
+default_session_store = 'memory'
+default_session_store_file = 'sessions.sqlite'
+
+# Executor used for OpenCV work: "thread" or "process". 0 workers means one per CPU
+default_render_executor = 'thread'
+default_render_workers = 0
+# Maximum number of render jobs waiting for a worker. 0 means no limit
+default_render_queue_size = 32
+# Time in seconds after which a render job is abandoned. 0 means no timeout
+default_render_timeout = 30
+
+# Number of database connections shared by all commands
+default_db_pool_size = 5
+# Time in seconds to wait for a free connection when all of them are in use
+default_db_pool_timeout = 10
+# Connections idle for longer than this many seconds are pinged before use
+default_db_ping_interval = 30
\ No newline at end of file
@@ -0,0 +1,120 @@
+import asyncio
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from .ReturnInfo import ReturnInfo
+from .database_functions import select as mysql_select, execute_query, execute_many as mysql_execute_many
+
+backend = None
+
+# Runs the blocking database functions on a dedicated thread pool, using connections from the connection pool
+# The thread count should match the size of the connection pool so no thread waits for a free connection
+class ThreadPoolBackend():
+    def __init__(self, workers: int = 5):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='database')
+
+    async def select(self, query: str, multiple: bool = False, return_empty_list: bool = False, params: tuple | None = None) -> ReturnInfo:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, mysql_select, None, query, multiple, return_empty_list, params)
+
+    async def execute(self, query: str, params: tuple | None = None) -> ReturnInfo:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, execute_query, None, None, query, params)
+
+    async def execute_many(self, query: str, params_list: list[tuple]) -> ReturnInfo:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, mysql_execute_many, None, None, query, params_list)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+# Cursor and connection stand-in used by FakeBackend
+class FakeCursor():
+    def __init__(self, fake_backend: 'FakeBackend'):
+        self.fake_backend = fake_backend
+        self.rows = []
+        self.in_transaction = False
+
+    def execute(self, query: str, params: tuple | None = None):
+        self.fake_backend.executed.append(query if params is None else (query, params))
+        self.rows = list(self.fake_backend.find_rows(query))
+
+    def fetchone(self) -> tuple | None:
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self) -> list[tuple]:
+        rows, self.rows = self.rows, []
+        return rows
+
+    def executemany(self, query: str, params_list: list[tuple]):
+        for params in params_list:
+            self.execute(query, params)
+
+    def start_transaction(self):
+        self.in_transaction = True
+
+    def commit(self):
+        self.in_transaction = False
+        self.fake_backend.commits += 1
+
+    def rollback(self):
+        self.in_transaction = False
+
+# In-process backend for running commands without a MySQL server
+# Rows returned for a query are registered with add_rows, every statement is recorded in executed, together with its parameters if it had any
+# It goes through the same select and execute_query functions as the real backend, so the ReturnInfo semantics are the same
+class FakeBackend():
+    def __init__(self):
+        # (compiled pattern, rows)
+        self.responses = []
+        self.executed = []
+        self.commits = 0
+        self.cursor = FakeCursor(self)
+
+    # pattern is a regular expression searched for in the query. Later registrations take precedence
+    def add_rows(self, pattern: str, rows: list[tuple[Any, ...]]):
+        self.responses.insert(0, (re.compile(pattern), rows))
+
+    def find_rows(self, query: str) -> list[tuple[Any, ...]]:
+        for pattern, rows in self.responses:
+            if pattern.search(query):
+                return rows
+        return []
+
+    async def select(self, query: str, multiple: bool = False, return_empty_list: bool = False, params: tuple | None = None) -> ReturnInfo:
+        return mysql_select(self.cursor, query, multiple, return_empty_list, params)
+
+    async def execute(self, query: str, params: tuple | None = None) -> ReturnInfo:
+        return execute_query(self.cursor, self.cursor, query, params)
+
+    async def execute_many(self, query: str, params_list: list[tuple]) -> ReturnInfo:
+        return mysql_execute_many(self.cursor, self.cursor, query, params_list)
+
+    def close(self):
+        pass
+
+def set_database_backend(new_backend: ThreadPoolBackend | FakeBackend):
+    global backend
+    close_database_backend()
+    backend = new_backend
+
+def close_database_backend():
+    global backend
+    if backend is None:
+        return
+    backend.close()
+    backend = None
+
+# Awaitable counterparts of select and execute_query. They return the same ReturnInfo as the blocking versions
+# Values should be passed in params with %s placeholders in the query rather than formatted into it
+async def select(query: str, multiple: bool = False, return_empty_list: bool = False, params: tuple | None = None) -> ReturnInfo:
+    if backend is None:
+        return ReturnInfo(returnCode=-1, Messages={-1: 'Database backend has not been set up'})
+    return await backend.select(query, multiple, return_empty_list, params)
+
+async def execute(query: str, params: tuple | None = None) -> ReturnInfo:
+    if backend is None:
+        return ReturnInfo(returnCode=-1, Messages={-1: 'Database backend has not been set up'})
+    return await backend.execute(query, params)
+
+async def execute_many(query: str, params_list: list[tuple]) -> ReturnInfo:
+    if backend is None:
+        return ReturnInfo(returnCode=-1, Messages={-1: 'Database backend has not been set up'})
+    return await backend.execute_many(query, params_list)
\ No newline at end of file
@@ -0,0 +1,113 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Callable, Hashable
+
+# Thread-safe least recently used cache. A limit of 0 means no limit of that kind
+# max_bytes is checked against sizes reported by size_function, ttl is in seconds
+class LRUCache():
+    def __init__(self, max_bytes: int = 0, max_entries: int = 0, ttl: float = 0, size_function: Callable[[Any], int] = lambda _: 0):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.size_function = size_function
+        # key -> (value, size, time of insertion)
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self.lock:
+            return key in self.entries and not self.is_expired(key)
+
+    def is_expired(self, key: Hashable) -> bool:
+        return self.ttl > 0 and monotonic() - self.entries[key][2] > self.ttl
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            if self.is_expired(key):
+                self.drop(key)
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+
+    # Returns False if the value alone does not fit in the byte budget and thus was not stored
+    def put(self, key: Hashable, value: Any) -> bool:
+        size = self.size_function(value)
+        with self.lock:
+            if self.max_bytes > 0 and size > self.max_bytes:
+                return False
+            if key in self.entries:
+                self.drop(key)
+            self.entries[key] = (value, size, monotonic())
+            self.current_bytes += size
+            self.evict()
+        return True
+
+    def remove(self, key: Hashable) -> bool:
+        with self.lock:
+            if key not in self.entries:
+                return False
+            self.drop(key)
+            return True
+
+    # Removes all entries with keys matching key_filter. Returns number of removed entries
+    def invalidate(self, key_filter: Callable[[Hashable], bool]) -> int:
+        with self.lock:
+            keys = [key for key in self.entries.keys() if key_filter(key)]
+            for key in keys:
+                self.drop(key)
+            return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def resize(self, max_bytes: int | None = None, max_entries: int | None = None, ttl: float | None = None):
+        with self.lock:
+            if not max_bytes is None:
+                self.max_bytes = max_bytes
+            if not max_entries is None:
+                self.max_entries = max_entries
+            if not ttl is None:
+                self.ttl = ttl
+            self.evict()
+
+    def stats(self) -> dict[str, int | float]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.
+            }
+
+    # Both functions below expect the lock to be held
+    def drop(self, key: Hashable):
+        _, size, _ = self.entries.pop(key)
+        self.current_bytes -= size
+
+    def evict(self):
+        while self.entries and ((self.max_bytes > 0 and self.current_bytes > self.max_bytes) or (self.max_entries > 0 and len(self.entries) > self.max_entries)):
+            _, (_, size, _) = self.entries.popitem(last=False)
+            self.current_bytes -= size
+            self.evictions += 1
+
+def format_cache_stats(name: str, stats: dict[str, int | float]) -> str:
+    return '{} cache: {} entries, {}/{} bytes, {} hits, {} misses ({:.1%} hit rate), {} evictions'.format(name, stats['entries'], stats['bytes'], stats['max_bytes'] or 'unlimited', stats['hits'], stats['misses'], stats['hit_rate'], stats['evictions'])
\ No newline at end of file
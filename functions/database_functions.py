@@ -1,20 +1,30 @@
 import mysql.connector
+import threading
 from mysql.connector import errorcode
 from mysql.connector.cursor import MySQLCursor
+from mysql.connector.errors import PoolError
+from contextlib import contextmanager
+from queue import LifoQueue, Empty
+from collections import OrderedDict
+from time import sleep, monotonic
 from logging import Logger
-from typing import Any
+from typing import Any, Iterator
 from .ReturnInfo import ReturnInfo
 
 logger = None
+connection_pool = None
 
 def set_logger(logger_handle: Logger):
     global logger
     logger = logger_handle
 
-def log_query(query: str, success: bool = True, errMsg: str | Any = '') -> bool:
+def log_query(query: str, success: bool = True, errMsg: str | Any = '', params: tuple | None = None) -> bool:
     if not isinstance(logger, Logger):
         return False
-    message = f'Select query \"{query}\"\tResult: '
+    message = f'Select query \"{query}\"'
+    if not params is None:
+        message += f' with parameters {params}'
+    message += '\tResult: '
     if success:
         message += 'OK'
         logger.info(message)
@@ -23,11 +33,24 @@ def log_query(query: str, success: bool = True, errMsg: str | Any = '') -> bool:
         logger.error(message)
     return True
 
-def connect_database(username: str, password: str, database: None | str = None) -> ReturnInfo:
-    ret = ReturnInfo(Messages={
-        1: 'Error: incorrect username or password',
-        2: 'Database \"{}\" does not exist'.format(database)
-    })
+def log_pool_event(message: str, error: bool = False):
+    if not isinstance(logger, Logger):
+        return
+    if error:
+        logger.error(message)
+    else:
+        logger.info(message)
+
+def connection_error_to_return_info(ret: ReturnInfo, err: mysql.connector.Error):
+    if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
+        ret.returnCode = 1
+    elif err.errno == errorcode.ER_BAD_DB_ERROR:
+        ret.returnCode = 2
+    else:
+        ret.returnCode = 3
+        ret.Messages[3] = str(err)
+
+def get_connection_config(username: str, password: str, database: None | str = None) -> dict[str, str]:
     config = {
         'user': username,
         'password': password,
@@ -35,48 +58,314 @@ def connect_database(username: str, password: str, database: None | str = None)
     }
     if not database is None:
         config['database'] = database
+    return config
+
+def connect_database(username: str, password: str, database: None | str = None) -> ReturnInfo:
+    ret = ReturnInfo(Messages={
+        1: 'Error: incorrect username or password',
+        2: 'Database \"{}\" does not exist'.format(database)
+    })
     try:
-        db_handle = mysql.connector.connect(**config)
+        db_handle = mysql.connector.connect(**get_connection_config(username, password, database))
         db_cursor = db_handle.cursor()
         ret.returnValue = db_handle, db_cursor
     except mysql.connector.Error as err:
-        if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
-            ret.returnCode = 1
-        elif err.errno == errorcode.ER_BAD_DB_ERROR:
-            ret.returnCode = 2
-        else:
-            ret.returnCode = 3
-            ret.Messages[3] = str(err)
+        connection_error_to_return_info(ret, err)
+    return ret
+
+# Fixed size pool of connections shared by all threads. Connections are opened lazily up to pool_size
+# A connection idle for longer than ping_interval seconds is pinged on checkout and reconnected with exponential backoff if it's dead
+# Every connection keeps up to max_statements server-side prepared statements, one prepared cursor per query text
+class ConnectionPool():
+    def __init__(self, config: dict[str, str], pool_size: int = 5, checkout_timeout: float = 10., ping_interval: float = 30., reconnect_attempts: int = 5, backoff: float = 0.5, max_statements: int = 32):
+        self.config = config
+        self.pool_size = max(1, pool_size)
+        self.checkout_timeout = checkout_timeout
+        self.ping_interval = ping_interval
+        self.reconnect_attempts = max(1, reconnect_attempts)
+        self.backoff = backoff
+        self.max_statements = max(1, max_statements)
+        # (connection, time of checkin). Last in, first out, so the warmest connections get reused
+        self.idle = LifoQueue()
+        self.opened = 0
+        self.checked_out = 0
+        # id of connection -> query -> prepared cursor
+        self.statements = {}
+        self.statements_prepared = 0
+        self.statements_reused = 0
+        self.lock = threading.Lock()
+
+    def connect(self) -> mysql.connector.MySQLConnection:
+        delay = self.backoff
+        for attempt in range(self.reconnect_attempts):
+            try:
+                return mysql.connector.connect(**self.config)
+            except mysql.connector.Error as err:
+                # Wrong credentials or database won't fix themselves
+                if err.errno in (errorcode.ER_ACCESS_DENIED_ERROR, errorcode.ER_BAD_DB_ERROR) or attempt + 1 == self.reconnect_attempts:
+                    raise
+                log_pool_event('Connecting to the database failed ({}). Retrying in {}s'.format(err, delay), True)
+                sleep(delay)
+                delay *= 2
+
+    def is_healthy(self, db_handle: mysql.connector.MySQLConnection, idle_since: float) -> bool:
+        if monotonic() - idle_since < self.ping_interval:
+            return True
+        try:
+            db_handle.ping()
+        except mysql.connector.Error:
+            return False
+        return True
+
+    def checkout(self) -> mysql.connector.MySQLConnection:
+        try:
+            db_handle, idle_since = self.idle.get_nowait()
+        except Empty:
+            with self.lock:
+                can_open = self.opened < self.pool_size
+                if can_open:
+                    self.opened += 1
+            if can_open:
+                try:
+                    db_handle = self.connect()
+                except mysql.connector.Error:
+                    with self.lock:
+                        self.opened -= 1
+                    raise
+                idle_since = monotonic()
+            else:
+                try:
+                    db_handle, idle_since = self.idle.get(timeout=self.checkout_timeout or None)
+                except Empty:
+                    raise PoolError('No database connection became available in {}s'.format(self.checkout_timeout), errno=errorcode.ER_CON_COUNT_ERROR)
+        if not self.is_healthy(db_handle, idle_since):
+            log_pool_event('Database connection lost. Reconnecting', True)
+            self.forget_statements(db_handle)
+            try:
+                db_handle.close()
+            except mysql.connector.Error:
+                pass
+            try:
+                db_handle = self.connect()
+            except mysql.connector.Error:
+                with self.lock:
+                    self.opened -= 1
+                raise
+            log_pool_event('Database reconnected')
+        with self.lock:
+            self.checked_out += 1
+        return db_handle
+
+    def checkin(self, db_handle: mysql.connector.MySQLConnection):
+        with self.lock:
+            self.checked_out -= 1
+        try:
+            if db_handle.in_transaction:
+                db_handle.rollback()
+        except mysql.connector.Error:
+            # Broken connection is not returned to the pool, a new one will be opened in its place
+            self.forget_statements(db_handle)
+            with self.lock:
+                self.opened -= 1
+            return
+        self.idle.put((db_handle, monotonic()))
+
+    # Only the thread holding the connection uses its statements, the lock guards the dictionary of all connections
+    def prepared_cursor(self, db_handle: mysql.connector.MySQLConnection, query: str) -> MySQLCursor:
+        with self.lock:
+            statements = self.statements.setdefault(id(db_handle), OrderedDict())
+        if query in statements.keys():
+            statements.move_to_end(query)
+            with self.lock:
+                self.statements_reused += 1
+            return statements[query]
+        # The statement is prepared on the server by the first execute of this cursor and reused by the following ones
+        db_cursor = db_handle.cursor(prepared=True)
+        statements[query] = db_cursor
+        with self.lock:
+            self.statements_prepared += 1
+        if len(statements) > self.max_statements:
+            _, oldest_cursor = statements.popitem(last=False)
+            close_cursor(oldest_cursor)
+        return db_cursor
+
+    def forget_statements(self, db_handle: mysql.connector.MySQLConnection):
+        with self.lock:
+            statements = self.statements.pop(id(db_handle), {})
+        for db_cursor in statements.values():
+            close_cursor(db_cursor)
+
+    def close(self):
+        while True:
+            try:
+                db_handle, _ = self.idle.get_nowait()
+            except Empty:
+                break
+            self.forget_statements(db_handle)
+            try:
+                db_handle.close()
+            except mysql.connector.Error:
+                pass
+            with self.lock:
+                self.opened -= 1
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                'pool_size': self.pool_size,
+                'opened': self.opened,
+                'checked_out': self.checked_out,
+                'idle': self.idle.qsize(),
+                'statements_prepared': self.statements_prepared,
+                'statements_reused': self.statements_reused
+            }
+
+def close_cursor(db_cursor: MySQLCursor):
+    try:
+        db_cursor.close()
+    except mysql.connector.Error:
+        pass
+
+def setup_connection_pool(username: str, password: str, database: None | str = None, pool_size: int = 5, checkout_timeout: float = 10., ping_interval: float = 30.) -> ReturnInfo:
+    global connection_pool
+    ret = ReturnInfo(Messages={
+        1: 'Error: incorrect username or password',
+        2: 'Database \"{}\" does not exist'.format(database)
+    })
+    close_connection_pool()
+    config = get_connection_config(username, password, database)
+    # Without autocommit every select would leave a transaction open and the connection would keep reading an old snapshot
+    config['autocommit'] = True
+    pool = ConnectionPool(config, pool_size, checkout_timeout, ping_interval)
+    # Opening the first connection right away, so wrong settings are reported at startup
+    try:
+        pool.checkin(pool.checkout())
+    except mysql.connector.Error as err:
+        connection_error_to_return_info(ret, err)
+        return ret
+    connection_pool = pool
+    log_pool_event('Database connection pool ready. Pool size: {}'.format(pool.pool_size))
+    ret.returnValue = pool
     return ret
 
-def select(db_cursor: MySQLCursor, query: str, multiple: bool = False, return_empty_list: bool = False) -> ReturnInfo:
+def close_connection_pool():
+    global connection_pool
+    if connection_pool is None:
+        return
+    connection_pool.close()
+    connection_pool = None
+
+# Every checkout gets its own cursor, which is closed before the connection goes back to the pool
+# With prepared_query given, the connection's cached prepared cursor for that query is used instead
+@contextmanager
+def pooled_cursor(prepared_query: str | None = None) -> Iterator[tuple[mysql.connector.MySQLConnection, MySQLCursor]]:
+    if connection_pool is None:
+        raise PoolError('Connection pool has not been set up', errno=errorcode.CR_CONNECTION_ERROR)
+    db_handle = connection_pool.checkout()
+    try:
+        if prepared_query is None:
+            db_cursor = db_handle.cursor()
+            try:
+                yield db_handle, db_cursor
+            finally:
+                db_cursor.close()
+        else:
+            try:
+                yield db_handle, connection_pool.prepared_cursor(db_handle, prepared_query)
+            except mysql.connector.Error:
+                # A failed statement might have left its cursor unusable, they'll be prepared again
+                connection_pool.forget_statements(db_handle)
+                raise
+    finally:
+        connection_pool.checkin(db_handle)
+
+def error_number(err: mysql.connector.Error) -> int:
+    return err.errno if not err.errno is None else -1
+
+# With db_cursor set to None, a connection from the pool is used
+# Values for %s placeholders in the query are given in params. Pooled parameterized queries run as server-side prepared statements
+def select(db_cursor: MySQLCursor | None, query: str, multiple: bool = False, return_empty_list: bool = False, params: tuple | None = None) -> ReturnInfo:
     ret = ReturnInfo(Messages={
         1: 'Query returned no entries'
     })
     errorcode_offset = max(ret.Messages.keys())
     try:
-        db_cursor.execute(query)
-        result = db_cursor.fetchall() if multiple else db_cursor.fetchone()
+        if db_cursor is None:
+            with pooled_cursor(None if params is None else query) as (_, pool_cursor):
+                result = fetch_results(pool_cursor, query, multiple, params)
+        else:
+            result = fetch_results(db_cursor, query, multiple, params)
         if result is None or (multiple and not return_empty_list and len(result) == 0):
             ret.returnCode = 1
-            log_query(query, False, ret)
+            log_query(query, False, ret, params)
             return ret
         ret.returnValue = result
-        log_query(query)
+        log_query(query, params=params)
     except mysql.connector.Error as err:
-        ret.returnCode = err.errno + errorcode_offset
-        ret.Messages[err.errno + errorcode_offset] = str(err)
-        log_query(query, False, err)
+        ret.returnCode = error_number(err) + errorcode_offset
+        ret.Messages[ret.returnCode] = str(err)
+        log_query(query, False, err, params)
     return ret
 
-def execute_query(db_handle: mysql.connector.MySQLConnection, db_cursor: MySQLCursor, query: str) -> ReturnInfo:
-    ret = ReturnInfo()
+def fetch_results(db_cursor: MySQLCursor, query: str, multiple: bool, params: tuple | None = None) -> list[tuple] | tuple | None:
+    if params is None:
+        db_cursor.execute(query)
+    else:
+        db_cursor.execute(query, params)
+    if multiple:
+        return db_cursor.fetchall()
+    result = db_cursor.fetchone()
+    # The rest of the results has to be read before the cursor can be reused or closed
+    db_cursor.fetchall()
+    return result
+
+# With db_handle and db_cursor set to None, a connection from the pool is used
+def execute_query(db_handle: mysql.connector.MySQLConnection | None, db_cursor: MySQLCursor | None, query: str, params: tuple | None = None) -> ReturnInfo:
+    ret = ReturnInfo(Messages={})
     try:
+        if db_cursor is None:
+            with pooled_cursor(None if params is None else query) as (pool_handle, pool_cursor):
+                run_statement(pool_cursor, query, params)
+                pool_handle.commit()
+        else:
+            run_statement(db_cursor, query, params)
+            db_handle.commit()
+        log_query(query, params=params)
+    except mysql.connector.Error as err:
+        ret.returnCode = error_number(err)
+        ret.Messages[ret.returnCode] = str(err)
+        log_query(query, False, err, params)
+    return ret
+
+def run_statement(db_cursor: MySQLCursor, query: str, params: tuple | None = None):
+    if params is None:
         db_cursor.execute(query)
-        db_handle.commit()
-        log_query(query)
+    else:
+        db_cursor.execute(query, params)
+
+# Runs query once for every tuple in params_list within a single transaction, so either all of them go through or none does
+# An INSERT is sent to the server as a single statement with many rows
+def execute_many(db_handle: mysql.connector.MySQLConnection | None, db_cursor: MySQLCursor | None, query: str, params_list: list[tuple]) -> ReturnInfo:
+    ret = ReturnInfo(Messages={})
+    try:
+        if db_cursor is None:
+            with pooled_cursor() as (pool_handle, pool_cursor):
+                run_transaction(pool_handle, pool_cursor, query, params_list)
+        else:
+            run_transaction(db_handle, db_cursor, query, params_list)
+        log_query(query, params=tuple(params_list))
     except mysql.connector.Error as err:
-        ret.returnCode = err.errno
-        ret.Messages[err.errno] = str(err)
-        log_query(query, False, err)
-    return ret
\ No newline at end of file
+        ret.returnCode = error_number(err)
+        ret.Messages[ret.returnCode] = str(err)
+        log_query(query, False, err, tuple(params_list))
+    return ret
+
+def run_transaction(db_handle: mysql.connector.MySQLConnection, db_cursor: MySQLCursor, query: str, params_list: list[tuple]):
+    if not db_handle.in_transaction:
+        db_handle.start_transaction()
+    try:
+        db_cursor.executemany(query, params_list)
+        db_handle.commit()
+    except mysql.connector.Error:
+        db_handle.rollback()
+        raise
\ No newline at end of file
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from typing import Any, Callable
+from .ReturnInfo import ReturnInfo
+
+executor_types = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor
+}
+
+executor: Executor | None = None
+executor_type = ''
+worker_count = 0
+# Maximum number of jobs waiting for a free worker. 0 means no limit
+queue_size = 0
+# Timeout for a single job in seconds. 0 means no timeout
+job_timeout = 0.
+# Jobs submitted to the executor and not yet finished, running ones included
+pending_jobs = 0
+log_output = None
+
+def setup_render_executor(type_name: str = 'thread', workers: int = 0, max_queue: int = 0, timeout: float = 0., logging_ref: Callable[..., Any] | None = None) -> ReturnInfo:
+    global executor, executor_type, worker_count, queue_size, job_timeout, log_output
+    ret = ReturnInfo(Messages={
+        1: 'Unknown render executor type \"{}\". Possible types: {}'.format(type_name, ', '.join(executor_types.keys()))
+    })
+    if not type_name in executor_types.keys():
+        ret.returnCode = 1
+        return ret
+    shutdown_render_executor()
+    worker_count = workers if workers > 0 else (os.cpu_count() or 1)
+    executor = executor_types[type_name](max_workers=worker_count)
+    executor_type = type_name
+    queue_size = max(0, max_queue)
+    job_timeout = max(0., timeout)
+    log_output = logging_ref
+    log_executor('Render executor started: {} pool with {} workers, queue depth {}, job timeout {}'.format(executor_type, worker_count, queue_size or 'unlimited', '{}s'.format(job_timeout) if job_timeout else 'none'))
+    return ret
+
+def shutdown_render_executor():
+    global executor
+    if executor is None:
+        return
+    executor.shutdown(wait=True, cancel_futures=True)
+    executor = None
+
+def log_executor(message: str, level: int = logging.INFO):
+    if not log_output is None:
+        log_output(message, level)
+
+def get_queue_depth() -> int:
+    return max(0, pending_jobs - worker_count)
+
+def get_render_executor_stats() -> dict[str, int | str]:
+    return {
+        'type': executor_type,
+        'workers': worker_count,
+        'pending_jobs': pending_jobs,
+        'queue_depth': get_queue_depth(),
+        'max_queue_depth': queue_size
+    }
+
+def job_finished(future: asyncio.Future):
+    global pending_jobs
+    pending_jobs -= 1
+    # Marks the exception of a job nobody waits for anymore (timed out) as retrieved
+    if not future.cancelled():
+        future.exception()
+
+# Runs function(*args, **kwargs) on the render executor, or directly if the executor is not set up
+# If the function itself returns ReturnInfo, that ReturnInfo is returned as is. Any other value is put in returnValue
+# Codes are high so they don't clash with codes of the jobs themselves
+async def run_render_job(function: Callable[..., Any], *args, **kwargs) -> ReturnInfo:
+    global pending_jobs
+    job_name = getattr(function, '__name__', str(function))
+    ret = ReturnInfo(Messages={
+        101: 'Render queue is full',
+        102: 'Render job {} timed out'.format(job_name),
+        103: 'Render job {} failed: {{}}'.format(job_name)
+    })
+    try:
+        if executor is None:
+            value = function(*args, **kwargs)
+        else:
+            if queue_size > 0 and get_queue_depth() >= queue_size:
+                log_executor('Render queue is full ({} jobs waiting for {} workers). Rejecting {}'.format(get_queue_depth(), worker_count, job_name), logging.WARNING)
+                ret.returnCode = 101
+                return ret
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(executor, partial(function, *args, **kwargs))
+            pending_jobs += 1
+            future.add_done_callback(job_finished)
+            if get_queue_depth() > 0:
+                log_executor('Render queue depth: {}/{}'.format(get_queue_depth(), queue_size or 'unlimited'))
+            # Shielded so a timed out job still counts as pending until a worker is actually done with it
+            value = await asyncio.wait_for(asyncio.shield(future), job_timeout or None)
+    except asyncio.TimeoutError:
+        log_executor('Render job {} timed out after {}s'.format(job_name, job_timeout), logging.ERROR)
+        ret.returnCode = 102
+        return ret
+    except Exception as err:
+        ret.returnCode = 103
+        ret.format_message(103, err)
+        return ret
+    if isinstance(value, ReturnInfo):
+        return value
+    ret.returnValue = value
+    return ret
\ No newline at end of file
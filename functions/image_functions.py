@@ -1,6 +1,260 @@
 import cv2
 import numpy
+import struct
+from math import ceil, sqrt
+from time import perf_counter
 from .ReturnInfo import ReturnInfo
+from .text_functions import layout_text
+
+# find_biggest_rectangle looks for the candidate region on a mask downscaled so its longer side is at most this many pixels
+pyramid_max_side = 1024
+# Pixels added on every side of the area where a reference image differs from its template
+diff_margin = 8
+# Start of frame markers of JPEG files, the segments holding the size of the image
+jpeg_frame_markers = (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF)
+# Factor an image's size is divided by while decoding -> flag for imdecode
+reduced_decode_flags = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+# Formats encode_for_upload can be asked for
+output_formats = ('auto', 'source', 'png', 'jpg', 'webp')
+# Images with at most this many colors among about flat_sample_pixels sampled pixels are sent as PNG by the auto output format
+flat_image_colors = 1024
+flat_sample_pixels = 65536
+# Lossy formats and the flag setting their quality when encoding
+quality_flags = {
+    'jpg': cv2.IMWRITE_JPEG_QUALITY,
+    'jpeg': cv2.IMWRITE_JPEG_QUALITY,
+    'webp': cv2.IMWRITE_WEBP_QUALITY
+}
+
+# read_image, decode_image and encode_image wrap OpenCV calls so they can be sent to a render executor
+def read_image(filepath: str) -> ReturnInfo:
+    ret = ReturnInfo(Messages={
+        1: 'Unable to read \"{}\" as image'.format(filepath)
+    })
+    image = cv2.imread(filepath)
+    if image is None:
+        ret.returnCode = 1
+        return ret
+    ret.returnValue = image
+    return ret
+
+# The encoded file is read where it is, without copying it
+def decode_image(buffer: bytes | bytearray | memoryview | numpy.ndarray, flags: int = cv2.IMREAD_COLOR) -> ReturnInfo:
+    ret = ReturnInfo(Messages={
+        1: 'Unable to decode the image'
+    })
+    if not isinstance(buffer, numpy.ndarray):
+        buffer = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    image = cv2.imdecode(buffer, flags)
+    if image is None:
+        ret.returnCode = 1
+        return ret
+    ret.returnValue = image
+    return ret
+
+# Width and height from the header of a PNG, JPEG, GIF, BMP or WebP file. None for other formats or a header that can't be read
+def read_image_size(buffer: bytes | bytearray | memoryview) -> tuple[int, int] | None:
+    data = memoryview(buffer).cast('B')
+    try:
+        if data[:8] == b'\x89PNG\r\n\x1a\n':
+            return struct.unpack_from('>II', data, 16)
+        if data[:4] == b'GIF8':
+            return struct.unpack_from('<HH', data, 6)
+        if data[:2] == b'BM':
+            width, height = struct.unpack_from('<ii', data, 18)
+            return (width, abs(height))
+        if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+            chunk = bytes(data[12:16])
+            if chunk == b'VP8 ':
+                width, height = struct.unpack_from('<HH', data, 26)
+                return (width & 0x3FFF, height & 0x3FFF)
+            if chunk == b'VP8L':
+                bits = struct.unpack_from('<I', data, 21)[0]
+                return ((bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1)
+            if chunk == b'VP8X':
+                return (int.from_bytes(data[24:27], 'little') + 1, int.from_bytes(data[27:30], 'little') + 1)
+            return None
+        if data[:2] == b'\xff\xd8':
+            # The size is in the first start of frame segment
+            position = 2
+            while position + 9 < len(data):
+                if data[position] != 0xFF:
+                    return None
+                marker = data[position + 1]
+                if marker == 0xFF:
+                    position += 1
+                    continue
+                if marker in jpeg_frame_markers:
+                    height, width = struct.unpack_from('>HH', data, position + 5)
+                    return (width, height)
+                if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                    position += 2
+                    continue
+                position += 2 + struct.unpack_from('>H', data, position + 2)[0]
+    except struct.error:
+        return None
+    return None
+
+# Decodes an uploaded file straight from the received buffer after checking its size in the header
+# Images over max_pixels (0 means no limit) are decoded at 1/2, 1/4 or 1/8 of their size if allow_reduced is set, otherwise rejected
+# With a limit, formats read_image_size can't read the size of are rejected (code 3), and so is an image decoded bigger than its header said
+# With min_size (width, height), images only needing to cover that many pixels are decoded reduced as long as they still cover them
+# JPEG is decoded at the reduced size directly, other formats are reduced by OpenCV after decoding
+# returnValue is the image and the factor its size was divided by
+def decode_upload(buffer: bytes | bytearray | memoryview, max_pixels: int, allow_reduced: bool, min_size: tuple[int, int] | None = None) -> ReturnInfo:
+    ret = ReturnInfo(Messages={
+        1: 'Unable to decode the image',
+        2: 'The image is too large, at most {} pixels are accepted'.format(max_pixels),
+        3: 'Unable to read the size of the image. Accepted formats are PNG, JPEG, GIF, BMP and WebP'
+    })
+    size = read_image_size(buffer)
+    factor = 1
+    if max_pixels > 0 and size is None:
+        ret.returnCode = 3
+        return ret
+    if not size is None:
+        width, height = size
+        if max_pixels > 0 and width * height > max_pixels:
+            factor = next((option for option in reduced_decode_flags.keys() if option > 1 and width * height <= max_pixels * option * option), 0)
+            if not allow_reduced or factor == 0:
+                ret.returnCode = 2
+                return ret
+        if allow_reduced and not min_size is None:
+            while factor * 2 in reduced_decode_flags.keys() and width // (factor * 2) >= min_size[0] and height // (factor * 2) >= min_size[1]:
+                factor *= 2
+    result = decode_image(buffer, reduced_decode_flags[factor])
+    if not result:
+        return result
+    if max_pixels > 0 and result.returnValue.shape[0] * result.returnValue.shape[1] > max_pixels:
+        ret.returnCode = 2
+        return ret
+    ret.returnValue = (result.returnValue, factor)
+    return ret
+
+# An upload kept as the bytes it was received as, decoded again at the size decode_upload chose for it whenever its pixels are needed
+class EncodedImage():
+    def __init__(self, data: bytes, factor: int = 1):
+        self.data = data
+        self.factor = factor
+
+    def decode(self) -> ReturnInfo:
+        return decode_image(self.data, reduced_decode_flags[self.factor])
+
+    def nbytes(self) -> int:
+        return len(self.data)
+
+# extension is given without a dot, returnValue is the encoded file as bytes
+# quality (1-100) is used by lossy formats listed in quality_flags, 0 leaves the encoder's default
+def encode_image(image: numpy.array, extension: str, quality: int = 0) -> ReturnInfo:
+    ret = ReturnInfo(Messages={
+        1: 'Unable to encode the image as {}'.format(extension)
+    })
+    params = []
+    if quality > 0 and extension.lower() in quality_flags.keys():
+        params = [quality_flags[extension.lower()], min(100, quality)]
+    success, buffer = cv2.imencode('.' + extension, image, params)
+    if not success:
+        ret.returnCode = 1
+        return ret
+    ret.returnValue = buffer.tobytes()
+    return ret
+
+# Whole number an image of image_shape is divided by so that its longer side is at most max_side. 0 means no limit
+# A whole factor makes every pixel of the downscaled image the average of one block of pixels, so parts of it can be downscaled again on their own
+def downscale_factor(image_shape: tuple[int, ...], max_side: int) -> int:
+    if max_side <= 0:
+        return 1
+    return max(1, ceil(max(image_shape[:2]) / max_side))
+
+# Returns the image itself if it's already small enough. Up to factor - 1 pixels at the bottom and at the right are left out
+def downscale_image(image: numpy.ndarray, max_side: int) -> numpy.ndarray:
+    factor = downscale_factor(image.shape, max_side)
+    if factor == 1:
+        return image
+    height = max(1, image.shape[0] // factor)
+    width = max(1, image.shape[1] // factor)
+    return cv2.resize(image[:height * factor, :width * factor], (width, height), interpolation=cv2.INTER_AREA)
+
+# Moves bounds (top, left, down, right) on an image of from_shape to the same place on an image of to_shape, keeping at least one pixel
+def scale_bounds(bounds: tuple[int, int, int, int], from_shape: tuple[int, ...], to_shape: tuple[int, ...]) -> tuple[int, int, int, int]:
+    if from_shape[:2] == to_shape[:2]:
+        return bounds
+    vertical_scale = to_shape[0] / from_shape[0]
+    horizontal_scale = to_shape[1] / from_shape[1]
+    top = min(int(bounds[0] * vertical_scale), to_shape[0] - 1)
+    left = min(int(bounds[1] * horizontal_scale), to_shape[1] - 1)
+    return (top, left, max(top + 1, int(bounds[2] * vertical_scale)), max(left + 1, int(bounds[3] * horizontal_scale)))
+
+# Flat images (drawings, screenshots, text on plain backgrounds) have few distinct colors and stay small and sharp as PNG
+# Colors are counted on a grid of about flat_sample_pixels pixels
+def is_flat_image(image: numpy.ndarray) -> bool:
+    height, width = image.shape[:2]
+    step = max(1, ceil(sqrt(height * width / flat_sample_pixels)))
+    sample = image[::step, ::step].reshape(-1, image.shape[2] if image.ndim == 3 else 1).astype(numpy.uint32)
+    packed = numpy.zeros(len(sample), numpy.uint32)
+    for channel in range(min(4, sample.shape[1])):
+        packed |= sample[:, channel] << (8 * channel)
+    return len(numpy.unique(packed)) <= flat_image_colors
+
+# Encodes an image to be sent, fitting it in max_bytes (0 means no limit)
+# output_format is one of output_formats: auto picks PNG for flat images and lossy_format for others, source keeps extension
+# Lossy formats start at quality and go down to min_quality with a binary search. Lossless output over the budget is encoded as lossy_format
+# If even min_quality is too big, the image is halved until it fits
+# returnValue is a dict: 'data' (bytes), 'extension', 'quality' (0 for lossless), 'factor' the image was divided by and 'seconds' spent
+def encode_for_upload(image: numpy.ndarray, extension: str, output_format: str, quality: int, max_bytes: int, min_quality: int, lossy_format: str) -> ReturnInfo:
+    ret = ReturnInfo(Messages={
+        1: 'Unknown output format \"{}\". Possible formats: {}'.format(output_format, ', '.join(output_formats)),
+        2: 'Unable to fit the image in {} bytes'.format(max_bytes)
+    })
+    start = perf_counter()
+    if not output_format in output_formats:
+        ret.returnCode = 1
+        return ret
+    if output_format == 'auto':
+        extension = 'png' if is_flat_image(image) else lossy_format
+    elif output_format != 'source':
+        extension = output_format
+    factor = 1
+    while True:
+        lossy = extension.lower() in quality_flags.keys()
+        result = encode_image(image, extension, quality if lossy else 0)
+        if not result:
+            return result
+        data = result.returnValue
+        used_quality = quality if lossy else 0
+        if max_bytes <= 0 or len(data) <= max_bytes:
+            break
+        if not lossy:
+            extension = lossy_format
+            continue
+        low = min(min_quality, quality - 1)
+        high = quality - 1
+        best = None
+        while low <= high:
+            middle = (low + high) // 2
+            result = encode_image(image, extension, middle)
+            if not result:
+                return result
+            if len(result.returnValue) <= max_bytes:
+                best = (middle, result.returnValue)
+                low = middle + 1
+            else:
+                high = middle - 1
+        if not best is None:
+            used_quality, data = best
+            break
+        if min(image.shape[:2]) < 2:
+            ret.returnCode = 2
+            return ret
+        image = cv2.resize(image, (image.shape[1] // 2, image.shape[0] // 2), interpolation=cv2.INTER_AREA)
+        factor *= 2
+    ret.returnValue = {'data': data, 'extension': extension, 'quality': used_quality, 'factor': factor, 'seconds': perf_counter() - start}
+    return ret
 
 def get_recommended_font_size(bounds: tuple[int], character_count: int) -> float:
     max_width = bounds[3] - bounds[1]
@@ -9,21 +263,27 @@ def get_recommended_font_size(bounds: tuple[int], character_count: int) -> float
     height_estimated_size = max_height/30.5
     return min(width_estimated_size, height_estimated_size)
 
-def find_biggest_rectangle(image: numpy.array, bgr_color: list[int], hue_range: int, saturation_range: int, value_range: int) -> ReturnInfo:
-    ret = ReturnInfo(Messages={
-        1: 'No color found'
-    })
+# Lower and upper HSV bounds of colors considered the same as bgr_color
+def color_bounds(bgr_color: list[int], hue_range: int, saturation_range: int, value_range: int) -> tuple[numpy.ndarray, numpy.ndarray]:
     hsv_color = numpy.array([[bgr_color]], numpy.uint8)
     hsv_color = cv2.cvtColor(hsv_color, cv2.COLOR_BGR2HSV)
     h, s, v = (int(number) for number in hsv_color[0, 0])
-    hsv_picture = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
     lower_bound = numpy.array([max(0, h - hue_range // 2), max(0, s - saturation_range // 2), max(0, v - value_range // 2)], numpy.uint8)
     upper_bound = numpy.array([min(179, h + hue_range // 2), min(255, s + saturation_range // 2), min(255, v + value_range // 2)], numpy.uint8)
-    binary_mask = cv2.inRange(hsv_picture, lower_bound, upper_bound)
-    contours, hierarchy = cv2.findContours(binary_mask, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+    return lower_bound, upper_bound
+
+def color_mask(image: numpy.array, bgr_color: list[int], hue_range: int, saturation_range: int, value_range: int) -> numpy.ndarray:
+    hsv_picture = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    return cv2.inRange(hsv_picture, *color_bounds(bgr_color, hue_range, saturation_range, value_range))
+
+def find_biggest_region(binary_mask: numpy.ndarray) -> tuple[float, numpy.ndarray] | None:
+    return biggest_region_of_contours(*cv2.findContours(binary_mask, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE))
+
+# Area of a region is the area of its outer contour minus the areas of its holes. Returns (area, contour) of the biggest region or None
+# Expects contours and hierarchy of cv2.findContours with RETR_CCOMP
+def biggest_region_of_contours(contours: tuple[numpy.ndarray, ...], hierarchy: numpy.ndarray | None) -> tuple[float, numpy.ndarray] | None:
     if len(contours) == 0 or hierarchy is None:
-        ret.returnCode = 1
-        return ret
+        return None
     hierarchy = hierarchy[0]
     biggest_area = 0
     biggest_contour = None
@@ -39,61 +299,205 @@ def find_biggest_rectangle(image: numpy.array, bgr_color: list[int], hue_range:
             biggest_area = area
             biggest_contour = contours[i]
     if biggest_contour is None:
+        return None
+    return biggest_area, biggest_contour
+
+# Finds the biggest region on a downscaled mask, then looks for it again at full resolution only inside that region's surroundings (ROI)
+# A region's area is always lower than its pixel count, which gives an upper bound for regions the ROI doesn't fully contain:
+# their pixels outside the ROI plus the bounding boxes of their parts touching the ROI's edge (unless it's the edge of the image)
+# The ROI result is used only when the region found doesn't touch the edge and that bound is not above its area, so it's the same as the full search
+# Otherwise returns None and the whole mask has to be searched
+def find_biggest_region_pyramid(binary_mask: numpy.ndarray) -> tuple[float, numpy.ndarray] | None:
+    height, width = binary_mask.shape
+    factor = ceil(max(height, width) / pyramid_max_side)
+    if factor < 2:
+        return None
+    small_mask = cv2.resize(binary_mask, (ceil(width / factor), ceil(height / factor)), interpolation=cv2.INTER_LINEAR)
+    # Keeps blocks where most of the sampled pixels match, so noise does not join with the region
+    _, small_mask = cv2.threshold(small_mask, 127, 255, cv2.THRESH_BINARY)
+    candidate = find_biggest_region(small_mask)
+    if candidate is None:
+        return None
+    x, y, w, h = cv2.boundingRect(candidate[1])
+    margin = 2 * factor
+    top = max(0, y * factor - margin)
+    left = max(0, x * factor - margin)
+    bottom = min(height, (y + h) * factor + margin)
+    right = min(width, (x + w) * factor + margin)
+    roi = binary_mask[top:bottom, left:right]
+    contours, hierarchy = cv2.findContours(roi, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE, offset=(left, top))
+    region = biggest_region_of_contours(contours, hierarchy)
+    if region is None:
+        return None
+    bound = cv2.countNonZero(binary_mask) - cv2.countNonZero(roi)
+    for i in range(len(contours)):
+        if hierarchy[0][i][3] != -1:
+            continue
+        x, y, w, h = cv2.boundingRect(contours[i])
+        if (top > 0 and y == top) or (left > 0 and x == left) or (bottom < height and y + h == bottom) or (right < width and x + w == right):
+            if contours[i] is region[1]:
+                return None
+            bound += w * h
+    if bound > region[0]:
+        return None
+    return region
+
+# With pyramid set, a big image is searched with find_biggest_region_pyramid first. The result is the same either way
+def find_biggest_rectangle(image: numpy.array, bgr_color: list[int], hue_range: int, saturation_range: int, value_range: int, pyramid: bool = True) -> ReturnInfo:
+    ret = ReturnInfo(Messages={
+        1: 'No color found'
+    })
+    binary_mask = color_mask(image, bgr_color, hue_range, saturation_range, value_range)
+    region = find_biggest_region_pyramid(binary_mask) if pyramid else None
+    if region is None:
+        region = find_biggest_region(binary_mask)
+    if region is None:
         ret.returnCode = 1
         return ret
-    rect = cv2.boundingRect(biggest_contour)
+    rect = cv2.boundingRect(region[1])
     #format it to (top, left, down, right)
     rect = (rect[1], rect[0], rect[1] + rect[3], rect[0] + rect[2])
     ret.returnValue = rect
     return ret
 
-# size_rect is a rectangle containing locations for second image to appear in the first: (Y inital, X initial, Y final, X final)
-def insert_image_into_image(Image_background: numpy.array, Image_element: numpy.array, size_rect: tuple[int, int, int, int]) -> ReturnInfo:
-    y_initial = size_rect[0]
-    x_initial = size_rect[1]
-    y_final = size_rect[2]
-    x_final = size_rect[3]
+# Bounding box (top, left, down, right) of the part of reference that differs from template by more than threshold in any channel, widened by diff_margin
+# Both images are compared sampled down to at most pyramid_max_side pixels, so regions narrower than 3 samples are not seen
+# Returns None if the images differ in size or nothing changed
+def find_changed_area(template: numpy.ndarray, reference: numpy.ndarray, threshold: int) -> tuple[int, int, int, int] | None:
+    if template.shape != reference.shape or template.dtype != reference.dtype:
+        return None
+    height, width = reference.shape[:2]
+    factor = ceil(max(height, width) / pyramid_max_side)
+    if factor > 1:
+        small_size = (ceil(width / factor), ceil(height / factor))
+        template = cv2.resize(template, small_size, interpolation=cv2.INTER_NEAREST)
+        reference = cv2.resize(reference, small_size, interpolation=cv2.INTER_NEAREST)
+    difference = cv2.absdiff(template, reference)
+    channels = difference.shape[2:]
+    unchanged = cv2.inRange(difference, numpy.zeros(channels, numpy.uint8), numpy.full(channels, threshold, numpy.uint8))
+    # Single pixels changed by lossy compression are not a painted region
+    changed = cv2.erode(cv2.bitwise_not(unchanged), numpy.ones((3, 3), numpy.uint8))
+    x, y, w, h = cv2.boundingRect(changed)
+    if w == 0 or h == 0:
+        return None
+    # Erosion took one sample off every side of the area
+    margin = 2 * factor + diff_margin
+    return (max(0, y * factor - margin), max(0, x * factor - margin), min(height, (y + h) * factor + margin), min(width, (x + w) * factor + margin))
+
+# A reference image is the template with the field painted over, so the color is only looked for where the two differ
+# Falls back to searching the whole reference when the sizes don't match or nothing changed
+def find_changed_rectangle(template: numpy.ndarray, reference: numpy.ndarray, bgr_color: list[int], hue_range: int, saturation_range: int, value_range: int, threshold: int) -> ReturnInfo:
+    area = find_changed_area(template, reference, threshold)
+    if area is None:
+        return find_biggest_rectangle(reference, bgr_color, hue_range, saturation_range, value_range)
+    top, left, down, right = area
+    result = find_biggest_rectangle(reference[top:down, left:right], bgr_color, hue_range, saturation_range, value_range)
+    if not result:
+        return result
+    rect_top, rect_left, rect_down, rect_right = result.returnValue
+    result.returnValue = (rect_top + top, rect_left + left, rect_down + top, rect_right + left)
+    return result
+
+# Finds every region filled with one of bgr_colors, converting the image to HSV once and labelling each color's mask once
+# Regions smaller than min_area pixels are skipped as noise. returnValue is a list of (index of the color, (top, left, down, right))
+# ordered by color, then by rows from top to bottom and from left to right in each row
+# Regions whose vertical spans overlap are in the same row, so fields drawn a few pixels apart on one line keep their left to right order
+# With template given, only the area where the image differs from it is searched, unless their sizes don't match
+def find_all_rectangles(image: numpy.array, bgr_colors: list[list[int]], hue_range: int, saturation_range: int, value_range: int, min_area: int = 0, template: numpy.ndarray | None = None, threshold: int = 0) -> ReturnInfo:
     ret = ReturnInfo(Messages={
-        1: 'Incorrect size of the target area',
-        2: 'Image array is empty'
+        1: 'No color found'
     })
-    if y_initial < 0 or x_initial < 0:
+    area = None if template is None else find_changed_area(template, image, threshold)
+    top, left = 0, 0
+    if not area is None:
+        top, left, down, right = area
+        image = image[top:down, left:right]
+    hsv_picture = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    rectangles = []
+    for color_index, bgr_color in enumerate(bgr_colors):
+        binary_mask = cv2.inRange(hsv_picture, *color_bounds(bgr_color, hue_range, saturation_range, value_range))
+        count, _, stats, _ = cv2.connectedComponentsWithStats(binary_mask, connectivity=8)
+        # Label 0 is the background
+        regions = [stats[label] for label in range(1, count) if stats[label][cv2.CC_STAT_AREA] >= max(1, min_area)]
+        regions.sort(key=lambda region: region[cv2.CC_STAT_TOP])
+        rows = []
+        row_down = -1
+        for region in regions:
+            region_down = region[cv2.CC_STAT_TOP] + region[cv2.CC_STAT_HEIGHT]
+            if len(rows) == 0 or region[cv2.CC_STAT_TOP] >= row_down:
+                rows.append([])
+                row_down = region_down
+            rows[-1].append(region)
+            row_down = max(row_down, region_down)
+        regions = [region for row in rows for region in sorted(row, key=lambda region: region[cv2.CC_STAT_LEFT])]
+        for region in regions:
+            x, y, w, h = (int(number) for number in region[:4])
+            rectangles.append((color_index, (y + top, x + left, y + top + h, x + left + w)))
+    if len(rectangles) == 0:
         ret.returnCode = 1
         return ret
+    ret.returnValue = rectangles
+    return ret
+
+# Returns the buffer a drawing function should write into: a fresh copy of the image, the image itself (in place) or a caller-owned buffer of the same shape
+def prepare_output_image(image: numpy.array, output_image: numpy.ndarray | None = None) -> numpy.ndarray | None:
+    if output_image is None:
+        return numpy.copy(image)
+    if output_image.shape != image.shape or output_image.dtype != image.dtype:
+        return None
+    if output_image is not image:
+        numpy.copyto(output_image, image)
+    return output_image
+
+# Resizes Image_element to the whole size_rect (inclusive like in insert_image_into_image) and cuts off what falls outside of an image of image_shape
+# Returns the visible rectangle (top, left, down, right), down and right excluded, and its pixels. None if no part of the rectangle is visible
+def resize_into_rectangle(Image_element: numpy.array, size_rect: tuple[int, int, int, int], image_shape: tuple[int, ...]) -> tuple[tuple[int, int, int, int], numpy.ndarray] | None:
+    y_initial, x_initial, y_final, x_final = size_rect
+    top = max(y_initial, 0)
+    left = max(x_initial, 0)
+    bottom = min(y_final, image_shape[0] - 1)
+    right = min(x_final, image_shape[1] - 1)
+    if y_final < y_initial or x_final < x_initial or top > bottom or left > right:
+        return None
+    inserting_image = cv2.resize(Image_element, (x_final - x_initial + 1, y_final - y_initial + 1), interpolation=cv2.INTER_LINEAR)
+    return (top, left, bottom + 1, right + 1), inserting_image[top - y_initial:bottom - y_initial + 1, left - x_initial:right - x_initial + 1]
+
+# size_rect is a rectangle containing locations for second image to appear in the first: (Y inital, X initial, Y final, X final)
+# Parts of the rectangle outside of the background are clipped. The element is resized to the whole rectangle and written with a single slice assignment
+# If output_image is given, the result is written into it instead of a new copy. Passing the background itself as output_image composites in place
+def insert_image_into_image(Image_background: numpy.array, Image_element: numpy.array, size_rect: tuple[int, int, int, int], output_image: numpy.ndarray | None = None) -> ReturnInfo:
+    ret = ReturnInfo(Messages={
+        1: 'Incorrect size of the target area',
+        2: 'Image array is empty',
+        3: 'Output image does not match the background'
+    })
     background_height, background_width, _ = Image_background.shape
     if not all((background_height, background_width)):
         ret.returnCode = 2
         return ret
-    if y_final >= background_height or x_final >= background_width:
+    visible_part = resize_into_rectangle(Image_element, size_rect, Image_background.shape)
+    if visible_part is None:
         ret.returnCode = 1
         return ret
-    inserting_image = cv2.resize(Image_element, (x_final - x_initial + 1, y_final - y_initial + 1), interpolation=cv2.INTER_LINEAR)
-    returnImage = numpy.copy(Image_background)
-    for y in range(y_initial, y_final + 1):
-        for x in range(x_initial, x_final + 1):
-            returnImage[y][x] = inserting_image[y - y_initial][x - x_initial]
+    returnImage = prepare_output_image(Image_background, output_image)
+    if returnImage is None:
+        ret.returnCode = 3
+        return ret
+    (top, left, bottom, right), inserted_part = visible_part
+    returnImage[top:bottom, left:right] = inserted_part
     ret.returnValue = returnImage
     return ret
 
-def wrap_text(text: str, max_width: int, font: int | float, font_scale: int, thickness: int) -> list[str]:
-    words = text.split(' ')
-    word_lines = []
-    current_line = words[0]
-    for word in words[1:]:
-        (current_width, _), _ = cv2.getTextSize(current_line + ' ' + word, font, font_scale, thickness)
-        if current_width <= max_width:
-            current_line += ' ' + word
-        else:
-            word_lines.append(current_line)
-            current_line = word
-    word_lines.append(current_line)
-    return word_lines
-
-def write_on_image(image: numpy.array, text: str, font: int, font_scale: int | float, color: tuple[int, int, int], thickness: int, line_type: int, textarea: tuple[int, int, int, int]) -> ReturnInfo:
+def wrap_text(text: str, max_width: int, font: int, font_scale: int | float, thickness: int) -> list[str]:
+    return layout_text(text, max_width, font, font_scale, thickness).lines
+
+# If output_image is given, the text is written into it instead of a new copy. Passing the image itself as output_image writes in place
+def write_on_image(image: numpy.array, text: str, font: int, font_scale: int | float, color: tuple[int, int, int], thickness: int, line_type: int, textarea: tuple[int, int, int, int], output_image: numpy.ndarray | None = None) -> ReturnInfo:
     ret = ReturnInfo(okCodes=[0, 1], Messages={
         1: 'The bounding box is too small to contain all text. Consider lowering the font scale.',
         2: 'The textarea is not correct',
-        3: 'Image array is empty'
+        3: 'Image array is empty',
+        4: 'Output image does not match the image'
     })
     image_height, image_width, _ = image.shape
     if not all((image_height, image_width)):
@@ -103,33 +507,36 @@ def write_on_image(image: numpy.array, text: str, font: int, font_scale: int | f
     if any(number < 0 for number in textarea) or textarea[0] >= textarea[2] or textarea[1] >= textarea[3] or textarea[2] > image_height or textarea[3] > image_width:
         ret.returnCode = 2
         return ret
-    return_image = numpy.copy(image)
-    (_, text_height), baseline = cv2.getTextSize(text, font, font_scale, thickness)
-    text_height += baseline
-    lines = wrap_text(text, textarea[3] - textarea[1], font, font_scale, thickness)
-    current_height = textarea[0] + text_height - baseline
-    for line in lines:
-        cv2.putText(return_image, line, (textarea[1], current_height), font, font_scale, color, thickness, line_type)
-        current_height += text_height
-    if current_height > textarea[2]:
+    return_image = prepare_output_image(image, output_image)
+    if return_image is None:
+        ret.returnCode = 4
+        return ret
+    layout = layout_text(text, textarea[3] - textarea[1], font, font_scale, thickness)
+    layout.draw(return_image, textarea[0], textarea[1], color, line_type)
+    if layout.required_height() > textarea[2] - textarea[0]:
         ret.returnCode = 1
     ret.returnValue = return_image
     return ret
 
-def show_fields(image: numpy.array, field_coordinates: list[tuple[int, int, int, int]], field_names: list[str], color: tuple[int, int, int] = (255, 0, 0)) -> ReturnInfo:
+# If output_image is given, the fields are drawn into it instead of a new copy
+def show_fields(image: numpy.array, field_coordinates: list[tuple[int, int, int, int]], field_names: list[str], color: tuple[int, int, int] = (255, 0, 0), output_image: numpy.ndarray | None = None) -> ReturnInfo:
     thickness = 2
-    field_image = numpy.copy(image)
-    ret = ReturnInfo()
+    ret = ReturnInfo(Messages={
+        1: 'Output image does not match the image'
+    })
+    field_image = prepare_output_image(image, output_image)
+    if field_image is None:
+        ret.returnCode = 1
+        return ret
     for i in range(len(field_coordinates)):
         pt1 = (field_coordinates[i][1], field_coordinates[i][0])
         pt2 = (field_coordinates[i][3], field_coordinates[i][2])
         cv2.rectangle(field_image, pt1, pt2, color, thickness)
         estimated_size = get_recommended_font_size(field_coordinates[i], len(field_names[i]))
         linetype = cv2.LINE_8 if estimated_size > 0.7 else cv2.LINE_4
-        result = write_on_image(field_image, field_names[i], cv2.FONT_HERSHEY_SIMPLEX, estimated_size, color, thickness, linetype, field_coordinates[i])
+        result = write_on_image(field_image, field_names[i], cv2.FONT_HERSHEY_SIMPLEX, estimated_size, color, thickness, linetype, field_coordinates[i], field_image)
         if not result:
             return result
-        field_image = result.returnValue
     ret.returnValue = field_image
     return ret
 
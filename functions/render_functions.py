@@ -0,0 +1,256 @@
+import cv2
+import numpy
+from math import ceil
+from typing import Any
+from .ReturnInfo import ReturnInfo
+from .image_functions import resize_into_rectangle, EncodedImage, scale_bounds, show_fields
+from .text_functions import layout_text
+
+# Fields of a template in use are dicts with 'type', 'bounds', 'value', 'updated' and 'layer'. Values of image fields can be kept as EncodedImage
+# layer is the field's value rasterized once (FieldLayer), None until the field is filled or after its value changed
+# updated tells whether the layer is on the session's image. A changed field only brings back its own part of the template,
+# every field overlapping what gets restored or drawn is drawn again from its layer, and the rest of the image is left as it is
+
+def clip_rectangle(rectangle: tuple[int, int, int, int], image_shape: tuple[int, ...]) -> tuple[int, int, int, int]:
+    top, left, down, right = rectangle
+    return (max(0, top), max(0, left), min(image_shape[0], down), min(image_shape[1], right))
+
+def rectangles_overlap(first: tuple[int, int, int, int], second: tuple[int, int, int, int]) -> bool:
+    return first[0] < second[2] and second[0] < first[2] and first[1] < second[3] and second[1] < first[3]
+
+# Pixels a field puts on the image within extent (top, left, down, right), down and right excluded
+# Without mask every pixel of the extent is replaced by pixels, otherwise only pixels under the mask are, pixels being a single color then
+class FieldLayer():
+    def __init__(self, extent: tuple[int, int, int, int], pixels: numpy.ndarray, mask: numpy.ndarray | None = None):
+        self.extent = extent
+        self.pixels = pixels
+        self.mask = mask
+
+    def apply(self, image: numpy.ndarray):
+        top, left, down, right = self.extent
+        if self.mask is None:
+            image[top:down, left:right] = self.pixels
+        else:
+            numpy.copyto(image[top:down, left:right], self.pixels, where=self.mask)
+
+    def nbytes(self) -> int:
+        return self.pixels.nbytes + (0 if self.mask is None else self.mask.nbytes)
+
+# Draws the field's value into a layer covering only the part of an image of image_shape it changes
+# Applying the layer gives the same pixels as write_on_image or insert_image_into_image on that image
+# Code 1 (ok) means the text doesn't fit its field, the layer is still made
+def rasterize_field(field_type: str, bounds: tuple[int, int, int, int], value: Any, image_shape: tuple[int, ...], thickness: int, line_type: int) -> ReturnInfo:
+    ret = ReturnInfo(okCodes=[0, 1], Messages={
+        1: 'The bounding box is too small to contain all text. Consider lowering the font scale.',
+        2: 'Incorrect size of the target area',
+        3: 'Unable to decode the image'
+    })
+    top, left, down, right = bounds
+    if field_type == 'image':
+        if isinstance(value, EncodedImage):
+            result = value.decode()
+            if not result:
+                ret.returnCode = 3
+                return ret
+            value = result.returnValue
+        visible_part = resize_into_rectangle(value, bounds, image_shape)
+        if visible_part is None:
+            ret.returnCode = 2
+            return ret
+        ret.returnValue = FieldLayer(*visible_part)
+        return ret
+    if any(number < 0 for number in bounds) or top >= down or left >= right or down > image_shape[0] or right > image_shape[1]:
+        ret.returnCode = 2
+        return ret
+    text, font, font_scale, color = value
+    layout = layout_text(text, right - left, font, font_scale, thickness)
+    extent = clip_rectangle(layout.extent(top, left), image_shape)
+    mask = numpy.zeros((extent[2] - extent[0], extent[3] - extent[1]), numpy.uint8)
+    layout.draw(mask, top - extent[0], left - extent[1], (255,), line_type)
+    ret.returnValue = FieldLayer(extent, numpy.array(color, numpy.uint8), (mask > 0)[..., None])
+    if layout.required_height() > down - top:
+        ret.returnCode = 1
+    return ret
+
+# The template with layers of filled fields on top, composited into a single image allocated once per session
+# base is the template shared with other sessions and is never written to
+# preview_base is a copy of base made by downscale_image (also never written to). The session then keeps its own downscaled copy of image
+# for previews, refreshed only where image changed since the last preview. Without it previews are made from image itself
+# release drops every array, including references to base and preview_base, until attach is called again. shape stays known meanwhile
+# Copying base and compositing are full-size array work, so the session's own copies are only made by prepare, which composite and
+# get_preview_image call, and those are meant to run as render jobs (see render_layered_image). Until then image is None and base is shown
+class LayeredImage():
+    def __init__(self, base: numpy.ndarray, preview_base: numpy.ndarray | None = None):
+        self.shape = base.shape
+        self.attach(base, preview_base)
+
+    # Starts again from base, fields have to be composited again after it. Nothing is copied until prepare
+    def attach(self, base: numpy.ndarray, preview_base: numpy.ndarray | None = None):
+        self.base = base
+        self.preview_base = preview_base
+        self.image = None
+        self.preview_image = None
+        self.preview_factor = 1 if preview_base is None else round(max(base.shape[:2]) / max(preview_base.shape[:2]))
+        # Rectangles of image changed since preview_image was last refreshed
+        self.changed_areas = []
+        # Reused for previews with field outlines drawn on top, allocated when first needed
+        self.preview_buffer = None
+
+    # Makes the session's own copies of base and preview_base if they aren't made yet
+    def prepare(self):
+        if self.image is None:
+            self.image = self.base.copy()
+            self.preview_image = None if self.preview_base is None else self.preview_base.copy()
+            self.changed_areas = []
+
+    def release(self):
+        self.base = None
+        self.preview_base = None
+        self.image = None
+        self.preview_image = None
+        self.changed_areas = []
+        self.preview_buffer = None
+
+    def is_released(self) -> bool:
+        return self.base is None
+
+    # The image as it is now, base itself while nothing was composited yet
+    def current_image(self) -> numpy.ndarray:
+        return self.base if self.image is None else self.image
+
+    # Takes the arrays of a copy the job ran on, which with a process pool is not the session's own LayeredImage
+    def update_from(self, other: 'LayeredImage'):
+        if other is self:
+            return
+        self.image = other.image
+        self.preview_image = other.preview_image
+        self.changed_areas = other.changed_areas
+        self.preview_buffer = other.preview_buffer
+
+    def mark_changed(self, extent: tuple[int, int, int, int]):
+        if not self.preview_image is None:
+            self.changed_areas.append(extent)
+
+    # Nothing to restore while image isn't copied from base yet
+    def restore(self, extent: tuple[int, int, int, int]):
+        if self.image is None:
+            return
+        top, left, down, right = extent
+        self.image[top:down, left:right] = self.base[top:down, left:right]
+        self.mark_changed(extent)
+
+    # Applies layers in the given order. With full set, the whole image is first brought back to the template
+    def composite(self, layers: list[FieldLayer], full: bool = False) -> numpy.ndarray:
+        self.prepare()
+        if full:
+            numpy.copyto(self.image, self.base)
+            self.mark_changed((0, 0, self.image.shape[0], self.image.shape[1]))
+        for layer in layers:
+            layer.apply(self.image)
+            self.mark_changed(layer.extent)
+        return self.image
+
+    # Downscales the changed rectangles again, each widened to whole blocks of preview_factor pixels
+    # The result is the same as downscaling the whole image
+    def get_preview_image(self) -> numpy.ndarray:
+        self.prepare()
+        if self.preview_image is None:
+            return self.image
+        factor = self.preview_factor
+        preview_height, preview_width = self.preview_image.shape[:2]
+        for top, left, down, right in self.changed_areas:
+            preview_top = top // factor
+            preview_left = left // factor
+            preview_down = min(preview_height, ceil(down / factor))
+            preview_right = min(preview_width, ceil(right / factor))
+            if preview_top >= preview_down or preview_left >= preview_right:
+                continue
+            source = self.image[preview_top * factor:preview_down * factor, preview_left * factor:preview_right * factor]
+            self.preview_image[preview_top:preview_down, preview_left:preview_right] = cv2.resize(source, (preview_right - preview_left, preview_down - preview_top), interpolation=cv2.INTER_AREA)
+        self.changed_areas = []
+        return self.preview_image
+
+    def get_preview_buffer(self) -> numpy.ndarray:
+        preview_image = self.get_preview_image()
+        if self.preview_buffer is None or self.preview_buffer.shape != preview_image.shape:
+            self.preview_buffer = numpy.empty_like(preview_image)
+        return self.preview_buffer
+
+    def nbytes(self) -> int:
+        image_bytes = 0 if self.image is None else self.image.nbytes
+        preview_bytes = 0 if self.preview_image is None else self.preview_image.nbytes
+        return image_bytes + preview_bytes + (0 if self.preview_buffer is None else self.preview_buffer.nbytes)
+
+# Render job compositing layers into the session's image (see LayeredImage.composite) and, with bounds given, bringing its preview up to date
+# and drawing outlines of fields at bounds (on the full-size image) on it in the preview buffer, all in one job
+# returnValue is (the LayeredImage, pass it to update_from, the preview with outlines or None without bounds)
+def render_layered_image(layered_image: LayeredImage, layers: list[FieldLayer], bounds: list[tuple[int, int, int, int]] | None = None, names: list[str] | None = None) -> ReturnInfo:
+    ret = ReturnInfo()
+    layered_image.composite(layers)
+    preview = None
+    if not bounds is None:
+        preview_image = layered_image.get_preview_image()
+        preview_bounds = [scale_bounds(field_bounds, layered_image.shape, preview_image.shape) for field_bounds in bounds]
+        result = show_fields(preview_image, preview_bounds, names, output_image=layered_image.get_preview_buffer())
+        if not result:
+            return result
+        preview = result.returnValue
+    ret.returnValue = (layered_image, preview)
+    return ret
+
+# Bytes a template in use keeps: (arrays that can be released and rebuilt, field values that have to be kept)
+# The shared template itself isn't counted
+def session_nbytes(layered_image: LayeredImage, fields: dict[str, dict[str, Any]]) -> tuple[int, int]:
+    working_bytes = layered_image.nbytes()
+    value_bytes = 0
+    for field in fields.values():
+        if not field.get('layer') is None:
+            working_bytes += field['layer'].nbytes()
+        value = field['value']
+        if isinstance(value, EncodedImage):
+            value_bytes += value.nbytes()
+        elif isinstance(value, numpy.ndarray):
+            value_bytes += value.nbytes
+    return working_bytes, value_bytes
+
+# Drops the session's image and every field's layer, keeping only field values. Returns the number of bytes released
+# After it the image has to be attached again and every filled field rasterized and composited again, which fields_to_render then gives
+def release_layers(layered_image: LayeredImage, fields: dict[str, dict[str, Any]]) -> int:
+    released_bytes = session_nbytes(layered_image, fields)[0]
+    layered_image.release()
+    for field in fields.values():
+        field['layer'] = None
+        field['updated'] = False
+    return released_bytes
+
+# Called after the field's value changed. Restores the part of the image its old layer covered
+# and marks drawn fields overlapping it to be drawn again. Returns the restored rectangle, None if the field had no layer
+# A released image has nothing to restore, every field is drawn again once it's attached
+def invalidate_field(layered_image: LayeredImage, fields: dict[str, dict[str, Any]], field_name: str) -> tuple[int, int, int, int] | None:
+    field = fields[field_name]
+    old_layer = field.get('layer')
+    field['layer'] = None
+    field['updated'] = False
+    if old_layer is None or layered_image.is_released():
+        return None
+    layered_image.restore(old_layer.extent)
+    for other_field in fields.values():
+        if not other_field.get('layer') is None and rectangles_overlap(old_layer.extent, other_field['layer'].extent):
+            other_field['updated'] = False
+    return old_layer.extent
+
+# Names of fields whose layers have to be applied: fields with a layer not on the image yet and fields on the image overlapping any of them,
+# repeated until nothing is added. Applying a layer again doesn't change the parts of the image it already covered
+def fields_to_render(fields: dict[str, dict[str, Any]]) -> list[str]:
+    pending = [field_name for field_name, field in fields.items() if not field.get('layer') is None and not field['updated']]
+    checked = 0
+    while checked < len(pending):
+        extent = fields[pending[checked]]['layer'].extent
+        checked += 1
+        for field_name, field in fields.items():
+            if field_name in pending or field.get('layer') is None:
+                continue
+            if rectangles_overlap(extent, field['layer'].extent):
+                field['updated'] = False
+                pending.append(field_name)
+    return [field_name for field_name in fields.keys() if field_name in pending]
\ No newline at end of file
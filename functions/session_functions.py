@@ -0,0 +1,176 @@
+import asyncio
+from collections import OrderedDict
+from math import ceil
+from typing import Any, Callable, Hashable, Iterator
+
+# Templates in use keyed by user id, kept from least to most recently used, with a budget for the memory they take
+# size_function gives the bytes a session takes, release_function drops what can be rebuilt from disk and returns the number of bytes freed
+# Under pressure least recently used sessions are released first, a new session is refused only if the budget is exceeded even then
+# A max_bytes of 0 means no limit. Sessions are only used from the event loop, so unlike LRUCache there is no lock
+class SessionManager():
+    def __init__(self, max_bytes: int = 0, size_function: Callable[[Any], int] = lambda _: 0, release_function: Callable[[Any], int] = lambda _: 0):
+        self.max_bytes = max_bytes
+        self.size_function = size_function
+        self.release_function = release_function
+        self.sessions = OrderedDict()
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.refusals = 0
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.sessions
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(self.sessions)
+
+    def __getitem__(self, key: Hashable) -> Any:
+        return self.sessions[key]
+
+    # A new or replaced session counts as the most recently used one
+    def __setitem__(self, key: Hashable, session: Any):
+        self.sessions[key] = session
+        self.sessions.move_to_end(key)
+
+    def __delitem__(self, key: Hashable):
+        del self.sessions[key]
+
+    def keys(self):
+        return self.sessions.keys()
+
+    def values(self):
+        return self.sessions.values()
+
+    def items(self):
+        return self.sessions.items()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        return self.sessions.get(key, default)
+
+    def pop(self, key: Hashable, *default: Any) -> Any:
+        return self.sessions.pop(key, *default)
+
+    def touch(self, key: Hashable):
+        if key in self.sessions:
+            self.sessions.move_to_end(key)
+
+    # Sizes change as fields are filled, rasterized and released, so they are added up when needed
+    def current_bytes(self) -> int:
+        return sum(self.size_function(session) for session in self.sessions.values())
+
+    # Releases sessions other than protected, least recently used first, until needed_bytes more fit in the budget
+    # Returns False if they still don't fit once every other session was released
+    def make_room(self, needed_bytes: int, protected: Hashable | None = None) -> bool:
+        if self.max_bytes <= 0:
+            return True
+        used_bytes = self.current_bytes()
+        for key, session in list(self.sessions.items()):
+            if used_bytes + needed_bytes <= self.max_bytes:
+                break
+            if key == protected:
+                continue
+            released_bytes = self.release_function(session)
+            if released_bytes > 0:
+                used_bytes -= released_bytes
+                self.evictions += 1
+                self.evicted_bytes += released_bytes
+        return used_bytes + needed_bytes <= self.max_bytes
+
+    # Same as make_room for a session about to be added, counting it as refused if it doesn't fit
+    def admit(self, needed_bytes: int) -> bool:
+        if self.make_room(needed_bytes):
+            return True
+        self.refusals += 1
+        return False
+
+    def resize(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.make_room(0)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'sessions': len(self.sessions),
+            'bytes': self.current_bytes(),
+            'max_bytes': self.max_bytes,
+            'evictions': self.evictions,
+            'evicted_bytes': self.evicted_bytes,
+            'refusals': self.refusals
+        }
+
+def format_session_manager_stats(stats: dict[str, int]) -> str:
+    return 'Sessions: {} in use, {}/{} bytes, {} evictions ({} bytes released), {} refused'.format(stats['sessions'], stats['bytes'], stats['max_bytes'] or 'unlimited', stats['evictions'], stats['evicted_bytes'], stats['refusals'])
+
+# Calls callbacks after a delay from a single task, running only while there are timers. Timers are kept by key in the slots of a hashed wheel
+# turning one slot per tick, so adding, replacing and cancelling one takes the same time however many there are
+# A callback is called between delay and delay + tick seconds after it was scheduled, with loop.call_soon so it can't stop the wheel
+class TimerWheel():
+    def __init__(self, tick: float = 1., slot_count: int = 512):
+        self.tick = tick
+        # Each slot maps keys to (turns of the wheel left, callback, arguments)
+        self.slots = [{} for _ in range(slot_count)]
+        # key -> index of the slot holding its timer
+        self.timers = {}
+        self.position = 0
+        self.next_tick_time = 0.
+        self.task = None
+
+    def __len__(self) -> int:
+        return len(self.timers)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.timers
+
+    # Replaces the timer with the same key if there is one. Has to be called from the event loop
+    def schedule(self, key: Hashable, delay: float, callback: Callable[..., Any], *args: Any):
+        self.cancel(key)
+        loop = asyncio.get_running_loop()
+        if self.task is None:
+            self.next_tick_time = loop.time() + self.tick
+            self.task = loop.create_task(self.run())
+        # The first tick is at most one tick away, so one more tick makes sure the callback is never early
+        ticks = max(0, ceil(delay / self.tick)) + 1
+        slot = (self.position + ticks) % len(self.slots)
+        self.slots[slot][key] = ((ticks - 1) // len(self.slots), callback, args)
+        self.timers[key] = slot
+
+    # Returns False if there was no timer with this key
+    def cancel(self, key: Hashable) -> bool:
+        slot = self.timers.pop(key, None)
+        if slot is None:
+            return False
+        del self.slots[slot][key]
+        return True
+
+    def advance(self):
+        self.position = (self.position + 1) % len(self.slots)
+        slot = self.slots[self.position]
+        loop = asyncio.get_running_loop()
+        for key, (turns, callback, args) in list(slot.items()):
+            if turns > 0:
+                slot[key] = (turns - 1, callback, args)
+                continue
+            del slot[key]
+            del self.timers[key]
+            loop.call_soon(callback, *args)
+
+    # Ticks missed while the loop was busy are caught up at once
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self.timers:
+                await asyncio.sleep(max(0., self.next_tick_time - loop.time()))
+                while self.timers and self.next_tick_time <= loop.time():
+                    self.advance()
+                    self.next_tick_time += self.tick
+        finally:
+            self.task = None
+
+    def stop(self):
+        if not self.task is None:
+            self.task.cancel()
+            self.task = None
+        for slot in self.slots:
+            slot.clear()
+        self.timers.clear()
\ No newline at end of file
@@ -0,0 +1,199 @@
+import asyncio
+import json
+import sqlite3
+import struct
+import cv2
+import numpy
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from .ReturnInfo import ReturnInfo
+from .image_functions import EncodedImage
+
+session_format_version = 1
+
+# A stored session is a little-endian 4 byte length, a JSON header of that length and the bytes of image field values after it
+# The header has everything needed to use the template again except the images, which it points to by (offset, length) after the header
+# Text values are stored as they are, image values as the compressed upload. Images kept decoded are stored as PNG so they decode to the same pixels
+# data needs 'template_id', 'filename', 'channel_id', 'message_id', 'expires_at' and 'fields' with 'type', 'bounds' and 'value'. returnValue is the payload
+def serialize_session(data: dict[str, Any]) -> ReturnInfo:
+    ret = ReturnInfo(Messages={
+        1: 'Unable to encode the value of field \"{}\"'
+    })
+    blobs = []
+    offset = 0
+    fields = {}
+    for field_name, field in data['fields'].items():
+        value = field['value']
+        stored_value = None
+        if isinstance(value, numpy.ndarray):
+            success, buffer = cv2.imencode('.png', value)
+            if not success:
+                ret.format_message(1, field_name)
+                ret.returnCode = 1
+                return ret
+            value = EncodedImage(buffer.tobytes())
+        if isinstance(value, EncodedImage):
+            stored_value = {'data': [offset, len(value.data)], 'factor': value.factor}
+            blobs.append(value.data)
+            offset += len(value.data)
+        elif not value is None:
+            text, font, font_scale, color = value
+            stored_value = {'text': text, 'font': font, 'font_scale': font_scale, 'color': list(color)}
+        fields[field_name] = {'type': field['type'], 'bounds': list(field['bounds']), 'value': stored_value}
+    header = json.dumps({
+        'version': session_format_version,
+        'template_id': data['template_id'],
+        'filename': data['filename'],
+        'channel_id': data['channel_id'],
+        'message_id': data['message_id'],
+        'expires_at': data['expires_at'],
+        'fields': fields
+    }, separators=(',', ':')).encode()
+    ret.returnValue = b''.join([struct.pack('<I', len(header)), header] + blobs)
+    return ret
+
+# Gives the session without its images and field layers: data with 'template_id', 'filename', 'channel_id', 'message_id', 'expires_at'
+# and 'fields', each field with 'type', 'bounds' and 'value', images as EncodedImage
+def deserialize_session(payload: bytes) -> ReturnInfo:
+    ret = ReturnInfo(Messages={
+        1: 'Stored session is damaged',
+        2: 'Stored session has an unsupported format version'
+    })
+    try:
+        header_length = struct.unpack_from('<I', payload)[0]
+        header = json.loads(payload[4:4 + header_length])
+    except (struct.error, ValueError):
+        ret.returnCode = 1
+        return ret
+    if header.get('version') != session_format_version:
+        ret.returnCode = 2
+        return ret
+    blobs = memoryview(payload)[4 + header_length:]
+    fields = {}
+    for field_name, field in header['fields'].items():
+        stored_value = field['value']
+        value = None
+        if not stored_value is None and 'data' in stored_value:
+            offset, length = stored_value['data']
+            value = EncodedImage(bytes(blobs[offset:offset + length]), stored_value['factor'])
+        elif not stored_value is None:
+            value = (stored_value['text'], stored_value['font'], stored_value['font_scale'], tuple(stored_value['color']))
+        fields[field_name] = {'type': field['type'], 'bounds': tuple(field['bounds']), 'value': value}
+    header['fields'] = fields
+    ret.returnValue = header
+    return ret
+
+# Session stores keep one serialized session per user together with the generation of the session and the time (time.time) it expires at
+# Saving replaces the stored session, deleting removes it only if it's still of the given generation, so a late delete of an ended session
+# can't remove a newer one. load returns (payload, generation, expires_at) with code 1 if there is nothing stored or it has expired
+# exists only tells whether load would find a session
+# Sessions are only serialized for stores with persistent set, as nothing else is ever read back
+
+# Sessions live in the bot's process only, where they're in use anyway, so nothing is stored and nothing survives a restart. filepath is not used
+class MemorySessionStore():
+    persistent = False
+
+    def __init__(self, filepath: str = ''):
+        pass
+
+    async def save(self, user_id: int, generation: int, expires_at: float, payload: bytes) -> ReturnInfo:
+        return ReturnInfo()
+
+    async def load(self, user_id: int, now: float) -> ReturnInfo:
+        return ReturnInfo(returnCode=1, okCodes=[0, 1], Messages={1: 'No stored session'})
+
+    async def delete(self, user_id: int, generation: int) -> ReturnInfo:
+        return ReturnInfo()
+
+    async def exists(self, user_id: int, now: float) -> ReturnInfo:
+        return ReturnInfo(returnValue=False)
+
+    def delete_expired(self, now: float) -> ReturnInfo:
+        return ReturnInfo(returnValue=0)
+
+    def close(self):
+        pass
+
+# Keeps sessions in an SQLite file, so they can be resumed after a restart
+# Queries run one at a time on a single thread of their own, in the order they were awaited, so the event loop never waits for the disk
+class SQLiteSessionStore():
+    persistent = True
+
+    def __init__(self, filepath: str):
+        self.connection = sqlite3.connect(filepath, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS sessions (user_id INTEGER PRIMARY KEY, generation INTEGER NOT NULL, expires_at REAL NOT NULL, payload BLOB NOT NULL)')
+        self.connection.commit()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='session_store')
+
+    def run_query(self, query: str, params: tuple, fetch: bool = False) -> ReturnInfo:
+        ret = ReturnInfo(Messages={1: 'Session store error: {error}'})
+        try:
+            cursor = self.connection.execute(query, params)
+            ret.returnValue = cursor.fetchone() if fetch else cursor.rowcount
+            self.connection.commit()
+        except sqlite3.Error as error:
+            ret.format_message(1, error=error)
+            ret.returnCode = 1
+        return ret
+
+    async def run(self, query: str, params: tuple, fetch: bool = False) -> ReturnInfo:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.run_query, query, params, fetch)
+
+    async def save(self, user_id: int, generation: int, expires_at: float, payload: bytes) -> ReturnInfo:
+        return await self.run('INSERT OR REPLACE INTO sessions (user_id, generation, expires_at, payload) VALUES (?, ?, ?, ?)', (user_id, generation, expires_at, payload))
+
+    async def load(self, user_id: int, now: float) -> ReturnInfo:
+        ret = ReturnInfo(okCodes=[0, 1], Messages={1: 'No stored session'})
+        result = await self.run('SELECT payload, generation, expires_at FROM sessions WHERE user_id = ? AND expires_at > ?', (user_id, now), fetch=True)
+        if not result:
+            return result
+        if result.returnValue is None:
+            ret.returnCode = 1
+            return ret
+        ret.returnValue = result.returnValue
+        return ret
+
+    async def delete(self, user_id: int, generation: int) -> ReturnInfo:
+        return await self.run('DELETE FROM sessions WHERE user_id = ? AND generation = ?', (user_id, generation))
+
+    # Doesn't read the stored session itself, returnValue tells whether there is one that hasn't expired
+    async def exists(self, user_id: int, now: float) -> ReturnInfo:
+        result = await self.run('SELECT 1 FROM sessions WHERE user_id = ? AND expires_at > ?', (user_id, now), fetch=True)
+        if result:
+            result.returnValue = not result.returnValue is None
+        return result
+
+    # Called once when the bot starts, before the store is used from the event loop
+    def delete_expired(self, now: float) -> ReturnInfo:
+        return self.run_query('DELETE FROM sessions WHERE expires_at <= ?', (now,))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.connection.close()
+
+session_store_types = {
+    'memory': MemorySessionStore,
+    'sqlite': SQLiteSessionStore
+}
+
+# filepath is only used by stores kept on disk. Stored sessions already expired are deleted, the others are only read when their users come back
+def open_session_store(type_name: str, filepath: str, now: float) -> ReturnInfo:
+    ret = ReturnInfo(Messages={
+        1: 'Unknown session store type \"{}\". Possible types: {}'.format(type_name, ', '.join(session_store_types.keys())),
+        2: 'Unable to open session store \"{}\": {{error}}'.format(filepath)
+    })
+    if not type_name in session_store_types.keys():
+        ret.returnCode = 1
+        return ret
+    try:
+        store = session_store_types[type_name](filepath)
+    except sqlite3.Error as error:
+        ret.format_message(2, error=error)
+        ret.returnCode = 2
+        return ret
+    result = store.delete_expired(now)
+    if not result:
+        store.close()
+        return result
+    ret.returnValue = store
+    return ret
\ No newline at end of file
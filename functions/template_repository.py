@@ -0,0 +1,108 @@
+from typing import Any
+from mysql.connector.cursor import MySQLCursor
+from .ReturnInfo import ReturnInfo
+from .database_functions import select as mysql_select
+from .async_database_functions import select as async_select
+from .cache_functions import LRUCache
+
+# A template and all of its fields come in one round trip. Templates without fields give a single row with NULL field columns
+template_columns = 'i.id, i.filename, i.image_extension, i.created_at, i.enumeration, f.id, f.field_name, f.type, f.up_bound, f.left_bound, f.down_bound, f.right_bound'
+template_query = 'SELECT {} FROM images AS i LEFT JOIN editable_fields AS f ON f.image_id=i.id WHERE i.user_id=%s AND i.enumeration=%s ORDER BY f.id'.format(template_columns)
+user_templates_query = 'SELECT {} FROM images AS i LEFT JOIN editable_fields AS f ON f.image_id=i.id WHERE i.user_id=%s ORDER BY i.enumeration, f.id'.format(template_columns)
+
+# Groups joined rows into templates: {'id', 'filename', 'extension', 'created_at', 'enumeration', 'fields'}
+# fields is a list of {'id', 'name', 'type', 'bounds'} in order of creation, bounds being (top, left, down, right)
+def templates_from_rows(rows: list[tuple[Any, ...]]) -> list[dict[str, Any]]:
+    templates = {}
+    for row in rows:
+        template_id = row[0]
+        if not template_id in templates.keys():
+            templates[template_id] = {'id': template_id, 'filename': row[1], 'extension': row[2], 'created_at': row[3], 'enumeration': row[4], 'fields': []}
+        if row[5] is None:
+            continue
+        templates[template_id]['fields'].append({'id': row[5], 'name': row[6], 'type': row[7], 'bounds': tuple(row[8:12])})
+    return list(templates.values())
+
+def template_result(result: ReturnInfo) -> ReturnInfo:
+    ret = ReturnInfo(Messages={
+        1: 'Template not found'
+    })
+    if not result:
+        return result
+    templates = templates_from_rows(result.returnValue)
+    if len(templates) == 0:
+        ret.returnCode = 1
+        return ret
+    ret.returnValue = templates[0]
+    return ret
+
+def user_templates_result(result: ReturnInfo) -> ReturnInfo:
+    if result:
+        result.returnValue = templates_from_rows(result.returnValue)
+    return result
+
+# Field names are compared like MySQL compares them, without case
+def find_field(template: dict[str, Any], field_name: str) -> dict[str, Any] | None:
+    for field in template['fields']:
+        if field['name'].lower() == field_name.lower():
+            return field
+    return None
+
+# Hashable description of the fields, changes whenever a field is added, removed or moved
+def fields_signature(template: dict[str, Any]) -> int:
+    return hash(tuple((field['name'], field['type'], field['bounds']) for field in template['fields']))
+
+# Blocking versions, used by the standalone client. With db_cursor set to None, a connection from the pool is used
+# Code 1 means there's no such template, other failing codes come from select
+def load_template(db_cursor: MySQLCursor | None, user_id: int | str, template_number: int) -> ReturnInfo:
+    return template_result(mysql_select(db_cursor, template_query, True, True, (str(user_id), template_number)))
+
+def load_user_templates(db_cursor: MySQLCursor | None, user_id: int | str) -> ReturnInfo:
+    return user_templates_result(mysql_select(db_cursor, user_templates_query, True, True, (str(user_id),)))
+
+# Awaitable loader used by the bot's commands, going through the database backend
+# Loaded templates are kept in a read-through cache keyed by (user id, template number), lists of templates under (user id, None)
+# Commands changing a template or its fields have to call invalidate. ttl limits how long changes made elsewhere (standalone client) go unnoticed
+# Cached templates are shared, so callers must not modify them
+class TemplateRepository():
+    def __init__(self, enabled: bool = True, ttl: float = 0, max_entries: int = 0):
+        self.enabled = enabled
+        self.cache = LRUCache(max_entries=max_entries, ttl=ttl)
+
+    def configure(self, enabled: bool, ttl: float, max_entries: int):
+        self.enabled = enabled
+        self.cache.resize(max_entries=max_entries, ttl=ttl)
+        if not enabled:
+            self.cache.clear()
+
+    async def get_template(self, user_id: int | str, template_number: int) -> ReturnInfo:
+        key = (str(user_id), template_number)
+        if self.enabled:
+            template = self.cache.get(key)
+            if not template is None:
+                return ReturnInfo(returnValue=template)
+        result = template_result(await async_select(template_query, True, True, key))
+        if self.enabled and result.returnCode == 0:
+            self.cache.put(key, result.returnValue)
+        return result
+
+    async def get_user_templates(self, user_id: int | str) -> ReturnInfo:
+        key = (str(user_id), None)
+        if self.enabled:
+            user_templates = self.cache.get(key)
+            if not user_templates is None:
+                return ReturnInfo(returnValue=user_templates)
+        result = user_templates_result(await async_select(user_templates_query, True, True, key[:1]))
+        if self.enabled and result:
+            self.cache.put(key, result.returnValue)
+        return result
+
+    # Drops the given template and the user's list of templates. Without template_number all of the user's templates are dropped
+    def invalidate(self, user_id: int | str, template_number: int | None = None) -> int:
+        user_id = str(user_id)
+        if template_number is None:
+            return self.cache.invalidate(lambda key: key[0] == user_id)
+        return self.cache.invalidate(lambda key: key[0] == user_id and key[1] in (template_number, None))
+
+    def stats(self) -> dict[str, int | float]:
+        return self.cache.stats()
\ No newline at end of file
@@ -0,0 +1,147 @@
+import cv2
+import threading
+from .cache_functions import LRUCache
+
+# Number of text layouts kept for reuse
+layout_cache_entries = 1024
+# Number of automatically fitted font scales kept for reuse
+fit_cache_entries = 1024
+# Limits of the automatic font scale search. The search stops once the range is narrower than fit_precision or after fit_iterations steps
+min_fit_scale = 0.1
+fit_precision = 0.01
+fit_iterations = 20
+
+# Hershey fonts advance by a whole number of font units per character, independent of the scale
+# cv2.getTextSize adds the scaled advances one by one and rounds once: width = round(sum(advance * scale) + thickness)
+# font -> character -> advance at scale 1
+character_advances = {}
+advances_lock = threading.Lock()
+
+layout_cache = LRUCache(max_entries=layout_cache_entries)
+# (text, font, thickness, width, height) -> the biggest scale that fits
+fit_cache = LRUCache(max_entries=fit_cache_entries)
+
+def get_character_advance(font: int, character: str) -> int:
+    advances = character_advances.get(font)
+    if advances is None:
+        with advances_lock:
+            advances = character_advances.setdefault(font, {})
+    advance = advances.get(character)
+    if advance is None:
+        (advance, _), _ = cv2.getTextSize(character, font, 1.0, 0)
+        advances[character] = advance
+    return advance
+
+# Height of a line without and with the part below the baseline. It doesn't depend on the text
+def get_line_metrics(font: int, font_scale: float, thickness: int) -> tuple[int, int]:
+    (_, text_height), baseline = cv2.getTextSize(' ', font, font_scale, thickness)
+    return text_height, baseline
+
+# Result of laying out a text in a given width. It can be drawn any number of times without measuring the text again
+class TextLayout():
+    def __init__(self, lines: list[str], width: int, font: int, font_scale: float, thickness: int, line_height: int, baseline: int):
+        self.lines = lines
+        # Width of the widest line
+        self.width = width
+        self.font = font
+        self.font_scale = font_scale
+        self.thickness = thickness
+        # Distance between baselines of two lines, the part below the baseline included
+        self.line_height = line_height
+        self.baseline = baseline
+
+    # Height the text takes from the top of the first line to the bottom of the last one
+    def height(self) -> int:
+        return len(self.lines) * self.line_height
+
+    # Room write_on_image asks for: down to the baseline of a line that would follow the last one
+    def required_height(self) -> int:
+        return self.height() + self.line_height - self.baseline
+
+    def fits(self, max_width: int, max_height: int) -> bool:
+        return self.width <= max_width and self.required_height() <= max_height
+
+    # Rectangle (top, left, down, right), down and right excluded, that drawing the text at (top, left) can change
+    # Glyphs may reach past the measured size (accents, slanted fonts, thick strokes), so a line height is added on every side
+    def extent(self, top: int, left: int) -> tuple[int, int, int, int]:
+        margin = self.line_height + self.thickness
+        return (top - margin, left - margin, top + self.height() + margin, left + self.width + margin)
+
+    # Baseline positions of the lines for a text starting at top
+    def line_positions(self, top: int) -> list[int]:
+        first_line = top + self.line_height - self.baseline
+        return [first_line + i * self.line_height for i in range(len(self.lines))]
+
+    def draw(self, image: cv2.Mat, top: int, left: int, color: tuple[int, int, int], line_type: int):
+        for line, position in zip(self.lines, self.line_positions(top)):
+            cv2.putText(image, line, (left, position), self.font, self.font_scale, color, self.thickness, line_type)
+
+# Greedy wrapping on spaces, linear in the length of the text. Returns the lines and the width of the widest one
+# A line is measured the way cv2.getTextSize does it, so lines break exactly where measuring the whole line would break them
+def wrap_words(text: str, max_width: int, font: int, font_scale: float, thickness: int) -> tuple[list[str], int]:
+    words = text.split(' ')
+    space = get_character_advance(font, ' ') * font_scale
+    lines = []
+    widest_line = 0
+    current_line = [words[0]]
+    current_width = 0.
+    for character in words[0]:
+        current_width += get_character_advance(font, character) * font_scale
+    for word in words[1:]:
+        width = current_width + space
+        for character in word:
+            width += get_character_advance(font, character) * font_scale
+        if round(width + thickness) <= max_width:
+            current_line.append(word)
+            current_width = width
+        else:
+            lines.append(' '.join(current_line))
+            widest_line = max(widest_line, round(current_width + thickness))
+            current_line = [word]
+            current_width = 0.
+            for character in word:
+                current_width += get_character_advance(font, character) * font_scale
+    lines.append(' '.join(current_line))
+    widest_line = max(widest_line, round(current_width + thickness))
+    return lines, widest_line
+
+def create_layout(text: str, max_width: int, font: int, font_scale: float, thickness: int) -> TextLayout:
+    text_height, baseline = get_line_metrics(font, font_scale, thickness)
+    lines, width = wrap_words(text, max_width, font, font_scale, thickness)
+    return TextLayout(lines, width, font, font_scale, thickness, text_height + baseline, baseline)
+
+# Layouts are cached, so laying out the same text in the same width again returns the same object
+def layout_text(text: str, max_width: int, font: int, font_scale: float, thickness: int) -> TextLayout:
+    key = (text, max_width, font, font_scale, thickness)
+    layout = layout_cache.get(key)
+    if layout is None:
+        layout = create_layout(text, max_width, font, font_scale, thickness)
+        layout_cache.put(key, layout)
+    return layout
+
+# Biggest font scale (within fit_precision) at which the wrapped text fits in bounds (top, left, down, right)
+# Found with a binary search. Layouts tried along the way are not cached, only the result is
+# If the text doesn't fit even at min_fit_scale, min_fit_scale is returned and write_on_image will report that it doesn't fit
+def fit_font_scale(text: str, bounds: tuple[int, int, int, int], font: int, thickness: int) -> float:
+    max_width = bounds[3] - bounds[1]
+    max_height = bounds[2] - bounds[0]
+    key = (text, font, thickness, max_width, max_height)
+    font_scale = fit_cache.get(key)
+    if not font_scale is None:
+        return font_scale
+    # A single line is taller than its scaled font height, so no bigger scale can fit
+    unit_height, _ = get_line_metrics(font, 1.0, 0)
+    low = min_fit_scale
+    high = max(low, max_height / max(1, unit_height))
+    if not create_layout(text, max_width, font, low, thickness).fits(max_width, max_height):
+        high = low
+    for _ in range(fit_iterations):
+        if high - low < fit_precision:
+            break
+        middle = (low + high) / 2
+        if create_layout(text, max_width, font, middle, thickness).fits(max_width, max_height):
+            low = middle
+        else:
+            high = middle
+    fit_cache.put(key, low)
+    return low
\ No newline at end of file
@@ -5,7 +5,7 @@ from mysql.connector.cursor import MySQLCursor
 from hashlib import sha256
 from datetime import datetime
 from zoneinfo import ZoneInfo
-from typing import Callable
+from typing import Any, Callable
 from .ReturnInfo import ReturnInfo
 from .database_functions import select as mysql_select
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -92,7 +92,8 @@ def load_settings(setting_path: str = settings_filename, required_keys: list = [
         result.returnCode = 1
     return result
 
-def load_descriptions(db_cursor: MySQLCursor) -> ReturnInfo:
+# Without a cursor, a connection from the pool is used
+def load_descriptions(db_cursor: MySQLCursor | None = None) -> ReturnInfo:
     global descriptions
     query = 'SELECT d.field_name, d.description_text FROM descriptions AS d'
     result = mysql_select(db_cursor, query, True, True)
@@ -103,11 +104,14 @@ def load_descriptions(db_cursor: MySQLCursor) -> ReturnInfo:
     return ReturnInfo()
 
 # Easier way to get a setting without worrying if it's been set if it's negligable
-def get_setting(setting_name: str, type_of_setting: type | None = None) -> str | int | bool | None:
+# If the setting is missing and a default is given, the default is returned instead of an empty value
+def get_setting(setting_name: str, type_of_setting: type | None = None, default: Any = None) -> str | int | bool | None:
     if setting_name in settings.keys():
         if type_of_setting is None:
             return settings[setting_name]
         return type_of_setting(settings[setting_name])
+    if not default is None:
+        return default
     if type_of_setting == str:
         return ''
     if type_of_setting == int:
@@ -14,12 +14,13 @@ from os import makedirs, path
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
-from constants import discord_intents, logging_format, date_format, main_required_settings, db_required_settings, default_color_hex, project_name, absolute_path_to_project, log_file_split_check_timer
+from constants import discord_intents, logging_format, date_format, main_required_settings, db_required_settings, default_color_hex, project_name, absolute_path_to_project, log_file_split_check_timer, default_db_pool_size, default_db_pool_timeout, default_db_ping_interval
 from functions.utils import load_settings, get_setting, load_descriptions, get_description, custom_time, find_option_in_args, ensure_image_dir
-from functions.database_functions import connect_database, set_logger as set_database_logger
+from functions.database_functions import setup_connection_pool, set_logger as set_database_logger
+from functions.async_database_functions import set_database_backend, ThreadPoolBackend
 from functions.ReturnInfo import ReturnInfo
 
-from commands import setup_commands, reconnect_database as commands_reconnect_database, turn_off_command_prototype, create_template_command_prototype, view_command_prototype, add_field_command_prototype, remove_field_command_prototype, use_template_command_prototype, fill_image_field_command_prototype, fill_text_field_command_prototype, using_template_check, possible_fonts
+from commands import setup_commands, turn_off_command_prototype, create_template_command_prototype, view_command_prototype, add_field_command_prototype, add_fields_command_prototype, remove_field_command_prototype, use_template_command_prototype, fill_image_field_command_prototype, fill_text_field_command_prototype, using_template_check, possible_fonts
 
 client = discord.Client(intents=discord_intents)
 command_tree = discord.app_commands.CommandTree(client)
@@ -226,6 +227,29 @@ def set_up_functions():
             return await add_field_command_prototype(context, field_type, name, template_number, up_bound, left_bound, down_bound, right_bound, reference_image, color)
     except discord.app_commands.CommandAlreadyRegistered:
         pass
+    #command to add all fields marked on a reference image
+    global add_fields_command
+    try:
+        @command_tree.command(
+            name='add_fields',
+            description=get_description('add_fields_command'),
+            guilds=command_guilds
+        )
+        @command_describe(
+            field_type=get_description('field_type_option'),
+            names=get_description('names_option'),
+            template_number=get_description('template_number_option'),
+            reference_image=get_description('reference_image_option'),
+            colors=get_description('reference_colors_option'),
+        )
+        @discord.app_commands.choices(field_type=[
+            discord.app_commands.Choice(name='Text', value='text'),
+            discord.app_commands.Choice(name='Image', value='image')
+        ])
+        async def add_fields_command(context: discord.Interaction, field_type: discord.app_commands.Choice[str], names: str, template_number: discord.app_commands.Range[int, 1, 3], reference_image: discord.Attachment, colors: str = default_color_hex):
+            return await add_fields_command_prototype(context, field_type, names, template_number, reference_image, colors)
+    except discord.app_commands.CommandAlreadyRegistered:
+        pass
     #command to remove field
     global remove_field_command
     try:
@@ -274,7 +298,7 @@ def set_up_functions():
         )
         @discord.app_commands.choices(font=[discord.app_commands.Choice(name=font_name, value=font_name) for font_name in possible_fonts.keys()])
         @discord.app_commands.check(using_template_check)
-        async def fill_text_field_command(context: discord.Interaction, field_name: str, text: str, font: discord.app_commands.Choice[str], font_size: float = 3., color: str = default_color_hex):
+        async def fill_text_field_command(context: discord.Interaction, field_name: str, text: str, font: discord.app_commands.Choice[str], font_size: float = 0., color: str = default_color_hex):
             return await fill_text_field_command_prototype(context, field_name, text, font, font_size, color)
     except discord.app_commands.CommandAlreadyRegistered:
         pass
@@ -311,26 +335,6 @@ async def on_ready():
     if logging_into_file:
         seperate_log_file()
 
-@client.event
-async def on_disconnect():
-    if not db_handle is None and db_handle.is_connected():
-        if not db_cursor is None:
-            db_cursor.close()
-        db_handle.close()
-        log_output('Database disconnected')
-
-@client.event
-async def on_resumed():
-    global db_handle, db_cursor
-    if db_handle is None or not db_handle.is_connected():
-        result = connect_database(get_setting('db_username'), get_setting('db_password'), get_setting('database_name'))
-        if not result:
-            log_output(result, level=logging.CRITICAL)
-            return
-        db_handle, db_cursor = result.returnValue
-        commands_reconnect_database(db_handle, db_cursor)
-        log_output('Database reconnected')
-
 @command_tree.error
 async def on_error(context: discord.Interaction, error: discord.app_commands.AppCommandError):
     if type(error) == discord.app_commands.errors.CheckFailure:
@@ -340,8 +344,6 @@ async def on_error(context: discord.Interaction, error: discord.app_commands.App
 
 # Main function of the program
 def main():
-    global db_handle
-    global db_cursor
     global timezone
     global logging_into_file
     global log_date
@@ -384,21 +386,21 @@ def main():
         return
     log_date = datetime.fromisoformat(result.returnValue).date() if result.returnCode == 0 else datetime.now(timezone).date()
 
-    result = connect_database(get_setting('db_username'), get_setting('db_password'), get_setting('database_name'))
+    # Connections are checked out per query, dead ones get reconnected by the pool
+    result = setup_connection_pool(get_setting('db_username'), get_setting('db_password'), get_setting('database_name'), get_setting('db_pool_size', int, default_db_pool_size), get_setting('db_pool_timeout', float, default_db_pool_timeout), get_setting('db_ping_interval', float, default_db_ping_interval))
     if not result:
         log_output(result, level=logging.CRITICAL)
         return
-    db_handle, db_cursor = result.returnValue
+    # Commands await queries on their own threads, one per pooled connection, so the event loop never blocks on the database
+    set_database_backend(ThreadPoolBackend(result.returnValue.pool_size))
 
-    result = load_descriptions(db_cursor)
+    result = load_descriptions()
     if not result:
         log_output(result, level=logging.ERROR)
         log_output('Unable to access descriptions. Descriptions might be missing', level=logging.ERROR)
 
     data_for_commands = {
         'client': client,
-        'db_cursor': db_cursor,
-        'db_handle': db_handle,
         'logging_ref': log_output
     }
     success = setup_commands(data_for_commands)
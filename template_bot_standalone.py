@@ -1,15 +1,17 @@
 import logging
 import cv2
 import threading
-from numpy import copy as copy_array
 from typing import Callable
 from os import path, access, W_OK
 from sys import argv
 from shutil import copy as copy_file
 from functions.utils import find_option_in_args, load_settings, get_setting, settings_filename as default_settings_filename, ensure_image_dir
-from constants import db_required_settings, logging_format, date_format, absolute_path_to_project, default_color_hex, default_hue_range, default_saturation_range, default_value_range
-from functions.database_functions import connect_database, set_logger, select as mysql_select, execute_query
-from functions.image_functions import show_fields as show_image_fields, hex_to_bgr, find_biggest_rectangle, write_on_image, insert_image_into_image, get_recommended_font_size
+from constants import db_required_settings, logging_format, date_format, absolute_path_to_project, default_color_hex, default_hue_range, default_saturation_range, default_value_range, default_diff_threshold
+from functions.database_functions import connect_database, set_logger, execute_query
+from functions.template_repository import load_template, load_user_templates, template_query, user_templates_query, find_field
+from functions.image_functions import show_fields as show_image_fields, hex_to_bgr, find_biggest_rectangle, find_changed_rectangle
+from functions.render_functions import LayeredImage, rasterize_field, fields_to_render, invalidate_field
+from functions.text_functions import fit_font_scale
 from functions.ReturnInfo import ReturnInfo
 
 db_handle = None
@@ -19,6 +21,7 @@ default_color = hex_to_bgr(default_color_hex).returnValue
 availible_fonts = {
     cv2.FONT_HERSHEY_SIMPLEX: 'Simple'
 }
+text_thickness = 2
 
 def show_image_task(window_name: str, image: cv2.Mat, threading_flag: threading.Event | None = None):
     cv2.imshow(window_name, image)
@@ -57,31 +60,27 @@ def choose_available_templates(no_templates_message = 'No templates found. Creat
         2: 'Something went wrong with mysql statement\nQuery: {query}\n{errMsg}',
         3: no_templates_message
     })
-    query = f'SELECT id, image_extension, created_at, enumeration, filename FROM images WHERE user_id=\"{name}\"'
-    result = mysql_select(db_cursor, query, True, True)
+    result = load_user_templates(db_cursor, name)
     if not result:
         ret.returnCode = 2
-        ret.format_message(2, query=query, errMsg=result)
+        ret.format_message(2, query=user_templates_query, errMsg=result)
         return ret
     if len(result.returnValue) == 0:
         ret.returnCode = 3
         return ret
     option = {}
-    number_to_id = {}
-    temp_filenames = {}
-    for record in result.returnValue:
-        option[record[3]] = f'{record[1]} image. Created at: {record[2]}'
-        number_to_id[record[3]] = record[0]
-        temp_filenames[record[3]] = record[4]
+    number_to_template = {}
+    for template in result.returnValue:
+        option[template['enumeration']] = f'{template["extension"]} image. Created at: {template["created_at"]}'
+        number_to_template[template['enumeration']] = template
     exit_key = max(option.keys()) + 1
     option[exit_key] = 'Exit'
     template_number = show_dialog_menu(option, 'Choose a template to add a field to')
     if template_number == exit_key:
         result.returnCode = 1
         return ret
-    image_id = number_to_id[template_number]
-    template_filename = temp_filenames[template_number]
-    ret.returnValue = {'id': image_id, 'enumeration': template_number, 'filename': template_filename}
+    # The template comes with all of its fields, so callers don't need to query them
+    ret.returnValue = number_to_template[template_number]
     return ret
 
 def prepare(args: list[str]) -> bool:
@@ -127,22 +126,22 @@ def login():
         name = input('Username: ')
     
 def view_command():
-    query = f'SELECT image_extension, created_at, enumeration FROM images WHERE user_id=\"{name}\"'
-    result = mysql_select(db_cursor, query, True, True)
+    result = load_user_templates(db_cursor, name)
     if not result:
         print('Something went wrong with mysql statement')
-        print(f'Query: {query}')
+        print(f'Query: {user_templates_query}')
         print(result)
         return
+    user_templates = {template['enumeration']: template for template in result.returnValue}
     template_options = {}
     forbidden_keys = []
     for i in range(1, 4):
         template_options[i] = 'No registered template'
         forbidden_keys.append(i)
-    for record in result.returnValue:
-        template_options[record[2]] = f'{record[0]} image. Created at: {record[1]}'
+    for template in result.returnValue:
+        template_options[template['enumeration']] = f'{template["extension"]} image. Created at: {template["created_at"]}'
         try:
-            forbidden_keys.remove(record[2])
+            forbidden_keys.remove(template['enumeration'])
         except ValueError:
             # This shouldn't happen without manipulating database by hand
             pass
@@ -152,30 +151,17 @@ def view_command():
     if template_number == exit_code:
         return
     show_fields = show_dialog_menu({1: 'Yes', 2: 'No'}, 'Would you like to view fields as well?') == 1
-    query = f'SELECT id, filename FROM images WHERE user_id=\"{name}\" AND enumeration={template_number}'
-    result = mysql_select(db_cursor, query)
-    if not result:
-        print('Something went wrong with mysql statement')
-        print(f'Query: {query}')
-        print(result)
-        return
-    filename = path.join(absolute_path_to_project, 'Images', result.returnValue[1])
+    template = user_templates[template_number]
+    filename = path.join(absolute_path_to_project, 'Images', template['filename'])
     image = cv2.imread(filename)
     if show_fields:
-        query = f'SELECT field_name, up_bound, left_bound, down_bound, right_bound, type FROM editable_fields WHERE image_id={result.returnValue[0]}'
-        result = mysql_select(db_cursor, query, True, True)
-        if not result:
-            print('Something went wrong with mysql statement')
-            print(f'Query: {query}')
-            print(result)
-            return
         field_names = []
         field_bounds = []
         field_types = []
-        for record in result.returnValue:
-            field_names.append(record[0])
-            field_bounds.append((record[1], record[2], record[3], record[4]))
-            field_types.append(record[5])
+        for field in template['fields']:
+            field_names.append(field['name'])
+            field_bounds.append(field['bounds'])
+            field_types.append(field['type'])
 
         result = show_image_fields(image, field_bounds, field_names, default_color)
         if not result:
@@ -207,31 +193,29 @@ def create_template_command():
     while not template_number.isdigit() or int(template_number) < 1 or int(template_number) > 3:
         print(f'\"{template_number}\" is not a correct template number. Please try again')
         template_number = input('Template number: ')
-    query = f'SELECT id, image_extension, created_at FROM images WHERE user_id=\"{name}\" AND enumeration={template_number}'
-    result = mysql_select(db_cursor, query)
+    result = load_template(db_cursor, name, int(template_number))
     # 0 means record found. 1 means no record was found
-    result.okCodes.append(1)
-    if not result:
+    if not result and result.returnCode != 1:
         print('Something went wrong with mysql statement')
-        print(f'Query: {query}')
+        print(f'Query: {template_query}')
         print(result)
         return
     if result.returnCode == 0:
         record = result.returnValue
-        print(f'{record[1]} file created at {record[2]} already exists for template number {template_number}')
+        print(f'{record["extension"]} file created at {record["created_at"]} already exists for template number {template_number}')
         print('Do you want to delete this template and create a new one?')
         if show_dialog_menu({1: 'Yes, delete', 2: 'No, keep the old one'},'Do you want to delete this template and create a new one?') == 2:
             return
-        query = f'DELETE FROM images WHERE id={record[0]}'
-        result = execute_query(db_handle, db_cursor, query)
+        query = 'DELETE FROM images WHERE id=%s'
+        result = execute_query(db_handle, db_cursor, query, (record['id'],))
         if not result:
             print('Something went wrong with mysql statement')
             print(f'Query: {query}')
             print(result)
             return
         print('Deleted old template')
-    query = f'INSERT INTO images (image_extension, user_id, enumeration, created_at) VALUES (\"{extension}\", \"{name}\", {template_number}, NOW())'
-    result = execute_query(db_handle, db_cursor, query)
+    query = 'INSERT INTO images (image_extension, user_id, enumeration, created_at) VALUES (%s, %s, %s, NOW())'
+    result = execute_query(db_handle, db_cursor, query, (extension, name, template_number))
     if not result:
         print('Something went wrong with mysql statement')
         print(f'Query: {query}')
@@ -246,21 +230,14 @@ def add_field_commad():
         if result.returnCode != 1:
             print(result)
         return
-    image_id = result.returnValue['id']
-    template_filename = result.returnValue['filename']
+    template = result.returnValue
+    image_id = template['id']
+    template_filename = template['filename']
     field_type = 'text' if show_dialog_menu({1: 'Text', 2: 'Image'}, 'What kind of field do you want to add?') == 1 else 'image'
-    query = 'SELECT 1 from editable_fields WHERE field_name=\"{}\" AND image_id=' + str(image_id)
     do_loop = True
     while do_loop:
         field_name = input('Pick a name for the field: ')
-        result = mysql_select(db_cursor, query.format(field_name))
-        result.okCodes.append(1)
-        if not result:
-            print('Something went wrong with mysql statement')
-            print(f'Query: {query}')
-            print(result)
-            return
-        do_loop = result.returnCode == 0
+        do_loop = not find_field(template, field_name) is None
         if do_loop:
             print('A field with that name already exists. Please choose another one')
     if show_dialog_menu({1: 'Use a reference image', 2: 'Set them by hand'}, 'What way do you want to describe boundaries for the field rectangle?') == 1:
@@ -284,7 +261,11 @@ def add_field_commad():
             color_hex = input('Hex color code: ')
             result = hex_to_bgr(color_hex)
         bgr_color = result.returnValue
-        result = find_biggest_rectangle(image, bgr_color, default_hue_range, default_saturation_range, default_value_range)
+        template_image = cv2.imread(path.join(absolute_path_to_project, 'Images', template_filename))
+        if template_image is None:
+            result = find_biggest_rectangle(image, bgr_color, default_hue_range, default_saturation_range, default_value_range)
+        else:
+            result = find_changed_rectangle(template_image, image, bgr_color, default_hue_range, default_saturation_range, default_value_range, get_setting('diff_threshold', int, default_diff_threshold))
         if not result:
             print(result)
             return
@@ -318,8 +299,8 @@ def add_field_commad():
     shared_flag.set()
     if stop_command:
         return
-    query = f'INSERT INTO editable_fields (field_name, type, up_bound, left_bound, down_bound, right_bound, image_id) VALUES (\"{field_name}\", \"{field_type}\", {bounds[0]}, {bounds[1]}, {bounds[2]}, {bounds[3]}, {image_id})'
-    result = execute_query(db_handle, db_cursor, query)
+    query = 'INSERT INTO editable_fields (field_name, type, up_bound, left_bound, down_bound, right_bound, image_id) VALUES (%s, %s, %s, %s, %s, %s, %s)'
+    result = execute_query(db_handle, db_cursor, query, (field_name, field_type, bounds[0], bounds[1], bounds[2], bounds[3], image_id))
     if not result:
         print('Something went wrong with mysql statement')
         print(f'Query: {query}')
@@ -334,29 +315,23 @@ def remove_field():
             print(result)
         return
     image_id = result.returnValue['id']
-    query = f'SELECT field_name, type FROM editable_fields WHERE image_id={image_id}'
-    result = mysql_select(db_cursor, query, True, True)
-    if not result:
-        print('Something went wrong with mysql statement')
-        print(f'Query: {query}')
-        print(result)
-        return
-    if len(result.returnValue) == 0:
+    template_fields = result.returnValue['fields']
+    if len(template_fields) == 0:
         print('There are not fields associated with the chosen template')
         return
     options = {}
     names = {}
-    for idx, record in enumerate(result.returnValue):
-        options[idx + 1] = f'{record[0]} ({record[1]} field)'
-        names[idx + 1] = record[0]
+    for idx, field in enumerate(template_fields):
+        options[idx + 1] = f'{field["name"]} ({field["type"]} field)'
+        names[idx + 1] = field['name']
     exit_code = max(options.keys()) + 1
     options[exit_code] = 'Exit'
     chosen_key = show_dialog_menu(options, 'Choose a field to delete')
     if chosen_key == exit_code:
         return
     field_name = names[chosen_key]
-    query = f'DELETE FROM editable_fields WHERE field_name=\"{field_name}\" AND image_id={image_id}'
-    result = execute_query(db_handle, db_cursor, query)
+    query = 'DELETE FROM editable_fields WHERE field_name=%s AND image_id=%s'
+    result = execute_query(db_handle, db_cursor, query, (field_name, image_id))
     if not result:
         print('Something went wrong with mysql statement')
         print(f'Query: {query}')
@@ -374,30 +349,23 @@ def use_template_command(data: dict | None = None):
             return
         image_filepath = path.join(absolute_path_to_project, 'Images', result.returnValue['filename'])
         template_image = cv2.imread(image_filepath)
-        image_id = result.returnValue['id']
-        query = f'SELECT field_name, type, up_bound, left_bound, down_bound, right_bound FROM editable_fields WHERE image_id={image_id}'
-        result = mysql_select(db_cursor, query, True, True)
-        if not result:
-            print('Something went wrong with mysql statement')
-            print(f'Query: {query}')
-            print(result)
-            return
         text_fields = {}
         image_fields = {}
-        for record in result.returnValue:
+        for field in result.returnValue['fields']:
             field_data = {
-                'bounds': (record[2], record[3], record[4], record[5]),
+                'type': field['type'],
+                'bounds': field['bounds'],
                 'value': None,
-                'updated': False
+                'updated': False,
+                'layer': None
             }
-            if record[1] == 'text':
-                text_fields[record[0]] = field_data
+            if field['type'] == 'text':
+                text_fields[field['name']] = field_data
             else:
-                image_fields[record[0]] = field_data
+                image_fields[field['name']] = field_data
         fields = {'text': text_fields, 'image': image_fields}
         data = {
-            'original_image': template_image,
-            'image': copy_array(template_image),
+            'layers': LayeredImage(template_image),
             'fields': fields
         }
     else:
@@ -431,36 +399,33 @@ def use_template_command(data: dict | None = None):
     elif chosen_option == 4:
         save_image(data)
     
+# Text and image fields by name, the way render_functions expects them. Field names are unique within a template
+def all_fields(data: dict) -> dict:
+    return {**data['fields']['text'], **data['fields']['image']}
+
 def update_image(data: dict) -> bool:
-    text_fields_to_update = [(field_name, field['bounds'], field['value']) for field_name, field in data['fields']['text'].items() if not field['updated'] and not field['value'] is None]
-    image_fields_to_update = [(field_name, field['bounds'], field['value']) for field_name, field in data['fields']['image'].items() if not field['updated'] and not field['value'] is None]
-    for field in text_fields_to_update:
-        field_name = field[0]
-        bounds = field[1]
-        text, font, font_size, color = field[2]
-        result = write_on_image(data['image'], text, font, font_size, color, 2, cv2.LINE_8, bounds)
-        if not result:
-            print(f'Error while updating field \"{field_name}\"')
-            print(result)
-            return False
-        data['image'] = result.returnValue
-        data['fields']['text'][field_name]['updated'] = True
-    for field in image_fields_to_update:
-        field_name = field[0]
-        bounds = field[1]
-        image = field[2]
-        result = insert_image_into_image(data['image'], image, bounds)
+    fields = all_fields(data)
+    layers = data['layers']
+    for field_name, field in fields.items():
+        if field['value'] is None or not field['layer'] is None:
+            continue
+        result = rasterize_field(field['type'], field['bounds'], field['value'], layers.shape, text_thickness, cv2.LINE_8)
         if not result:
             print(f'Error while updating field \"{field_name}\"')
             print(result)
             return False
-        data['image'] = result.returnValue
-        data['fields']['image'][field_name]['updated'] = True
+        field['layer'] = result.returnValue
+    # Text fields first, then image fields
+    fields_to_draw = fields_to_render(fields)
+    fields_to_draw.sort(key=lambda field_name: fields[field_name]['type'] != 'text')
+    layers.composite([fields[field_name]['layer'] for field_name in fields_to_draw])
+    for field_name in fields_to_draw:
+        fields[field_name]['updated'] = True
     return True
 
 def preview_template(data: dict):
     if update_image(data):
-        threading.Thread(target=show_image_task, args=('Previewing imge', data['image']), daemon=True).start()
+        threading.Thread(target=show_image_task, args=('Previewing imge', data['layers'].image), daemon=True).start()
 
 def fill_text_field(data: dict):
     options = {}
@@ -485,11 +450,14 @@ def fill_text_field(data: dict):
     font = id_to_key[show_dialog_menu(options, 'Which font do you want to use?')]
     print('Which text do you want to display on the field?')
     text = input('Text: ')
-    estimated_font_size = get_recommended_font_size(field['bounds'], len(text))
-    print(f'What size do you want your text to be? For this field and text recommended size is {estimated_font_size:.2f}')
+    fitted_font_size = fit_font_scale(text, field['bounds'], font, text_thickness)
+    print(f'What size do you want your text to be? The biggest size at which this text fits the field is {fitted_font_size:.2f}')
     font_size = None
     while font_size is None:
-        size_raw = input('Size: ')
+        size_raw = input('Size (leave empty to fit the text to the field): ')
+        if size_raw.strip() == '':
+            font_size = fitted_font_size
+            continue
         try:
             font_size = float(size_raw)
         except ValueError:
@@ -507,12 +475,8 @@ def fill_text_field(data: dict):
             print('Please try again')
     data['fields']['text'][field_name]['value'] = text, font, font_size, color
     if is_update:
-        # For text field if I don't do it, text could overlap with itself
-        # This isn't issue for image fields because this program doesn't support transparent images yet
-        for field_type in data['fields'].keys():
-            for field_name in data['fields'][field_type].keys():
-                data['fields'][field_type][field_name]['updated'] = False
-        data['image'] = copy_array(data['original_image'])
+        # For text field if I don't do it, text could overlap with itself. Only this field's part of the template is brought back
+        invalidate_field(data['layers'], all_fields(data), field_name)
     print(f'Field {field_name} filled out!')
 
 def fill_image_field(data: dict):
@@ -543,6 +507,12 @@ def fill_image_field(data: dict):
             continue
         check_ok = True
     data['fields']['image'][field_name]['value'] = image
+    invalidate_field(data['layers'], all_fields(data), field_name)
+    # Resized once now, updates only composite the layer until the field is filled again
+    field = data['fields']['image'][field_name]
+    result = rasterize_field('image', field['bounds'], image, data['layers'].shape, text_thickness, cv2.LINE_8)
+    if result:
+        field['layer'] = result.returnValue
     print(f'Field {field_name} filled out!')
 
 def save_image(data: dict):
@@ -569,7 +539,7 @@ def save_image(data: dict):
             continue
         check_ok = True
     update_image(data)
-    cv2.imwrite(filepath, data['image'])
+    cv2.imwrite(filepath, data['layers'].image)
     print(f'image saved to {filepath}')
 
 def main():
@@ -0,0 +1,83 @@
+"""
+Checks that the awaitable database functions give the same ReturnInfo as the blocking ones, using FakeBackend instead of a MySQL server
+Usage: python -m pytest tests
+"""
+
+import sys
+import os
+import asyncio
+import mysql.connector
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions.async_database_functions import FakeBackend, set_database_backend, close_database_backend, select as async_select, execute as async_execute, execute_many as async_execute_many
+from functions.database_functions import select, execute_query, execute_many
+
+template_rows = [(1, 'first.png'), (2, 'second.png')]
+
+def make_backend() -> FakeBackend:
+    fake_backend = FakeBackend()
+    fake_backend.add_rows(r'FROM templates', template_rows)
+    set_database_backend(fake_backend)
+    return fake_backend
+
+def same_result(blocking_result, async_result) -> bool:
+    return (blocking_result.returnCode, blocking_result.returnValue, str(blocking_result)) == (async_result.returnCode, async_result.returnValue, str(async_result))
+
+def test_select_matches_blocking_select():
+    fake_backend = make_backend()
+    cases = [
+        ('SELECT id, filename FROM templates WHERE user_id = %s', False, False, (5,)),
+        ('SELECT id, filename FROM templates WHERE user_id = %s', True, False, (5,)),
+        ('SELECT id FROM fields WHERE template_id = %s', False, False, (1,)),
+        ('SELECT id FROM fields WHERE template_id = %s', True, False, (1,)),
+        ('SELECT id FROM fields WHERE template_id = %s', True, True, (1,))
+    ]
+    for query, multiple, return_empty_list, params in cases:
+        blocking_result = select(fake_backend.cursor, query, multiple, return_empty_list, params)
+        async_result = asyncio.run(async_select(query, multiple, return_empty_list, params))
+        assert same_result(blocking_result, async_result), query
+    close_database_backend()
+
+def test_select_codes():
+    make_backend()
+    assert asyncio.run(async_select('SELECT id, filename FROM templates')).returnValue == template_rows[0]
+    assert asyncio.run(async_select('SELECT id, filename FROM templates', multiple=True)).returnValue == template_rows
+    assert asyncio.run(async_select('SELECT id FROM fields')).returnCode == 1
+    result = asyncio.run(async_select('SELECT id FROM fields', multiple=True, return_empty_list=True))
+    assert result and result.returnValue == []
+    close_database_backend()
+
+def test_execute_matches_blocking_execute():
+    fake_backend = make_backend()
+    query = 'DELETE FROM templates WHERE id = %s'
+    blocking_result = execute_query(fake_backend.cursor, fake_backend.cursor, query, (1,))
+    async_result = asyncio.run(async_execute(query, (1,)))
+    assert same_result(blocking_result, async_result)
+    assert fake_backend.executed == [(query, (1,)), (query, (1,))]
+    assert fake_backend.commits == 2
+    query = 'INSERT INTO fields (template_id, name) VALUES (%s, %s)'
+    params_list = [(1, 'a'), (1, 'b')]
+    blocking_result = execute_many(fake_backend.cursor, fake_backend.cursor, query, params_list)
+    async_result = asyncio.run(async_execute_many(query, params_list))
+    assert same_result(blocking_result, async_result)
+    assert fake_backend.executed[2:] == [(query, params) for params in params_list] * 2
+    close_database_backend()
+
+def test_errors_match_blocking_errors():
+    fake_backend = make_backend()
+    def failing_execute(query: str, params: tuple | None = None):
+        raise mysql.connector.Error('Table does not exist', errno=1146)
+    fake_backend.cursor.execute = failing_execute
+    query = 'SELECT id FROM missing'
+    blocking_result = select(fake_backend.cursor, query)
+    async_result = asyncio.run(async_select(query))
+    assert not async_result and same_result(blocking_result, async_result)
+    query = 'DELETE FROM missing'
+    blocking_result = execute_query(fake_backend.cursor, fake_backend.cursor, query)
+    async_result = asyncio.run(async_execute(query))
+    assert async_result.returnCode == 1146 and same_result(blocking_result, async_result)
+    close_database_backend()
+
+def test_without_backend():
+    close_database_backend()
+    assert asyncio.run(async_select('SELECT 1')).returnCode == -1
+    assert asyncio.run(async_execute('DELETE FROM templates')).returnCode == -1
\ No newline at end of file
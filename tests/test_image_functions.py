@@ -0,0 +1,44 @@
+"""
+Checks the order in which find_all_rectangles gives the fields drawn on a template and the pixel limit of decode_upload
+Usage: python -m pytest tests
+"""
+
+import sys
+import os
+import cv2
+import numpy
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions.image_functions import find_all_rectangles, decode_upload
+
+red = [0, 0, 255]
+
+def draw_boxes(boxes: list[tuple[int, int, int, int]]) -> numpy.ndarray:
+    image = numpy.full((200, 300, 3), 255, dtype=numpy.uint8)
+    for top, left, down, right in boxes:
+        image[top:down, left:right] = red
+    return image
+
+def test_offset_boxes_on_one_row_are_ordered_left_to_right():
+    # Drawn by hand, the boxes of the first row start a few pixels apart, the right-most one highest
+    boxes = [(23, 10, 53, 60), (20, 200, 50, 250), (25, 100, 55, 150), (120, 150, 150, 200), (122, 30, 152, 80)]
+    result = find_all_rectangles(draw_boxes(boxes), [red], 10, 50, 50)
+    assert result
+    assert [bounds for _, bounds in result.returnValue] == [boxes[0], boxes[2], boxes[1], boxes[4], boxes[3]]
+
+def test_boxes_on_separate_rows_are_ordered_top_to_bottom():
+    boxes = [(10, 200, 40, 250), (60, 10, 90, 60)]
+    result = find_all_rectangles(draw_boxes(boxes), [red], 10, 50, 50)
+    assert result
+    assert [bounds for _, bounds in result.returnValue] == boxes
+
+def test_uploads_of_unknown_size_are_rejected_with_a_limit():
+    # TIFF isn't one of the formats read_image_size reads, so its size can't be checked before decoding
+    buffer = cv2.imencode('.tiff', numpy.zeros((40, 50, 3), dtype=numpy.uint8))[1].tobytes()
+    assert decode_upload(buffer, 1000000, True).returnCode == 3
+    result = decode_upload(buffer, 0, True)
+    assert result and result.returnValue[0].shape == (40, 50, 3)
+
+def test_uploads_over_the_limit_are_rejected():
+    buffer = cv2.imencode('.png', numpy.zeros((40, 50, 3), dtype=numpy.uint8))[1].tobytes()
+    assert decode_upload(buffer, 1000, False).returnCode == 2
+    assert decode_upload(buffer, 2000, False)
\ No newline at end of file
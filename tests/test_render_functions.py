@@ -0,0 +1,46 @@
+"""
+Checks that a session released while a layer job is still running is rendered from its field values once it's used again
+Usage: python -m pytest tests
+"""
+
+import sys
+import os
+import asyncio
+import numpy
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions.render_functions import LayeredImage, release_layers, invalidate_field, fields_to_render, render_layered_image, rasterize_field
+from commands import start_layer_job
+
+def make_session() -> tuple[numpy.ndarray, LayeredImage, dict]:
+    template = numpy.full((60, 80, 3), 30, dtype=numpy.uint8)
+    fields = {'picture': {'type': 'image', 'bounds': (10, 10, 29, 39), 'value': None, 'updated': False, 'layer': None, 'layer_job': None}}
+    return template, LayeredImage(template), fields
+
+def fill(layers: LayeredImage, fields: dict, value: numpy.ndarray):
+    field = fields['picture']
+    field['value'] = value
+    invalidate_field(layers, fields, 'picture')
+    start_layer_job(layers, field)
+
+def test_late_layer_job_after_release():
+    async def run():
+        template, layers, fields = make_session()
+        fill(layers, fields, numpy.full((20, 30, 3), 200, dtype=numpy.uint8))
+        # Released for being idle before the job is done
+        release_layers(layers, fields)
+        await fields['picture']['layer_job'][1]
+        assert fields['picture']['layer'] is None
+        # Filled again while still released
+        fill(layers, fields, numpy.full((20, 30, 3), 100, dtype=numpy.uint8))
+        await fields['picture']['layer_job'][1]
+        assert fields['picture']['layer'] is None
+        # Used again: the template is attached and the field is rasterized from its value, as an update does
+        layers.attach(template)
+        field = fields['picture']
+        field['layer'] = rasterize_field(field['type'], field['bounds'], field['value'], layers.shape, 2, 8).returnValue
+        result = render_layered_image(layers, [fields[field_name]['layer'] for field_name in fields_to_render(fields)])
+        assert result
+        image = layers.current_image()
+        assert (image[10:30, 10:40] == 100).all()
+        assert (image[:10] == 30).all()
+    asyncio.run(run())
\ No newline at end of file